@@ -1,6 +1,17 @@
+import atexit
+import logging
 import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
 
 import pika
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
 
 
 class Amqp:
@@ -14,12 +25,34 @@ class Amqp:
         self.channel = self.connection.channel()
         self.channel.exchange_declare(exchange=exchange, exchange_type=exchange_type)
 
+    def enable_confirms(self):
+        """
+        Put the channel in confirm mode, publish will wait until the broker confirms the message.
+        """
+        self.channel.confirm_delivery()
+
     def publish(self, message, exchange="shares", routing_key=""):
-        self.channel.basic_publish(exchange, routing_key, body=message)
+        self.channel.basic_publish(
+            exchange, routing_key, body=message, properties=pika.BasicProperties(delivery_mode=2)
+        )
 
     def close_connection(self):
         self.connection.close()
 
+    def declare_queue(self, queue_name, routing_key="", exchange="shares", arguments=None):
+        """
+        Declare a durable queue bound to the exchange with the routing key
+        """
+        self.channel.queue_declare(queue=queue_name, durable=True, arguments=arguments)
+        self.channel.queue_bind(exchange=exchange, queue=queue_name, routing_key=routing_key)
+
+    def declare_dead_letter_queue(self, exchange, queue_name):
+        """
+        Declare a fanout exchange for the rejected messages of other queues and a durable queue that keeps them
+        """
+        self.channel.exchange_declare(exchange=exchange, exchange_type="fanout")
+        self.declare_queue(queue_name, exchange=exchange)
+
     def start_consuming(self, callback, queue='', exchange="shares"):
         result = self.channel.queue_declare(queue=queue, exclusive=True)
         queue_name = result.method.queue
@@ -30,3 +63,281 @@ class Amqp:
             auto_ack=True
         )
         self.channel.start_consuming()
+
+    def consume_batches(self, queues, batch_size, batch_timeout_ms, prefetch_count=None, exchange="shares",
+                        arguments=None):
+        """
+        Consume the queues (a dict of queue name and routing key) and yield lists of (method, body) with the
+        messages received until there are batch_size of them, or batch_timeout_ms passed since the first one.
+        The messages have to be acknowledged with ack.
+
+        The queues are durable, so the messages that were not acknowledged are delivered again if the consumer dies.
+        """
+        received = []
+
+        def on_message(channel, method, properties, body):
+            received.append((method, body))
+
+        self.channel.basic_qos(prefetch_count=prefetch_count or batch_size)
+        for queue_name, routing_key in queues.items():
+            self.declare_queue(queue_name, routing_key, exchange, arguments)
+            self.channel.basic_consume(queue=queue_name, on_message_callback=on_message)
+
+        timeout = batch_timeout_ms / 1000
+        while True:
+            while not received:
+                self.connection.process_data_events(time_limit=timeout)
+
+            deadline = time.monotonic() + timeout
+            while len(received) < batch_size and time.monotonic() < deadline:
+                self.connection.process_data_events(time_limit=max(deadline - time.monotonic(), 0))
+
+            batch = received[:]
+            del received[:]
+            yield batch
+
+    @contextmanager
+    def heartbeats(self, interval=5):
+        """
+        Keep answering the heartbeats of the broker from a background thread while the block runs, e.g. a long write,
+        so the broker doesn't close the connection. The connection isn't thread-safe, so the block must not use it.
+        """
+        done = threading.Event()
+
+        def process_events():
+            while not done.wait(interval):
+                try:
+                    self.connection.process_data_events(time_limit=0)
+                except pika.exceptions.AMQPError:
+                    logger.exception("Error processing the events of the connection")
+                    return
+
+        thread = threading.Thread(target=process_events, name="amqp-heartbeats", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def sleep(self, seconds):
+        """
+        Sleep processing the events of the connection
+        """
+        self.connection.sleep(seconds)
+
+    def ack(self, delivery_tag, multiple=False):
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+
+    def nack(self, delivery_tag, multiple=False, requeue=True):
+        self.channel.basic_nack(delivery_tag=delivery_tag, multiple=multiple, requeue=requeue)
+
+
+class AmqpPublisher:
+    """
+    Long-lived publisher. publish() only puts the message in a buffer, a background thread owns the broker connection
+    and sends the buffered messages in batches with publisher confirms, so the caller never waits for the broker.
+
+    The messages buffered in the same flush for the same routing key are sent as one amqp message, one per line.
+    If the connection is lost the thread reconnects and sends the batch again.
+
+    The queues (a dict of queue name and routing key) are declared with queue_arguments and bound every time it
+    connects, so the messages published before their consumer ever ran aren't dropped as unroutable.
+
+    publish() never blocks the caller for more than PUBLISH_TIMEOUT_MS: if the buffer is still full the message is
+    dropped, logged and counted in dropped, as the messages that the broker rejects (nack or unroutable). If the
+    thread died it is started again by the next publish().
+    """
+    def __init__(self, exchange="shares", exchange_type="fanout", batch_size=None, flush_interval_ms=None,
+                 max_buffer=None, queues=None, queue_arguments=None):
+        config = settings.AMQP_PUBLISHER
+        self.exchange = exchange
+        self.exchange_type = exchange_type
+        self.queues = queues or {}
+        self.queue_arguments = queue_arguments
+        self.batch_size = batch_size or config["BATCH_SIZE"]
+        self.flush_interval = (flush_interval_ms or config["FLUSH_INTERVAL_MS"]) / 1000
+        self.reconnect_delay = config["RECONNECT_DELAY_MS"] / 1000
+        self.publish_timeout = config["PUBLISH_TIMEOUT_MS"] / 1000
+        self.dropped = 0
+        self._buffer = queue.Queue(maxsize=max_buffer or config["MAX_BUFFER"])
+        self._amqp = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def publish(self, message, routing_key="") -> bool:
+        """
+        Buffer the message, False if it was dropped because the buffer was full
+        """
+        self._ensure_running()
+        try:
+            self._buffer.put((routing_key, message), timeout=self.publish_timeout)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                dropped = self.dropped
+            logger.error("Publisher buffer of {} is full, dropped {!r} ({} dropped)".format(
+                self.exchange, message, dropped
+            ))
+            return False
+        return True
+
+    def flush(self):
+        """
+        Block until every buffered message was confirmed by the broker.
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            self._ensure_running()
+            self._buffer.join()
+
+    def close(self):
+        if self._running():
+            try:
+                self._buffer.put(None, timeout=self.publish_timeout)
+            except queue.Full:
+                logger.error("Publisher buffer of {} is full, closing without sending it".format(self.exchange))
+                return
+            self._thread.join()
+            self._thread = None
+
+    def _running(self) -> bool:
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def _ensure_running(self):
+        if self._running():
+            return
+
+        with self._lock:
+            if self._running():
+                return
+            buffer = queue.Queue(maxsize=self._buffer.maxsize)
+            if self._thread is not None and self._pid == os.getpid():
+                # the thread died: the messages it took are lost, the ones it didn't take are kept
+                logger.error("Publisher thread of {} died, starting it again".format(self.exchange))
+                while True:
+                    try:
+                        buffer.put_nowait(self._buffer.get_nowait())
+                    except queue.Empty:
+                        break
+            # after a fork the thread and the connection of the parent process don't exist anymore
+            self._buffer = buffer
+            self._amqp = None
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="amqp-publisher", daemon=True)
+            self._thread.start()
+
+    def _next_batch(self):
+        """
+        Wait for the first message and then keep reading until the batch is full or the flush interval expires.
+        """
+        batch = []
+        while not batch:
+            try:
+                batch.append(self._buffer.get(timeout=self.flush_interval))
+            except queue.Empty:
+                self._heartbeat()
+
+        deadline = time.monotonic() + self.flush_interval
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._buffer.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        try:
+            self._publish_batches()
+        except Exception:
+            logger.exception("Publisher thread of {} stopped".format(self.exchange))
+            raise
+
+    def _publish_batches(self):
+        running = True
+        while running:
+            batch = self._next_batch()
+            running = batch[-1] is not None
+
+            messages = defaultdict(list)
+            for item in batch:
+                if item is not None:
+                    routing_key, message = item
+                    messages[routing_key].append(message)
+
+            for routing_key, lines in messages.items():
+                self._send("\n".join(lines), routing_key)
+
+            for _ in batch:
+                self._buffer.task_done()
+
+        if self._amqp is not None:
+            self._amqp.close_connection()
+
+    def _send(self, body, routing_key):
+        while True:
+            try:
+                if self._amqp is None:
+                    self._amqp = Amqp(exchange=self.exchange, exchange_type=self.exchange_type)
+                    for queue_name, queue_routing_key in self.queues.items():
+                        self._amqp.declare_queue(queue_name, queue_routing_key, self.exchange, self.queue_arguments)
+                    self._amqp.enable_confirms()
+                self._amqp.publish(body, exchange=self.exchange, routing_key=routing_key)
+                return
+            except (pika.exceptions.NackError, pika.exceptions.UnroutableError):
+                # the broker rejected the message, sending it again wouldn't change it
+                with self._lock:
+                    self.dropped += len(body.splitlines())
+                logger.exception("The broker rejected the message {!r} of {}, dropped".format(body, self.exchange))
+                return
+            except pika.exceptions.AMQPError:
+                logger.exception("Error publishing into {}, reconnecting".format(self.exchange))
+                self._disconnect()
+                time.sleep(self.reconnect_delay)
+
+    def _heartbeat(self):
+        if self._amqp is not None:
+            try:
+                self._amqp.connection.process_data_events(time_limit=0)
+            except pika.exceptions.AMQPError:
+                self._disconnect()
+
+    def _disconnect(self):
+        if self._amqp is not None:
+            try:
+                self._amqp.close_connection()
+            except pika.exceptions.AMQPError:
+                pass
+        self._amqp = None
+
+
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+def get_publisher(exchange="shares", exchange_type="fanout", queues=None, queue_arguments=None) -> AmqpPublisher:
+    """
+    Process-wide publisher for the exchange, the queues are declared by the publisher (see AmqpPublisher)
+    """
+    publisher = _publishers.get(exchange)
+    if publisher is None:
+        with _publishers_lock:
+            publisher = _publishers.get(exchange)
+            if publisher is None:
+                publisher = _publishers[exchange] = AmqpPublisher(
+                    exchange=exchange, exchange_type=exchange_type, queues=queues, queue_arguments=queue_arguments,
+                )
+                atexit.register(publisher.close)
+    return publisher
+
+
+def parse_message(body) -> list:
+    """
+    A message can carry several lines, one per published message.
+    """
+    if isinstance(body, bytes):
+        body = body.decode()
+    return [line for line in body.splitlines() if line.strip()]
@@ -0,0 +1,117 @@
+"""
+Async versions of the read endpoints. They run in the event loop of the ASGI server and read the read-only database
+with motor, so a request that waits for Mongo doesn't hold a thread of the sync-to-async pool.
+
+Django 3.2 can't stream an async iterator, so these endpoints return JSON pages only; the NDJSON streams are served
+by the sync endpoints.
+"""
+from bson.errors import InvalidId
+from django.http import HttpResponseNotAllowed, HttpResponseNotFound, JsonResponse
+from django.utils.cache import patch_vary_headers
+
+from rest_framework.status import HTTP_400_BAD_REQUEST
+
+from .cache import acached_organization, aorganization_validator_fields
+from .read_only import AsyncReadOnlyDB
+from .views import (
+    OrganizationSummaryViewSet, ShareHoldingViewSet, ShareOwnersViewSet, group_owners, holding_after, is_conditional,
+    not_modified_organization, not_modified_response, organization_validators, owner_after, page_limit,
+    paginated_response, with_validators,
+)
+
+
+async def paginate(entries, limit: int, cursor_of):
+    """
+    views.paginate for an async cursor
+    """
+    page = []
+    cursor = None
+    async for entry in entries:
+        if len(page) == limit:
+            return page, cursor
+        cursor = cursor_of(entry)
+        page.append(entry)
+    return page, None
+
+
+def invalid_page(exc) -> JsonResponse:
+    return JsonResponse({"detail": "Invalid page: {}".format(exc)}, status=HTTP_400_BAD_REQUEST)
+
+
+async def share_owners(request, orgnr):
+    """
+    Get information about the owners of the organization, paginated as in ShareOwnersViewSet
+    """
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    try:
+        limit = page_limit(request, streaming=False)
+        after = owner_after(request.GET.get("after"))
+    except (InvalidId, ValueError) as exc:
+        return invalid_page(exc)
+
+    if is_conditional(request):
+        response = not_modified_organization(request, await aorganization_validator_fields(orgnr))
+        if response is not None:
+            patch_vary_headers(response, ["Accept"])
+            return response
+
+    organization = await acached_organization(orgnr)
+    if organization is None:
+        return HttpResponseNotFound()
+
+    validators = organization_validators(organization)
+    response = not_modified_response(request, validators)
+    if response is None:
+        owners = AsyncReadOnlyDB().find_organization_owners(
+            orgnr, organization["total_shares"], after=after, limit=limit + 1
+        )
+        page, cursor = await paginate(owners, limit, ShareOwnersViewSet.owner_cursor)
+        response = paginated_response(request, group_owners(page), cursor, limit)
+
+    patch_vary_headers(response, ["Accept"])
+    return with_validators(response, validators)
+
+
+async def share_holding(request, orgnr):
+    """
+    Get information about the shares that the organization bought, paginated as in ShareHoldingViewSet
+    """
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    try:
+        limit = page_limit(request, streaming=False)
+        after = holding_after(request.GET.get("after"))
+    except ValueError as exc:
+        return invalid_page(exc)
+
+    rodb = AsyncReadOnlyDB()
+    owner_key = "organization:{}".format(orgnr)
+    if not await rodb.holdings_exist(owner_key):
+        return HttpResponseNotFound()
+
+    holdings = rodb.find_holdings(owner_key, after=after, limit=limit + 1)
+    page, cursor = await paginate(holdings, limit, ShareHoldingViewSet.holding_cursor)
+    return paginated_response(request, page, cursor, limit)
+
+
+async def organization_summary(request, orgnr):
+    """
+    Organization's summary, with an ETag and Last-Modified for conditional requests
+    """
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    if is_conditional(request):
+        response = not_modified_organization(request, await aorganization_validator_fields(orgnr))
+        if response is not None:
+            return response
+
+    data = await acached_organization(orgnr)
+    if not data:
+        return HttpResponseNotFound()
+
+    validators = organization_validators(data)
+    response = not_modified_response(request, validators)
+    if response is None:
+        response = JsonResponse(OrganizationSummaryViewSet.summary(data))
+    return with_validators(response, validators)
@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+import pika
+from django.conf import settings
+
+from .amqp import Amqp, get_publisher, parse_message
+from .read_only import AsyncReadOnlyDB, ReadOnlyDB
+
+logger = logging.getLogger(__name__)
+
+# Fanout exchange where the organizations saved in the read-only database are published, one orgnr per line, or "*"
+# when every organization could have changed
+INVALIDATION_EXCHANGE = "shares"
+INVALIDATE_ALL = "*"
+
+# Fields of the organization document that are cached for the summary and owners endpoints
+CACHED_FIELDS = [
+    "number_of_owners", "number_of_holdings", "has_foreign_owners", "has_multiple_share_class", "total_shares",
+    "share_class_totals", "group_id", "parent_company", "in_cross_holding", "top_owners", "owner_square_sum",
+    "version", "updated_at",
+]
+
+# Fields of the organization document that the conditional requests are answered with
+VALIDATOR_FIELDS = ["version", "updated_at"]
+
+
+class _Loading:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with a max size and a TTL per entry.
+
+    Concurrent misses of the same key are coalesced: only the first thread calls the loader, the other ones wait for
+    its value. A value that was invalidated while it was loaded is returned but not cached. aget does the same for
+    coroutines, the misses are coalesced among the tasks of the same event loop.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._tasks = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.coalesced = 0
+            self.evictions = 0
+            self.invalidations = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def _hit(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+        return False, None
+
+    def get(self, key, loader: Callable[[], Any]):
+        if not self.max_size:
+            return loader()
+
+        with self._lock:
+            hit, value = self._hit(key)
+            if hit:
+                return value
+
+            loading = self._loading.get(key)
+            leader = loading is None
+            if leader:
+                loading = self._loading[key] = _Loading()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            loading.event.wait()
+            if loading.error is not None:
+                raise loading.error
+            return loading.value
+
+        try:
+            loading.value = loader()
+        except Exception as exc:
+            loading.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._loading[key]
+                if loading.error is None and not loading.stale:
+                    self._set(key, loading.value)
+            loading.event.set()
+        return loading.value
+
+    async def aget(self, key, loader: Callable[[], Awaitable]):
+        if not self.max_size:
+            return await loader()
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            hit, value = self._hit(key)
+            if hit:
+                return value
+
+            task, loading = self._tasks.get(key, (None, None))
+            leader = task is None or task.get_loop() is not loop
+            if leader:
+                loading = _Loading()
+                task = loop.create_task(loader())
+                self._tasks[key] = (task, loading)
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return await asyncio.shield(task)
+
+        try:
+            return await asyncio.shield(task)
+        finally:
+            with self._lock:
+                if self._tasks.get(key, (None,))[0] is task:
+                    del self._tasks[key]
+                if task.done() and not task.cancelled() and task.exception() is None and not loading.stale:
+                    self._set(key, task.result())
+
+    def _set(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, keys: Iterable):
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+                if key in self._loading:
+                    self._loading[key].stale = True
+                if key in self._tasks:
+                    self._tasks[key][1].stale = True
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            for loading in self._loading.values():
+                loading.stale = True
+            for task, loading in self._tasks.values():
+                loading.stale = True
+
+
+class InvalidationListener:
+    """
+    Background thread that consumes the invalidation exchange with an exclusive queue per process and removes the
+    organizations from the cache, and from the other targets (objects with invalidate(orgnrs) and clear()) that are
+    added. While it is disconnected the invalidations are lost, so the targets are cleared when it reconnects.
+    """
+    def __init__(self, cache: LRUCache, exchange: str = INVALIDATION_EXCHANGE):
+        self.targets = [cache]
+        self.exchange = exchange
+        self.reconnect_delay = settings.AMQP_PUBLISHER["RECONNECT_DELAY_MS"] / 1000
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def ensure_running(self):
+        if self._running():
+            return
+
+        with self._lock:
+            if not self._running():
+                if self._thread is not None and self._pid == os.getpid():
+                    # it clears the targets again when it connects, the invalidations were lost while it was dead
+                    logger.error("Cache invalidation thread died, starting it again")
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="cache-invalidation", daemon=True)
+                self._thread.start()
+
+    def _running(self) -> bool:
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def _run(self):
+        while True:
+            try:
+                amqp = Amqp(exchange=self.exchange, exchange_type="fanout")
+                self.clear()
+                amqp.start_consuming(self.on_message, exchange=self.exchange)
+            except pika.exceptions.AMQPError:
+                logger.exception("Error listening the cache invalidations, reconnecting")
+                time.sleep(self.reconnect_delay)
+
+    def on_message(self, channel, method, properties, body):
+        lines = parse_message(body)
+        try:
+            if INVALIDATE_ALL in lines:
+                self.clear()
+            else:
+                self.invalidate([int(line) for line in lines])
+        except ValueError:
+            logger.exception("Invalid cache invalidation {}".format(body))
+            self.clear()
+
+    def invalidate(self, orgnrs: Iterable[int]):
+        for target in self.targets:
+            target.invalidate(orgnrs)
+
+    def clear(self):
+        for target in self.targets:
+            target.clear()
+
+
+organization_cache = LRUCache(settings.READ_ONLY_CACHE["MAX_SIZE"], settings.READ_ONLY_CACHE["TTL_SECONDS"])
+invalidation_listener = InvalidationListener(organization_cache)
+
+
+def cached_organization(orgnr: int) -> Optional[Dict[str, Any]]:
+    """
+    Cached fields of the organization document (the returned dict is shared, it must not be modified), or None if the
+    organization doesn't exist.
+    """
+    if os.getenv("AMQP_HOST") and organization_cache.max_size:
+        invalidation_listener.ensure_running()
+    return organization_cache.get(orgnr, lambda: ReadOnlyDB().find_organization_element_fields(orgnr, CACHED_FIELDS))
+
+
+async def acached_organization(orgnr: int) -> Optional[Dict[str, Any]]:
+    """
+    cached_organization for coroutines, the organization is read with the async driver
+    """
+    if os.getenv("AMQP_HOST") and organization_cache.max_size:
+        invalidation_listener.ensure_running()
+    return await organization_cache.aget(
+        orgnr, lambda: AsyncReadOnlyDB().find_organization_element_fields(orgnr, CACHED_FIELDS)
+    )
+
+
+def organization_validator_fields(orgnr: int) -> Optional[Dict[str, Any]]:
+    """
+    Version and updated_at of the organization, or None if it doesn't exist: from the cache, or reading only those two
+    fields when the cache is disabled.
+    """
+    if organization_cache.max_size:
+        return cached_organization(orgnr)
+    return ReadOnlyDB().find_organization_element_fields(orgnr, VALIDATOR_FIELDS)
+
+
+async def aorganization_validator_fields(orgnr: int) -> Optional[Dict[str, Any]]:
+    """
+    organization_validator_fields for coroutines
+    """
+    if organization_cache.max_size:
+        return await acached_organization(orgnr)
+    return await AsyncReadOnlyDB().find_organization_element_fields(orgnr, VALIDATOR_FIELDS)
+
+
+def invalidate_organizations(orgnrs: Iterable[int] = None):
+    """
+    Remove the organizations (every organization by default) from the cache (and the other invalidation targets) of
+    this process and publish them into the invalidation exchange for the other processes.
+    """
+    if orgnrs is None:
+        invalidation_listener.clear()
+        lines = [INVALIDATE_ALL]
+    else:
+        orgnrs = set(orgnrs)
+        invalidation_listener.invalidate(orgnrs)
+        lines = [str(orgnr) for orgnr in orgnrs]
+
+    if os.getenv("AMQP_HOST") and lines:
+        publisher = get_publisher(INVALIDATION_EXCHANGE, "fanout")
+        for line in lines:
+            publisher.publish(line)
@@ -0,0 +1,57 @@
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+
+# Largest owners whose stakes are added up in top_5_owners_percentage
+SUMMARY_TOP_OWNERS = 5
+
+# An owner controls the organizations where it has more than this fraction of the shares
+CONTROL_FRACTION = 0.5
+
+
+def percentage(amount: int, total_shares: int) -> float:
+    return 100 * amount / total_shares
+
+
+def top_owners(organization: Dict[str, Any], n: int) -> List[Dict[str, Any]]:
+    """
+    n largest owners of the organization, from the top_owners of its document, with their percentage
+    """
+    owners = []
+    for owner in organization.get("top_owners", [])[:n]:
+        owner_type, _id = owner["key"].split(":")
+        owners.append({
+            "owner_type": owner_type,
+            "id": int(_id),
+            "name": owner["name"],
+            "amount": owner["amount"],
+            "percentage": percentage(owner["amount"], organization["total_shares"]),
+        })
+    return owners
+
+
+def concentration_metrics(organization: Dict[str, Any]) -> Dict[str, Optional[float]]:
+    """
+    Ownership concentration of the organization, from the top_owners and owner_square_sum that the projection keeps
+    in its document, without the owners:
+
+    - largest_owner_percentage and top_5_owners_percentage: stake of the largest owner and of the 5 largest ones.
+    - hhi: Herfindahl-Hirschman index, the sum of the squared percentages of all the owners, from 0 to 10000.
+    - free_float_percentage: stake of the owners below CONCENTRATION["FREE_FLOAT_THRESHOLD"] %.
+
+    They are None for the organizations without owners.
+    """
+    total_shares = organization.get("total_shares", 0)
+    if not total_shares:
+        return dict.fromkeys(
+            ["largest_owner_percentage", "top_5_owners_percentage", "hhi", "free_float_percentage"]
+        )
+
+    percentages = [percentage(owner["amount"], total_shares) for owner in organization.get("top_owners", [])]
+    threshold = settings.CONCENTRATION["FREE_FLOAT_THRESHOLD"]
+    return {
+        "largest_owner_percentage": percentages[0] if percentages else 0.0,
+        "top_5_owners_percentage": sum(percentages[:SUMMARY_TOP_OWNERS]),
+        "hhi": 10000 * organization.get("owner_square_sum", 0) / total_shares ** 2,
+        "free_float_percentage": max(100 - sum(value for value in percentages if value >= threshold), 0.0),
+    }
@@ -0,0 +1,312 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from .cache import invalidation_listener
+
+logger = logging.getLogger(__name__)
+
+# Owners of the organizations grouped by owner. The organizations are keyed by orgnr and the persons by -id, so both
+# fit in the same int64 array of nodes
+EDGES_SQL = """
+    SELECT COALESCE(organization_owner_id, -person_owner_id), organization_owned_id, SUM(amount)
+    FROM holders_share
+    {where}
+    GROUP BY 1, 2
+"""
+
+
+def node_key(owner_type: str, _id: int) -> int:
+    return _id if owner_type == "organization" else -_id
+
+
+def node_owner(key: int) -> Dict[str, Any]:
+    return {"owner_type": "organization", "id": key} if key > 0 else {"owner_type": "person", "id": -key}
+
+
+def csr(rows: np.ndarray, columns: np.ndarray, values: np.ndarray, size: int):
+    """
+    Compressed sparse rows of the edges: the columns and values of the row i are in [indptr[i], indptr[i + 1])
+    """
+    order = np.lexsort((columns, rows))
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+    return indptr, columns[order], values[order]
+
+
+def gather(indptr: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Positions of the edges of all the rows at once, and the index in rows of the row of every edge
+    """
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return np.repeat(np.arange(rows.size), counts), offsets + np.arange(offsets.size)
+
+
+class CSRGraph:
+    """
+    Immutable ownership graph: the owners and owned organizations are nodes, sorted by key, and the shares are
+    edges from the owner to the owned organization with the sum of their amounts. The edges are kept as CSR arrays
+    by owner, with the int32 index of the owned organization and the int64 amount, and by owned organization, with
+    the int32 index of the owner only, so an edge takes 16 bytes. A node takes 32: its int64 key, the int64 pointers
+    of both CSR arrays and the float64 total of its shares.
+
+    The traversals expand the whole frontier of a level at once with array operations.
+    """
+    def __init__(self, owners: np.ndarray, owned: np.ndarray, amounts: np.ndarray):
+        self.nodes = np.unique(np.concatenate([owners, owned]))
+        size = self.nodes.size
+        sources = np.searchsorted(self.nodes, owners).astype(np.int32)
+        targets = np.searchsorted(self.nodes, owned).astype(np.int32)
+        amounts = amounts.astype(np.int64)
+
+        self.out_indptr, self.out_indices, self.out_amounts = csr(sources, targets, amounts, size)
+        self.in_indptr, self.in_indices, _ = csr(targets, sources, amounts, size)
+        self.total_shares = np.bincount(targets, weights=amounts, minlength=size)
+
+    @classmethod
+    def empty(cls) -> "CSRGraph":
+        empty = np.zeros(0, dtype=np.int64)
+        return cls(empty, empty, empty)
+
+    @property
+    def edges(self) -> int:
+        return self.out_indices.size
+
+    def stats(self) -> Dict[str, int]:
+        arrays = [
+            self.nodes, self.out_indptr, self.out_indices, self.out_amounts, self.in_indptr, self.in_indices,
+            self.total_shares,
+        ]
+        return {"nodes": self.nodes.size, "edges": self.edges, "bytes": sum(array.nbytes for array in arrays)}
+
+    def index(self, key: int) -> Optional[int]:
+        position = np.searchsorted(self.nodes, key)
+        if position < self.nodes.size and self.nodes[position] == key:
+            return int(position)
+        return None
+
+    def edge_list(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Owner key, owned key and amount of every edge
+        """
+        owners = np.repeat(self.nodes, np.diff(self.out_indptr))
+        return owners, self.nodes[self.out_indices], self.out_amounts
+
+    def bfs(self, source: int, max_depth: int, upstream: bool = False):
+        """
+        Depth of the nodes reached from the source (-1 if they aren't reached) following the holdings, or the owners
+        if upstream, and the edge position that reached every node first.
+        """
+        indptr, indices = (self.in_indptr, self.in_indices) if upstream else (self.out_indptr, self.out_indices)
+        depth = np.full(self.nodes.size, -1, dtype=np.int32)
+        via = np.full(self.nodes.size, -1, dtype=np.int64)
+        depth[source] = 0
+        frontier = np.array([source], dtype=np.int32)
+        for level in range(1, max_depth + 1):
+            _, positions = gather(indptr, frontier)
+            reached = indices[positions]
+            new = depth[reached] < 0
+            frontier, first = np.unique(reached[new], return_index=True)
+            if not frontier.size:
+                break
+            depth[frontier] = level
+            via[frontier] = positions[new][first]
+        return depth, via
+
+    def upstream(self, source: int, max_depth: int) -> List[Dict[str, Any]]:
+        """
+        Owners of the organization, directly or through other organizations, with the depth of their shortest chain
+        """
+        depth, _ = self.bfs(source, max_depth, upstream=True)
+        reached = np.flatnonzero(depth > 0)
+        reached = reached[np.argsort(depth[reached], kind="stable")]
+        return [dict(node_owner(int(self.nodes[node])), depth=int(depth[node])) for node in reached]
+
+    def downstream(self, source: int, max_depth: int, min_percentage: float) -> List[Dict[str, Any]]:
+        """
+        Organizations owned by the source directly or through other organizations, with the depth of their
+        shortest chain and the effective percentage that the source holds: the product of the percentages along
+        every chain of up to max_depth organizations, added up. The chains are cut below min_percentage and when
+        they get back to the source. Sorted by percentage, the largest first.
+        """
+        min_fraction = min_percentage / 100
+        stakes = np.zeros(self.nodes.size)
+        depth = np.full(self.nodes.size, -1, dtype=np.int32)
+        frontier = np.array([source], dtype=np.int32)
+        fractions = np.ones(1)
+        for level in range(1, max_depth + 1):
+            rows, positions = gather(self.out_indptr, frontier)
+            reached = self.out_indices[positions]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = fractions[rows] * self.out_amounts[positions] / self.total_shares[reached]
+            keep = (reached != source) & (values >= min_fraction)
+            frontier, inverse = np.unique(reached[keep], return_inverse=True)
+            if not frontier.size:
+                break
+            fractions = np.bincount(inverse, weights=values[keep])
+            stakes[frontier] += fractions
+            depth[frontier] = np.where(depth[frontier] < 0, level, depth[frontier])
+
+        reached = np.flatnonzero(depth > 0)
+        reached = reached[np.argsort(-stakes[reached], kind="stable")]
+        return [
+            {"orgnr": int(self.nodes[node]), "depth": int(depth[node]), "percentage": 100 * float(stakes[node])}
+            for node in reached
+        ]
+
+    def path(self, source: int, target: int, max_depth: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Shortest chain of holdings from the source to the target, with the percentage of every step, or None
+        """
+        depth, via = self.bfs(source, max_depth)
+        if depth[target] < 0:
+            return None
+
+        steps = []
+        node = target
+        while node != source:
+            position = via[node]
+            owner = int(np.searchsorted(self.out_indptr, position, side="right") - 1)
+            steps.append(dict(
+                node_owner(int(self.nodes[owner])),
+                orgnr=int(self.nodes[node]),
+                percentage=100 * float(self.out_amounts[position] / self.total_shares[node]),
+            ))
+            node = owner
+        return steps[::-1]
+
+
+class OwnershipGraph:
+    """
+    Ownership graph of this process, loaded from the shares of the write-only database the first time it is used.
+
+    It is kept up to date with the same invalidations as the organization cache: the owners of the invalidated
+    organizations are read again and they replace the old edges in a background thread, REBUILD_DELAY_MS after the
+    graph is used with pending changes, so all the changes of that time take one rebuild of the arrays. Meanwhile the
+    requests use the previous graph.
+    """
+    def __init__(self):
+        self.rebuild_delay = settings.OWNERSHIP_GRAPH["REBUILD_DELAY_MS"] / 1000
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._graph = None
+        self._pending = set()
+        self._reload = False
+        self._thread = None
+        self._pid = None
+
+    def _loaded(self) -> bool:
+        # Until it is loaded there is nothing to update, unless it is being loaded
+        return self._graph is not None or self._rebuild_lock.locked()
+
+    def invalidate(self, orgnrs: Iterable[int]):
+        with self._lock:
+            if self._loaded():
+                self._pending.update(orgnrs)
+
+    def clear(self):
+        with self._lock:
+            self._reload = self._loaded()
+
+    def graph(self) -> CSRGraph:
+        with self._lock:
+            graph, changed = self._graph, self._reload or self._pending
+        if graph is None:
+            return self.refresh()
+        if changed:
+            self._ensure_rebuilding()
+        return graph
+
+    def refresh(self) -> CSRGraph:
+        """
+        Apply the pending changes in this thread and return the new graph
+        """
+        with self._rebuild_lock:
+            with self._lock:
+                graph, reload, orgnrs = self._graph, self._reload or self._graph is None, self._pending
+                self._reload, self._pending = False, set()
+            try:
+                if reload:
+                    graph = CSRGraph(*self.read_edges())
+                elif orgnrs:
+                    graph = self.replace_owners(graph, orgnrs)
+            except Exception:
+                with self._lock:
+                    self._reload = self._reload or reload
+                    self._pending.update(orgnrs)
+                raise
+            with self._lock:
+                self._graph = graph
+            return graph
+
+    def _ensure_rebuilding(self):
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._rebuild, name="ownership-graph", daemon=True)
+            self._thread.start()
+
+    def _rebuild(self):
+        try:
+            time.sleep(self.rebuild_delay)
+            self.refresh()
+        except Exception:
+            logger.exception("Error rebuilding the ownership graph")
+        finally:
+            connection.close()
+
+    def replace_owners(self, graph: CSRGraph, orgnrs: Iterable[int]) -> CSRGraph:
+        orgnrs = np.array(sorted(orgnrs), dtype=np.int64)
+        owners, owned, amounts = graph.edge_list()
+        keep = ~np.isin(owned, orgnrs)
+        new_owners, new_owned, new_amounts = self.read_edges(orgnrs)
+        return CSRGraph(
+            np.concatenate([owners[keep], new_owners]),
+            np.concatenate([owned[keep], new_owned]),
+            np.concatenate([amounts[keep], new_amounts]),
+        )
+
+    @staticmethod
+    def read_edges(orgnrs: np.ndarray = None, chunk_size: int = 100000):
+        """
+        Owner, owned organization and amount of the shares grouped by owner, of the given organizations or all of
+        them, read with a server side cursor
+        """
+        if orgnrs is None:
+            sql, params = EDGES_SQL.format(where=""), []
+        else:
+            sql, params = EDGES_SQL.format(where="WHERE organization_owned_id = ANY(%s)"), [orgnrs.tolist()]
+
+        chunks = []
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchmany(chunk_size)
+            while rows:
+                chunks.append(np.array(rows, dtype=np.int64).reshape(-1, 3))
+                rows = cursor.fetchmany(chunk_size)
+
+        edges = np.concatenate(chunks) if chunks else np.zeros((0, 3), dtype=np.int64)
+        return edges[:, 0], edges[:, 1], edges[:, 2]
+
+
+ownership_graph = OwnershipGraph()
+invalidation_listener.targets.append(ownership_graph)
+
+
+def get_ownership_graph() -> CSRGraph:
+    """
+    Current ownership graph of this process. The invalidations of the other processes are listened if there is a
+    broker.
+    """
+    if os.getenv("AMQP_HOST"):
+        invalidation_listener.ensure_running()
+    return ownership_graph.graph()
@@ -0,0 +1,211 @@
+import heapq
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from django.conf import settings
+from django.db import connection
+from pymongo import UpdateOne
+
+from .concentration import CONTROL_FRACTION
+from .read_only import ReadOnlyDB
+
+# Field of the owner stats of every metric
+METRICS = {
+    "holdings": "number_of_holdings",
+    "shares": "total_shares",
+    "controlled": "controlled_companies",
+}
+
+# Metrics that only grow, the others can go down and are corrected by rebuild_leaderboards
+MONOTONIC_METRICS = {"holdings", "shares"}
+
+# Stats of the owners from their positions: organizations held, shares of all of them and organizations where they
+# have more than CONTROL_FRACTION of the shares. The totals are only computed for the organizations held by the owners
+OWNER_STATS_SQL = """
+    WITH owner_positions AS (
+        SELECT organization_owned_id, organization_owner_id, person_owner_id, SUM(amount) AS amount
+        FROM holders_position
+        {where}
+        GROUP BY organization_owned_id, organization_owner_id, person_owner_id
+    ), totals AS (
+        SELECT organization_owned_id, SUM(amount) AS total
+        FROM holders_position
+        WHERE organization_owned_id IN (SELECT organization_owned_id FROM owner_positions)
+        GROUP BY organization_owned_id
+    )
+    SELECT p.organization_owner_id, p.person_owner_id, COALESCE(o.name, pe.name), COUNT(*), SUM(p.amount),
+        COUNT(*) FILTER (WHERE p.amount > %(fraction)s * t.total)
+    FROM owner_positions p
+    JOIN totals t ON t.organization_owned_id = p.organization_owned_id
+    LEFT JOIN holders_organization o ON o.orgnr = p.organization_owner_id
+    LEFT JOIN holders_person pe ON pe.id = p.person_owner_id
+    GROUP BY p.organization_owner_id, p.person_owner_id, o.name, pe.name
+"""
+
+
+def controller(organization: Dict[str, Any]) -> Optional[str]:
+    """
+    Key of the owner with more than CONTROL_FRACTION of the organization's shares, the largest one, if any
+    """
+    top_owners = organization.get("top_owners")
+    if top_owners and top_owners[0]["amount"] > CONTROL_FRACTION * organization["total_shares"]:
+        return top_owners[0]["key"]
+    return None
+
+
+def controllers(orgnrs: Iterable[int]) -> Dict[int, Optional[str]]:
+    """
+    Controller of each organization, None if it has none or it isn't in the ReadOnly DB yet
+    """
+    orgnrs = list(orgnrs)
+    organizations = ReadOnlyDB().find_organizations_fields(orgnrs, ["total_shares", "top_owners"])
+    return {orgnr: controller(organizations[orgnr]) if orgnr in organizations else None for orgnr in orgnrs}
+
+
+def sort_key(entry: Dict[str, Any]):
+    return -entry["value"], entry["key"]
+
+
+def leaderboard_entry(owner_stats: Dict[str, Any], field: str) -> Dict[str, Any]:
+    return {"key": owner_stats["_id"], "name": owner_stats.get("name"), "value": owner_stats.get(field, 0)}
+
+
+def replace_entry(entry: Dict[str, Any], size: int, monotonic: bool) -> List[Dict[str, Any]]:
+    """
+    Update pipeline that replaces the entry of the owner in the leaderboard: the old entry is filtered out, the new
+    one is added if its value is positive and the entries are sorted and sliced to the size. For the metrics that only
+    grow the leaderboard is kept as it is if it already has a larger (newer) value of the owner.
+    """
+    others = {"$filter": {"input": "$$entries", "cond": {"$ne": ["$$this.key", entry["key"]]}}}
+    added = [{"$literal": entry}] if entry["value"] > 0 else []
+    replaced = {"$slice": [
+        {"$sortArray": {"input": {"$concatArrays": [others, added]}, "sortBy": {"value": -1, "key": 1}}}, size,
+    ]}
+    if monotonic:
+        newer = {"$anyElementTrue": [{"$map": {"input": "$$entries", "in": {
+            "$and": [{"$eq": ["$$this.key", entry["key"]]}, {"$gte": ["$$this.value", entry["value"]]}],
+        }}}]}
+        replaced = {"$cond": [newer, "$$entries", replaced]}
+    return [
+        {"$set": {"_entries": {"$let": {"vars": {"entries": {"$ifNull": ["$entries", []]}}, "in": replaced}}}},
+        {"$set": {
+            "updated_at": {"$cond": [{"$eq": ["$_entries", {"$ifNull": ["$entries", []]}]}, "$updated_at", "$$NOW"]},
+            "entries": "$_entries",
+        }},
+        {"$unset": "_entries"},
+    ]
+
+
+def leaderboard_operations(owner_stats: List[Dict[str, Any]],
+                           leaderboards: Dict[str, List[Dict[str, Any]]]) -> List[UpdateOne]:
+    """
+    Atomic updates of the leaderboards with the current stats of the owners. Every leaderboard is a bounded heap
+    kept sorted by MongoDB: the entry of an owner is replaced in one pipeline update, so only the LEADERBOARD_SIZE
+    largest are kept. The owners below the smallest entry of a full leaderboard (as it was read before) are skipped.
+
+    The entries of the metrics that only grow are only replaced by larger values, so concurrent updates never leave
+    an older value behind. The other metrics are corrected by rebuild_leaderboards.
+    """
+    size = settings.LEADERBOARD_SIZE
+    operations = []
+    for metric, field in METRICS.items():
+        entries = leaderboards.get(metric, [])
+        listed = {entry["key"] for entry in entries}
+        smallest = entries[-1]["value"] if len(entries) >= size else 0
+
+        for stats in owner_stats:
+            entry = leaderboard_entry(stats, field)
+            if entry["key"] not in listed and (entry["value"] <= 0 or entry["value"] < smallest):
+                continue
+            operations.append(UpdateOne(
+                {"_id": metric}, replace_entry(entry, size, metric in MONOTONIC_METRICS), upsert=True,
+            ))
+    return operations
+
+
+def refresh_leaderboards(owner_keys: Iterable[str]):
+    """
+    Update the leaderboards with the current stats of the owners
+    """
+    rodb = ReadOnlyDB()
+    owner_stats = rodb.find_owner_stats(owner_keys)
+    if owner_stats:
+        rodb.update_leaderboards(leaderboard_operations(owner_stats, rodb.find_leaderboards()))
+
+
+def build_owner_stats(owner_keys: Iterable[str] = None, chunk_size: int = 10000) -> Iterator[Dict[str, Any]]:
+    """
+    Stats of the owners (e.g. "organization:10" or "person:3"), or of every owner, computed from the positions and
+    read with a server side cursor
+    """
+    params = {"fraction": CONTROL_FRACTION}
+    if owner_keys is None:
+        where = ""
+    else:
+        ids = defaultdict(list)
+        for key in owner_keys:
+            kind, _id = key.split(":")
+            ids[kind].append(int(_id))
+        where = "WHERE organization_owner_id = ANY(%(organizations)s) OR person_owner_id = ANY(%(persons)s)"
+        params.update(organizations=ids["organization"], persons=ids["person"])
+
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(OWNER_STATS_SQL.format(where=where), params)
+        rows = cursor.fetchmany(chunk_size)
+        while rows:
+            for organization_owner, person_owner, name, holdings, shares, controlled in rows:
+                yield {
+                    "_id": "organization:{}".format(organization_owner) if organization_owner
+                    else "person:{}".format(person_owner),
+                    "name": name,
+                    "number_of_holdings": holdings,
+                    "total_shares": int(shares),
+                    "controlled_companies": controlled,
+                }
+            rows = cursor.fetchmany(chunk_size)
+
+
+def recompute_owner_stats(owner_keys: Iterable[str]):
+    """
+    Compute again the stats of the owners and update the leaderboards with them
+    """
+    owner_keys = list(owner_keys)
+    ReadOnlyDB().replace_owner_stats(build_owner_stats(owner_keys))
+    refresh_leaderboards(owner_keys)
+
+
+def rebuild_leaderboards(chunk_size: int = 10000) -> int:
+    """
+    Compute the stats of every owner and the leaderboards from scratch, in chunks of owners, keeping only the
+    LEADERBOARD_SIZE largest entries of every metric in memory. The stats that weren't rebuilt are removed.
+    """
+    rodb = ReadOnlyDB()
+    rebuilt_at = datetime.utcnow()
+    leaderboards = {metric: [] for metric in METRICS}
+    owners = 0
+
+    def flush(chunk):
+        rodb.replace_owner_stats(chunk)
+        for metric, field in METRICS.items():
+            entries = [leaderboard_entry(stats, field) for stats in chunk]
+            leaderboards[metric] = heapq.nsmallest(
+                settings.LEADERBOARD_SIZE, leaderboards[metric] + [entry for entry in entries if entry["value"] > 0],
+                key=sort_key,
+            )
+
+    chunk = []
+    for stats in build_owner_stats(chunk_size=chunk_size):
+        stats["rebuilt_at"] = rebuilt_at
+        chunk.append(stats)
+        if len(chunk) == chunk_size:
+            flush(chunk)
+            owners += len(chunk)
+            chunk = []
+    flush(chunk)
+    owners += len(chunk)
+
+    for metric, entries in leaderboards.items():
+        rodb.replace_leaderboard(metric, entries, rebuilt_at)
+    rodb.expire_owner_stats(rebuilt_at)
+    return owners
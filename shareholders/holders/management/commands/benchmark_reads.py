@@ -0,0 +1,103 @@
+import asyncio
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shareholders.asgi import application
+
+PATHS = {
+    "sync": "/api/{orgnr}/{endpoint}",
+    "async": "/api/async/{orgnr}/{endpoint}",
+}
+
+
+async def request(path: str, query_string: bytes = b""):
+    """
+    Call the ASGI application in this process, as the ASGI server does, and return the status of the response
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query_string,
+        "root_path": "",
+        "headers": [(b"host", b"localhost")],
+        "client": ("127.0.0.1", 0),
+        "server": ("localhost", 80),
+    }
+    received = asyncio.Event()
+    status = None
+
+    async def receive():
+        if received.is_set():
+            # The client doesn't disconnect
+            await asyncio.Future()
+        received.set()
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await application(scope, receive, send)
+    return status
+
+
+async def run(path: str, query_string: bytes, concurrency: int, requests: int):
+    latencies = []
+    errors = 0
+    pending = iter(range(requests))
+
+    async def client():
+        nonlocal errors
+        for _ in pending:
+            start = time.perf_counter()
+            status = await request(path, query_string)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return time.perf_counter() - start, latencies, errors
+
+
+class Command(BaseCommand):
+    help = 'Compare the sync and async read endpoints, calling the ASGI application with concurrent clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('orgnr', type=int)
+        parser.add_argument('--endpoint', choices=["owners", "holding", "summary"], default="summary")
+        parser.add_argument('--concurrency', type=int, default=100, help="Concurrent clients")
+        parser.add_argument('--requests', type=int, default=2000, help="Requests per path")
+        parser.add_argument('--limit', type=int, help="Page size of the owners and holdings")
+        parser.add_argument('--path', choices=sorted(PATHS), action='append', help="Paths to run, both by default")
+
+    def handle(self, *args, **options):
+        if options["concurrency"] < 1 or options["requests"] < 1:
+            raise CommandError("--concurrency and --requests must be positive")
+        query_string = "limit={}".format(options["limit"]).encode() if options["limit"] else b""
+
+        for name in options["path"] or ["sync", "async"]:
+            path = PATHS[name].format(orgnr=options["orgnr"], endpoint=options["endpoint"])
+            # One request first, so the clients, the cache and the thread pool are created out of the measure
+            asyncio.run(request(path, query_string))
+            elapsed, latencies, errors = asyncio.run(
+                run(path, query_string, options["concurrency"], options["requests"])
+            )
+            percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+            self.stdout.write(
+                "{name}: {rate:.0f} req/s, p50 {p50:.1f} ms, p99 {p99:.1f} ms, {errors} errors".format(
+                    name=name,
+                    rate=len(latencies) / elapsed,
+                    p50=percentiles[49] * 1000,
+                    p99=percentiles[98] * 1000,
+                    errors=errors,
+                )
+            )
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from holders.cache import invalidate_organizations
+from holders.graph import CSRGraph, OwnershipGraph
+from holders.groups import GroupAnalytics
+from holders.read_only import GROUP_FIELDS, ReadOnlyDB
+
+
+class Command(BaseCommand):
+    help = 'Compute the corporate groups and cross holdings of every organization into the ReadOnly Db'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help="Organizations per bulk write")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        graph = CSRGraph(*OwnershipGraph.read_edges())
+        analytics = GroupAnalytics(graph)
+        self.stdout.write("Groups of {nodes} nodes and {edges} edges computed in {seconds:.1f}s".format(
+            seconds=time.monotonic() - started, **graph.stats()
+        ))
+
+        # Only the organizations whose fields changed are written, so their version and ETag change
+        started = time.monotonic()
+        rodb = ReadOnlyDB()
+        updated = 0
+        for batch in rodb.iter_organization_fields(list(GROUP_FIELDS), options["batch_size"]):
+            changes = {}
+            for document, fields in zip(batch, analytics.fields([document["_id"] for document in batch])):
+                if any(document.get(field, default) != fields[field] for field, default in GROUP_FIELDS.items()):
+                    changes[document["_id"]] = fields
+            rodb.update_organization_fields(changes)
+            invalidate_organizations(changes)
+            updated += len(changes)
+
+        self.stdout.write("{} organizations updated in {:.1f}s".format(updated, time.monotonic() - started))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from holders.read_only import ReadOnlyDB
+
+
+class Command(BaseCommand):
+    help = 'Create the missing indexes of the ReadOnly Db'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prune', action='store_true', help="Drop the indexes that aren't declared")
+
+    def handle(self, *args, **options):
+        created = ReadOnlyDB().ensure_indexes(prune=options["prune"])
+        for collection, indexes in created.items():
+            self.stdout.write("{}: {}".format(collection, ", ".join(indexes) if indexes else "up to date"))
@@ -0,0 +1,231 @@
+import csv
+import io
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from holders.models import OrganizationStats, RegistryImport
+
+# Columns of the Aksjonærregisteret export
+COLUMNS = {
+    "orgnr": "Orgnr",
+    "company": "Selskap",
+    "share_class": "Aksjeklasse",
+    "holder_name": "Navn aksjonær",
+    "holder_id": "Fødselsår/orgnr",
+    "postal_code": "Postnr/sted",
+    "country": "Landkode",
+    "amount": "Antall aksjer",
+}
+
+COUNTRIES = {
+    "": "Norway",
+    "NOR": "Norway",
+}
+
+STAGING_TABLES = [
+    "DROP TABLE IF EXISTS registry_staging, registry_positions",
+    """
+    CREATE TEMPORARY TABLE registry_staging (
+        orgnr integer,
+        company varchar(255),
+        share_class varchar(8),
+        holder_name varchar(255),
+        holder_orgnr integer,
+        birth_year integer,
+        postal_code varchar(20),
+        country varchar(255),
+        amount integer
+    ) ON COMMIT DROP
+    """,
+]
+
+MERGE = [
+    # companies
+    """
+    INSERT INTO holders_organization (orgnr, name, postal_code, country)
+    SELECT DISTINCT ON (orgnr) orgnr, company, '', 'Norway' FROM registry_staging
+    ON CONFLICT (orgnr) DO UPDATE SET name = EXCLUDED.name
+    """,
+    # organizations that own shares
+    """
+    INSERT INTO holders_organization (orgnr, name, postal_code, country)
+    SELECT DISTINCT ON (holder_orgnr) holder_orgnr, holder_name, postal_code, country FROM registry_staging
+    WHERE holder_orgnr IS NOT NULL
+    ON CONFLICT (orgnr) DO UPDATE SET
+        name = EXCLUDED.name, postal_code = EXCLUDED.postal_code, country = EXCLUDED.country
+    """,
+    # persons that own shares, the registry only publishes the birth year
+    """
+    INSERT INTO holders_person (name, postal_code, country, birth_date)
+    SELECT DISTINCT s.holder_name, s.postal_code, s.country, make_date(s.birth_year, 1, 1) FROM registry_staging s
+    WHERE s.holder_orgnr IS NULL AND NOT EXISTS (
+        SELECT 1 FROM holders_person p
+        WHERE p.name = s.holder_name AND p.postal_code = s.postal_code AND p.country = s.country
+            AND p.birth_date IS NOT DISTINCT FROM make_date(s.birth_year, 1, 1)
+    )
+    """,
+    """
+    CREATE TEMPORARY TABLE registry_positions ON COMMIT DROP AS
+    SELECT s.orgnr, s.holder_orgnr, (
+        SELECT MIN(p.id) FROM holders_person p
+        WHERE s.holder_orgnr IS NULL AND p.name = s.holder_name AND p.postal_code = s.postal_code
+            AND p.country = s.country AND p.birth_date IS NOT DISTINCT FROM make_date(s.birth_year, 1, 1)
+    ) AS person_id, s.share_class, SUM(s.amount) AS amount
+    FROM registry_staging s
+    GROUP BY 1, 2, 3, 4
+    """,
+    # the registry is the source of truth for a position, so it replaces the position and the shares of the same
+    # owner and class
+    """
+    DELETE FROM holders_position po USING registry_positions r
+    WHERE po.organization_owned_id = r.orgnr AND po.share_class = r.share_class
+        AND (po.organization_owner_id = r.holder_orgnr OR po.person_owner_id = r.person_id)
+    """,
+    """
+    DELETE FROM holders_share sh USING registry_positions r
+    WHERE sh.organization_owned_id = r.orgnr AND sh.share_class = r.share_class
+        AND (sh.organization_owner_id = r.holder_orgnr OR sh.person_owner_id = r.person_id)
+    """,
+    """
+    INSERT INTO holders_share (organization_owned_id, organization_owner_id, person_owner_id, share_class, amount)
+    SELECT orgnr, holder_orgnr, person_id, share_class, amount FROM registry_positions
+    """,
+    """
+    INSERT INTO holders_position (organization_owned_id, organization_owner_id, person_owner_id, share_class, amount,
+        shares)
+    SELECT orgnr, holder_orgnr, person_id, share_class, amount, 1 FROM registry_positions
+    """,
+    OrganizationStats.REFRESH_SQL.format(
+        where="WHERE s.organization_owned_id IN (SELECT DISTINCT orgnr FROM registry_staging)"
+    ),
+]
+
+
+def normalize_share_class(value: str) -> str:
+    """
+    The application only knows A and B shares, every other class (e.g. "Ordinære aksjer") is saved as A share.
+    """
+    return "B-aksje" if value.strip().upper().startswith("B") else "A-aksjer"
+
+
+class Command(BaseCommand):
+    help = 'Import the shareholder registry (Aksjonærregisteret) CSV export'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV file")
+        parser.add_argument('--delimiter', default=';')
+        parser.add_argument('--encoding', default='utf-8-sig')
+        parser.add_argument('--batch-size', type=int, default=50000)
+        parser.add_argument(
+            '--restart', action='store_true', help="Ignore the checkpoint and import the file from the beginning"
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not os.path.exists(path):
+            raise CommandError("{} does not exist".format(path))
+
+        checkpoint, _ = RegistryImport.objects.get_or_create(source=os.path.abspath(path))
+        if options["restart"]:
+            checkpoint.offset = checkpoint.rows = 0
+            checkpoint.finished = False
+            checkpoint.save()
+        elif checkpoint.finished:
+            self.stdout.write("{} was already imported, use --restart to import it again".format(path))
+            return
+
+        self.delimiter = options["delimiter"]
+        self.encoding = options["encoding"]
+        started = time.monotonic()
+        imported = skipped = 0
+
+        with open(path, "rb") as csv_file:
+            header = self._parse_line(csv_file.readline())
+            try:
+                self.positions = {name: header.index(column) for name, column in COLUMNS.items()}
+            except ValueError as exc:
+                raise CommandError("Unexpected header: {}".format(exc))
+
+            if checkpoint.offset:
+                csv_file.seek(checkpoint.offset)
+                self.stdout.write("Resuming {} from row {}".format(path, checkpoint.rows))
+
+            batch = []
+            offset = checkpoint.offset or csv_file.tell()
+            for line in csv_file:
+                offset += len(line)
+                row = self._row(line)
+                if row is None:
+                    skipped += 1
+                else:
+                    batch.append(row)
+
+                if len(batch) >= options["batch_size"]:
+                    imported += self._import_batch(batch, checkpoint, offset)
+                    batch = []
+                    self._report(checkpoint, imported, started)
+
+            imported += self._import_batch(batch, checkpoint, offset, finished=True)
+            self._report(checkpoint, imported, started)
+
+        if skipped:
+            self.stdout.write("{} invalid rows were skipped".format(skipped))
+        self.stdout.write("The read-only database was not updated, it has to be rebuilt")
+
+    def _parse_line(self, line: bytes) -> list:
+        return next(csv.reader([line.decode(self.encoding)], delimiter=self.delimiter), [])
+
+    def _row(self, line: bytes):
+        """
+        Transform a registry line into a staging table row, or None if it is not valid.
+        """
+        values = self._parse_line(line)
+        if len(values) <= max(self.positions.values()):
+            return None
+
+        value = {name: values[position].strip() for name, position in self.positions.items()}
+        holder_id = value["holder_id"]
+        try:
+            return [
+                int(value["orgnr"]),
+                value["company"][:255],
+                normalize_share_class(value["share_class"]),
+                value["holder_name"][:255],
+                int(holder_id) if len(holder_id) == 9 else None,
+                int(holder_id) if len(holder_id) == 4 else None,
+                value["postal_code"].split(" ")[0][:20],
+                COUNTRIES.get(value["country"], value["country"])[:255],
+                int(value["amount"]),
+            ]
+        except ValueError:
+            return None
+
+    def _import_batch(self, batch: list, checkpoint: RegistryImport, offset: int, finished: bool = False) -> int:
+        # strings are quoted so COPY reads empty strings as '' and empty values (None) as NULL
+        buffer = io.StringIO()
+        csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(batch)
+        buffer.seek(0)
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                for statement in STAGING_TABLES:
+                    cursor.execute(statement)
+                cursor.copy_expert("COPY registry_staging FROM STDIN WITH (FORMAT csv)", buffer)
+                for statement in MERGE:
+                    cursor.execute(statement)
+
+            checkpoint.offset = offset
+            checkpoint.rows += len(batch)
+            checkpoint.finished = finished
+            checkpoint.save()
+
+        return len(batch)
+
+    def _report(self, checkpoint: RegistryImport, imported: int, started: float):
+        elapsed = time.monotonic() - started
+        self.stdout.write("{} rows imported ({:.0f} rows/sec)".format(
+            checkpoint.rows, imported / elapsed if elapsed else 0
+        ))
@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from holders.models import Organization
+from holders.ownership import ultimate_owners
+from holders.read_only import ReadOnlyDB
+
+
+class Command(BaseCommand):
+    help = 'Precompute the ultimate owners of the most requested organizations'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--top', type=int, default=settings.ULTIMATE_OWNERS["PRECOMPUTED_COMPANIES"],
+            help="Most requested organizations to precompute",
+        )
+        parser.add_argument('--orgnr', type=int, action='append', default=[], help="Organizations to precompute too")
+        parser.add_argument(
+            '--decay', type=float, default=0.5,
+            help="The request counters are multiplied by it after the run, so the old requests count less",
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        config = settings.ULTIMATE_OWNERS
+        rodb = ReadOnlyDB()
+        orgnrs = list(dict.fromkeys(options["orgnr"] + rodb.most_requested_ultimate_owners(options["top"])))
+        existing = set(Organization.objects.filter(orgnr__in=orgnrs).values_list("orgnr", flat=True))
+        orgnrs = [orgnr for orgnr in orgnrs if orgnr in existing]
+
+        for orgnr in orgnrs:
+            owners = ultimate_owners(orgnr, config["MAX_DEPTH"], config["MIN_PERCENTAGE"])
+            rodb.save_ultimate_owners(orgnr, owners, config["MAX_DEPTH"], config["MIN_PERCENTAGE"])
+        rodb.expire_ultimate_owners(orgnrs, options["decay"])
+
+        self.stdout.write("{} organizations precomputed in {:.1f}s".format(len(orgnrs), time.monotonic() - started))
@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from holders.leaderboard import rebuild_leaderboards
+
+
+class Command(BaseCommand):
+    help = 'Compute the stats of every owner and the leaderboards from the WriteOnly Db, to correct their drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000, help="Owners per bulk write")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        owners = rebuild_leaderboards(options["chunk_size"])
+        self.stdout.write("Leaderboards of {} owners rebuilt in {:.1f}s".format(owners, time.monotonic() - started))
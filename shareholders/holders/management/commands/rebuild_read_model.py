@@ -0,0 +1,80 @@
+import time
+from itertools import islice
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from holders.cache import invalidate_organizations
+from holders.leaderboard import rebuild_leaderboards
+from holders.projection import build_holding_documents, build_organization_documents, organization_ranges
+from holders.read_only import ReadOnlyDB
+
+
+def rebuild_range(collection, owners_collection, first_orgnr, last_orgnr):
+    documents = []
+    buckets = []
+    for document, organization_buckets in build_organization_documents(first_orgnr, last_orgnr):
+        documents.append(document)
+        buckets.extend(organization_buckets)
+
+    rodb = ReadOnlyDB()
+    if buckets:
+        rodb.database[owners_collection].insert_many(buckets, ordered=False)
+    return rodb.insert_organizations(documents, collection)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the ReadOnly Db organizations, holdings and leaderboards from the WriteOnly Db'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Organizations per chunk")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        rodb = ReadOnlyDB()
+        shadow = "{}_rebuild".format(rodb.organization_collection)
+        owners_shadow = "{}_rebuild".format(rodb.owners_collection)
+        rodb.database.drop_collection(shadow)
+        rodb.database.drop_collection(owners_shadow)
+
+        chunks = [(shadow, owners_shadow, first, last) for first, last in organization_ranges(options["chunk_size"])]
+
+        if options["workers"] > 1:
+            # the workers must open their own connections instead of sharing the ones of this process
+            connections.close_all()
+            with Pool(options["workers"]) as pool:
+                inserted = sum(pool.starmap(rebuild_range, chunks))
+        else:
+            inserted = sum(rebuild_range(*chunk) for chunk in chunks)
+
+        # the shadow collections replace the current ones with their indexes, so they are built before
+        rodb.database[shadow].create_indexes(rodb.indexes[rodb.organization_collection])
+        rodb.database[owners_shadow].create_indexes(rodb.indexes[rodb.owners_collection])
+        # the group analytics aren't computed by the projection, they are kept until compute_group_analytics runs
+        rodb.copy_group_fields(shadow)
+        rodb.replace_organization_collection(owners_shadow, rodb.owners_collection)
+        rodb.replace_organization_collection(shadow)
+        invalidate_organizations()
+        self.stdout.write("{} organizations rebuilt in {:.1f}s".format(inserted, time.monotonic() - started))
+
+        started = time.monotonic()
+        shadow = "{}_rebuild".format(rodb.holdings_collection)
+        rodb.database.drop_collection(shadow)
+        # the holdings are built in one pass over the positions ordered by owner
+        documents = build_holding_documents()
+        inserted = 0
+        while True:
+            chunk = list(islice(documents, options["chunk_size"]))
+            if not chunk:
+                break
+            inserted += rodb.insert_organizations(chunk, shadow)
+
+        rodb.database[shadow].create_indexes(rodb.indexes[rodb.holdings_collection])
+        rodb.replace_organization_collection(shadow, rodb.holdings_collection)
+        self.stdout.write("{} holdings rebuilt in {:.1f}s".format(inserted, time.monotonic() - started))
+
+        started = time.monotonic()
+        owners = rebuild_leaderboards()
+        self.stdout.write("Leaderboards of {} owners rebuilt in {:.1f}s".format(owners, time.monotonic() - started))
@@ -1,28 +1,155 @@
 import logging
+import multiprocessing
+import time
+from multiprocessing.connection import wait
 
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, close_old_connections, connections
+from pymongo.errors import PyMongoError
 
-from holders.amqp import Amqp
-from holders.models import Share
+from holders.amqp import Amqp, parse_message
+from holders.projection import (
+    DEAD_LETTER_EXCHANGE, DEAD_LETTER_QUEUE, PARTITION_QUEUE_ARGUMENTS, PROJECTION_EXCHANGE, ConcurrentUpdateError,
+    partition_queue, project_shares,
+)
 
 
 logger = logging.getLogger(__name__)
 
+# Seconds before a worker that died is started again
+WORKER_RESTART_DELAY = 1
+
+# Seconds before a failed batch is requeued, doubled after every consecutive failure up to MAX_RETRY_DELAY
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
 
 class Command(BaseCommand):
     help = 'Listen and save into ReadOnly Db new shares'
+    failures = 0
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help="Listener processes")
+        parser.add_argument(
+            '--partitions', default=None, help="Partitions to listen, e.g. 0-3 or 0,2,4. All of them if unset"
+        )
+        parser.add_argument('--batch-size', type=int, default=500, help="Max messages per batch")
+        parser.add_argument(
+            '--batch-timeout-ms', type=int, default=200, help="Max time waiting for the messages of a batch"
+        )
+        parser.add_argument('--prefetch', type=int, default=None, help="Unacknowledged messages, batch size if unset")
 
     def handle(self, *args, **options):
-        def callback(ch, method, properties, body):
-            logger.info("Receiving a new share {}".format(body))
+        partitions = self.parse_partitions(options["partitions"])
+        workers = min(options["workers"], len(partitions))
+        assigned = [partitions[worker::workers] for worker in range(workers)]
+        if workers == 1:
+            self.listen(assigned[0], options)
+            return
+
+        # the forked workers must not share the database connections of the parent
+        connections.close_all()
+        processes = {}
+        for worker in assigned:
+            process = self.start_worker(worker, options)
+            processes[process.sentinel] = process, worker
+
+        # a worker only exits if it failed, it is started again so its partitions are always consumed
+        while processes:
+            for sentinel in wait(list(processes)):
+                process, worker = processes.pop(sentinel)
+                logger.error("Listener of partitions {} exited with code {}, restarting it".format(
+                    worker, process.exitcode
+                ))
+                time.sleep(WORKER_RESTART_DELAY)
+                process = self.start_worker(worker, options)
+                processes[process.sentinel] = process, worker
+
+    def start_worker(self, partitions, options) -> multiprocessing.Process:
+        process = multiprocessing.Process(target=self.listen, args=(partitions, options))
+        process.start()
+        return process
+
+    @staticmethod
+    def parse_partitions(value) -> list:
+        if not value:
+            return list(range(settings.READ_ONLY_PARTITIONS))
+
+        partitions = set()
+        for part in value.split(","):
+            first, _, last = part.partition("-")
+            try:
+                partitions.update(range(int(first), int(last or first) + 1))
+            except ValueError:
+                raise CommandError("Invalid partitions {}".format(value))
+        if not partitions or max(partitions) >= settings.READ_ONLY_PARTITIONS:
+            raise CommandError("There are {} partitions".format(settings.READ_ONLY_PARTITIONS))
+        return sorted(partitions)
+
+    def listen(self, partitions, options):
+        """
+        Consume the queues of the partitions. The queues have a single active consumer, so if several listeners
+        consume the same partition only one gets the messages and the shares of an organization are saved in order.
+        """
+        amqp = Amqp(exchange=PROJECTION_EXCHANGE, exchange_type="direct")
+        amqp.declare_dead_letter_queue(DEAD_LETTER_EXCHANGE, DEAD_LETTER_QUEUE)
+        batches = amqp.consume_batches(
+            {partition_queue(partition): str(partition) for partition in partitions},
+            options["batch_size"],
+            options["batch_timeout_ms"],
+            prefetch_count=options["prefetch"],
+            exchange=PROJECTION_EXCHANGE,
+            arguments=PARTITION_QUEUE_ARGUMENTS,
+        )
+        logger.info("Listening partitions {}".format(partitions))
+        for batch in batches:
+            self.save_batch(amqp, batch)
+
+    def save_batch(self, amqp, batch):
+        """
+        Save the shares of the batch and acknowledge the messages only after the write succeeded. The shares of
+        redelivered messages could have been saved before the consumer died, so their organizations are recomputed.
+
+        A message that can't be parsed is rejected alone, so it is dead-lettered into DEAD_LETTER_QUEUE, and the
+        rest of the batch is saved. If the batch can't be saved its messages are requeued after a delay that grows
+        with the consecutive failures, and the broken database connections are closed.
+        """
+        valid = []
+        share_ids = []
+        for method, body in batch:
             try:
-                share_id = int(body)
+                ids = [int(line) for line in parse_message(body)]
             except (TypeError, ValueError):
-                raise
+                logger.exception("Dead-lettering invalid message {!r}".format(body))
+                amqp.nack(method.delivery_tag, requeue=False)
+                continue
+            valid.append(method)
+            share_ids.extend(ids)
+        if not valid:
+            return
 
-            share = Share.objects.get(pk=share_id)
-            share.save_in_ro_db()
-            logger.info("Share {} was saved into read only database".format(body))
+        last_tag = valid[-1].delivery_tag
+        redelivered = any(method.redelivered for method in valid)
+        started = time.monotonic()
+        close_old_connections()
+        try:
+            # a long batch would miss the heartbeats of the broker
+            with amqp.heartbeats():
+                saved = project_shares(share_ids, recompute=redelivered)
+        except (DatabaseError, PyMongoError, ConcurrentUpdateError):
+            close_old_connections()
+            self.failures += 1
+            delay = min(RETRY_DELAY * 2 ** (self.failures - 1), MAX_RETRY_DELAY)
+            logger.exception("Error saving shares {} into read only database, retrying in {}s".format(
+                share_ids, delay
+            ))
+            amqp.sleep(delay)
+            amqp.nack(last_tag, multiple=True)
+            return
 
-        amqp = Amqp()
-        amqp.start_consuming(callback=callback)
+        self.failures = 0
+        amqp.ack(last_tag, multiple=True)
+        logger.info("{} shares were saved into read only database in {:.0f}ms".format(
+            saved, (time.monotonic() - started) * 1000
+        ))
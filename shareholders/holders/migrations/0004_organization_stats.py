@@ -0,0 +1,60 @@
+# Generated by Django 3.2.4 on 2026-10-18 09:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('holders', '0003_registry_import'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrganizationStats',
+            fields=[
+                (
+                    'organization',
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name='stats',
+                        serialize=False,
+                        to='holders.organization'
+                    )
+                ),
+                ('foreign_owners', models.IntegerField(default=0)),
+                ('share_classes', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='share',
+            index=models.Index(fields=['organization_owned', 'share_class'], name='holders_sha_organiz_6c8d6f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='share',
+            index=models.Index(
+                fields=['organization_owned', 'organization_owner'], name='holders_sha_organiz_48c16e_idx'
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='share',
+            index=models.Index(fields=['organization_owned', 'person_owner'], name='holders_sha_organiz_134725_idx'),
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO holders_organizationstats (organization_id, foreign_owners, share_classes)
+            SELECT s.organization_owned_id,
+                COUNT(DISTINCT COALESCE('o' || s.organization_owner_id, 'p' || s.person_owner_id)) FILTER (
+                    WHERE COALESCE(o.country, p.country) <> 'Norway'
+                ),
+                COUNT(DISTINCT s.share_class)
+            FROM holders_share s
+            LEFT JOIN holders_organization o ON o.orgnr = s.organization_owner_id
+            LEFT JOIN holders_person p ON p.id = s.person_owner_id
+            GROUP BY s.organization_owned_id
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,91 @@
+# Generated by Django 3.2.4 on 2026-10-18 10:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('holders', '0004_organization_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Position',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                (
+                    'share_class',
+                    models.CharField(choices=[('A-aksjer', 'A-aksjer'), ('B-aksje', 'B-aksje')], max_length=8)
+                ),
+                ('amount', models.BigIntegerField(default=0)),
+                ('shares', models.IntegerField(default=0)),
+                (
+                    'organization_owned',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='owner_positions',
+                        to='holders.organization'
+                    )
+                ),
+                (
+                    'organization_owner',
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='owned_positions',
+                        to='holders.organization'
+                    )
+                ),
+                (
+                    'person_owner',
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='owned_positions',
+                        to='holders.person'
+                    )
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='position',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(('organization_owner__isnull', False)),
+                fields=('organization_owned', 'organization_owner', 'share_class'),
+                name='unique_organization_position'
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='position',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(('person_owner__isnull', False)),
+                fields=('organization_owned', 'person_owner', 'share_class'),
+                name='unique_person_position'
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='position',
+            constraint=models.CheckConstraint(
+                check=models.Q(
+                    models.Q(('organization_owner__isnull', False), ('person_owner__isnull', True)),
+                    models.Q(('organization_owner__isnull', True), ('person_owner__isnull', False)),
+                    _connector='OR'
+                ),
+                name='position_only_one_kind_of_owner'
+            ),
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO holders_position (
+                organization_owned_id, organization_owner_id, person_owner_id, share_class, amount, shares
+            )
+            SELECT organization_owned_id, organization_owner_id, person_owner_id, share_class, SUM(amount), COUNT(*)
+            FROM holders_share
+            GROUP BY organization_owned_id, organization_owner_id, person_owner_id, share_class
+            ORDER BY MIN(id)
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
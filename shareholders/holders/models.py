@@ -1,5 +1,9 @@
-from django.db import models
-from django.db.models import Q, Count
+from typing import Any, Dict, Iterable, Tuple
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
 
 from .read_only import ReadOnlyDB
 from .utils import prepare_data_for_read_only_db
@@ -11,16 +15,56 @@ class Person(models.Model):
     country = models.CharField(max_length=255)
     birth_date = models.DateField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["name", "postal_code"]),
+        ]
+
     def __str__(self) -> str:
         return self.name
 
 
+def foreign_owner_q(prefix: str = "") -> Q:
+    """
+    Shares owned by a foreign organization or person. The prefix is the path from the model to the share.
+    """
+    return (
+        Q(**{prefix + "organization_owner__isnull": False}) & ~Q(**{prefix + "organization_owner__country": "Norway"})
+    ) | (
+        Q(**{prefix + "person_owner__isnull": False}) & ~Q(**{prefix + "person_owner__country": "Norway"})
+    )
+
+
+class OrganizationQuerySet(models.QuerySet):
+    def with_stats(self) -> "OrganizationQuerySet":
+        """
+        Annotate the ownership stats of the organizations, so they are computed for all of them in one query
+        instead of one query per property and organization.
+        """
+        holdings = Share.objects.filter(organization_owner=OuterRef("pk")).order_by().values(
+            "organization_owner"
+        ).annotate(holdings=Count("organization_owned", distinct=True)).values("holdings")
+
+        return self.annotate(
+            _total_shares=Coalesce(Sum("owner_shares__amount"), 0),
+            _number_of_owners=(
+                Count("owner_shares__organization_owner", distinct=True) +
+                Count("owner_shares__person_owner", distinct=True)
+            ),
+            _number_of_holdings=Coalesce(Subquery(holdings, output_field=models.IntegerField()), 0),
+            _foreign_owner_shares=Count("owner_shares", filter=foreign_owner_q("owner_shares__")),
+            _share_classes=Count("owner_shares__share_class", distinct=True),
+        )
+
+
 class Organization(models.Model):
     name = models.CharField(max_length=255, null=False, blank=False)
     postal_code = models.CharField(max_length=20)
     country = models.CharField(max_length=255)
     orgnr = models.IntegerField(primary_key=True)
 
+    objects = OrganizationQuerySet.as_manager()
+
     def __str__(self) -> str:
         return self.name
 
@@ -29,50 +73,68 @@ class Organization(models.Model):
         """
         Total shares that the organization has
         """
-        return sum([x.amount for x in Share.objects.filter(organization_owned=self).all()])
+        if hasattr(self, "_total_shares"):
+            return self._total_shares
+        return Share.objects.filter(organization_owned=self).aggregate(total=Coalesce(Sum("amount"), 0))["total"]
 
     @property
     def number_of_owners(self) -> int:
         """
         Amount of share that the organization sold
         """
-        return len(
-            Share.objects.filter(
-                organization_owned=self, organization_owner__isnull=False
-            ).values("organization_owner").distinct()
-        ) + len(
-            Share.objects.filter(organization_owned=self, person_owner__isnull=False).values("person_owner").distinct()
-        )
+        if hasattr(self, "_number_of_owners"):
+            return self._number_of_owners
+        return Share.objects.filter(organization_owned=self).aggregate(
+            owners=Count("organization_owner", distinct=True) + Count("person_owner", distinct=True)
+        )["owners"]
 
     @property
     def number_of_holdings(self) -> int:
         """
         Amount of shares that the organization bought
         """
-        return len(Share.objects.filter(organization_owner=self).values("organization_owned").distinct())
+        if hasattr(self, "_number_of_holdings"):
+            return self._number_of_holdings
+        return Share.objects.filter(organization_owner=self).values("organization_owned").distinct().count()
 
     @property
     def has_foreign_owners(self) -> bool:
         """
         If the organization has foreign owners
         """
-        organizations = Share.objects.filter(
-            ~Q(organization_owner__country='Norway') & Q(organization_owner__isnull=False)
-        )
-        persons = Share.objects.filter(
-            ~Q(person_owner__country='Norway') & Q(person_owner__isnull=False)
-        )
-
-        return True if organizations or persons else False
+        if hasattr(self, "_foreign_owner_shares"):
+            return self._foreign_owner_shares > 0
+        return self.owner_stats.foreign_owners > 0
 
     @property
     def has_multiple_share_class(self) -> bool:
         """
         If the holders bought different kinds of shares
         """
-        return len(
-            Share.objects.values('share_class').annotate(dcount=Count('id')).filter(organization_owned=self)
-        ) > 1
+        if hasattr(self, "_share_classes"):
+            return self._share_classes > 1
+        return self.owner_stats.share_classes > 1
+
+    @property
+    def owner_stats(self) -> "OrganizationStats":
+        try:
+            return self.stats
+        except OrganizationStats.DoesNotExist:
+            return OrganizationStats(organization=self)
+
+    def read_only_data(self) -> Dict[str, Any]:
+        """
+        Organization's fields and ownership stats as they are saved into ReadOnly DB.
+        """
+        data = prepare_data_for_read_only_db(self)
+        data.update({
+            "total_shares": self.total_shares,
+            "number_of_owners": self.number_of_owners,
+            "number_of_holdings": self.number_of_holdings,
+            "has_foreign_owners": self.has_foreign_owners,
+            "has_multiple_share_class": self.has_multiple_share_class,
+        })
+        return data
 
 
 class Share(models.Model):
@@ -105,6 +167,11 @@ class Share(models.Model):
         return self.organization_owned.name
 
     class Meta:
+        indexes = [
+            models.Index(fields=["organization_owned", "share_class"]),
+            models.Index(fields=["organization_owned", "organization_owner"]),
+            models.Index(fields=["organization_owned", "person_owner"]),
+        ]
         constraints = [
             models.CheckConstraint(
                 check=(
@@ -118,6 +185,36 @@ class Share(models.Model):
             )
         ]
 
+    def save(self, *args, **kwargs):
+        """
+        The organization's stats are updated in the same transaction. The stats row is locked first, so the shares
+        of the same organization are counted one at a time.
+
+        The share is added to its position in the same transaction too. The amounts of the owner's positions in the
+        organization, with this share, are kept for the projection into the ReadOnly DB: owner_amount and owner_shares
+        (all the classes), position_amount and position_shares (the share's class). The stats and the position are
+        updated before the share is inserted, so they include it when post_save projects it.
+        """
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+
+        with transaction.atomic():
+            stats, _ = OrganizationStats.objects.select_for_update().get_or_create(
+                organization_id=self.organization_owned_id
+            )
+            other_classes = Position.objects.filter(
+                organization_owned_id=self.organization_owned_id,
+                organization_owner_id=self.organization_owner_id,
+                person_owner_id=self.person_owner_id,
+            ).exclude(share_class=self.share_class).aggregate(
+                amount=Coalesce(Sum("amount"), 0), shares=Coalesce(Sum("shares"), 0)
+            )
+            stats.add_share(self)
+            self.position_amount, self.position_shares = Position.add_share(self)
+            self.owner_amount = other_classes["amount"] + self.position_amount
+            self.owner_shares = other_classes["shares"] + self.position_shares
+            super().save(*args, **kwargs)
+
     @property
     def percentage(self) -> float:
         """
@@ -129,49 +226,211 @@ class Share(models.Model):
         """
         This function transform the WriteOnly DB Record and save it into ReadOnly DB.
 
-        1. This function transforms all the Django ORM objects to Python's dict
-        2. This function checks if the organization exists in the RO DB
-        3. If exists it updates the record otherwise it will add a new one.
-        """
-        share_data = {
-            "share_class": self.share_class,
-            "amount": self.amount,
-        }
-
-        organization_data = prepare_data_for_read_only_db(self.organization_owned)
-        organization_data.update({
-            "total_shares": self.organization_owned.total_shares,
-            "number_of_owners": self.organization_owned.number_of_owners,
-            "number_of_holdings": self.organization_owned.number_of_holdings,
-            "has_foreign_owners": self.organization_owned.has_foreign_owners,
-            "has_multiple_share_class": self.organization_owned.has_multiple_share_class,
-        })
+        In "incremental" projection (the default) the share is added to the organization documents, the owner
+        buckets and the holdings of the owner with atomic updates, in "full" projection the documents are computed
+        again and replaced. Then the stats of the owner, and of the owners that got or lost the control of the
+        organization, are updated in the leaderboards.
+        """
+        from .cache import invalidate_organizations
+        from .leaderboard import controllers
+        from .projection import (
+            bucket_operations, holding_operations, owner_key, project_owner_stats, recompute_holdings,
+            recompute_organizations, share_operations,
+        )
+
+        before = controllers([self.organization_owned_id])
+        recompute = settings.READ_ONLY_PROJECTION == "full"
+        if recompute:
+            recompute_organizations(
+                {self.organization_owned_id, self.organization_owner_id} - {None}, owned=[self.organization_owned_id]
+            )
+            recompute_holdings([owner_key(self)])
+        else:
+            rodb = ReadOnlyDB()
+            rodb.update_organizations(share_operations(self))
+            rodb.update_owner_buckets(bucket_operations([self]))
+            rodb.update_holdings(holding_operations(self))
+        project_owner_stats([self], before, recompute)
+        invalidate_organizations({self.organization_owned_id, self.organization_owner_id} - {None})
 
-        organization_owner = prepare_data_for_read_only_db(self.organization_owner) if self.organization_owner else None
-        person_owner = prepare_data_for_read_only_db(self.person_owner) if self.person_owner else None
 
-        rodb = ReadOnlyDB()
+class OrganizationStats(models.Model):
+    """
+    Counters of the organization's owners. They are updated on every share write, so the organization's flags
+    are a lookup by primary key instead of an aggregation of the shares.
+    """
+    organization = models.OneToOneField(
+        Organization,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="stats",
+    )
+    foreign_owners = models.IntegerField(default=0)
+    share_classes = models.IntegerField(default=0)
 
-        data = rodb.find_organization_element({"_id": self.organization_owned.pk})
+    REFRESH_SQL = """
+        INSERT INTO holders_organizationstats (organization_id, foreign_owners, share_classes)
+        SELECT s.organization_owned_id,
+            COUNT(DISTINCT COALESCE('o' || s.organization_owner_id, 'p' || s.person_owner_id)) FILTER (
+                WHERE COALESCE(o.country, p.country) <> 'Norway'
+            ),
+            COUNT(DISTINCT s.share_class)
+        FROM holders_share s
+        LEFT JOIN holders_organization o ON o.orgnr = s.organization_owner_id
+        LEFT JOIN holders_person p ON p.id = s.person_owner_id
+        {where}
+        GROUP BY s.organization_owned_id
+        ON CONFLICT (organization_id) DO UPDATE SET
+            foreign_owners = EXCLUDED.foreign_owners, share_classes = EXCLUDED.share_classes
+    """
 
-        if organization_owner:
-            organization_owner.update(share_data)
-            organization_owner.update({"percentage": self.percentage})
-        else:
-            person_owner.update(share_data)
-            person_owner.update({"percentage": self.percentage})
+    def __str__(self) -> str:
+        return str(self.organization_id)
+
+    def add_share(self, share: "Share"):
+        """
+        Count the new owner and share class of a share that is about to be inserted. Each check is an index lookup.
+        """
+        others = Share.objects.filter(organization_owned_id=self.organization_id)
+        owner = share.organization_owner or share.person_owner
 
-        if not data:
-            organization_data["organizations_owner"] = [organization_owner] if organization_owner else []
-            organization_data["persons_owner"] = [person_owner] if person_owner else []
-            rodb.add_new_organization_share(organization_data)
+        if share.organization_owner_id:
+            new_owner = not others.filter(organization_owner_id=share.organization_owner_id).exists()
         else:
-            organization_data["organizations_owner"] = data["organizations_owner"]
-            if organization_owner:
-                organization_data["organizations_owner"].extend([organization_owner])
+            new_owner = not others.filter(person_owner_id=share.person_owner_id).exists()
+        new_share_class = not others.filter(share_class=share.share_class).exists()
+
+        updates = {}
+        if new_owner and owner.country != "Norway":
+            updates["foreign_owners"] = F("foreign_owners") + 1
+        if new_share_class:
+            updates["share_classes"] = F("share_classes") + 1
+        if updates:
+            OrganizationStats.objects.filter(pk=self.pk).update(**updates)
+
+    @classmethod
+    def refresh(cls, orgnrs: Iterable[int] = None):
+        """
+        Compute again the stats of the given organizations (or all of them) from their shares. It is used after
+        writing shares in bulk, which doesn't call Share.save.
+        """
+        with connection.cursor() as cursor:
+            if orgnrs is None:
+                cursor.execute(cls.REFRESH_SQL.format(where=""))
+            else:
+                cursor.execute(
+                    cls.REFRESH_SQL.format(where="WHERE s.organization_owned_id = ANY(%s)"), [list(orgnrs)]
+                )
+
+
+class Position(models.Model):
+    """
+    Shares of an owner in an organization of the same class, consolidated: the sum of their amounts and the number
+    of shares (purchases). It is upserted with every share, so the owners and holdings of the ReadOnly DB have an
+    entry per position instead of per share.
+    """
+    organization_owner = models.ForeignKey(
+        Organization,
+        on_delete=models.CASCADE,
+        related_name="owned_positions",
+        null=True,
+    )
+    person_owner = models.ForeignKey(
+        Person,
+        on_delete=models.CASCADE,
+        related_name="owned_positions",
+        null=True,
+    )
+    organization_owned = models.ForeignKey(
+        Organization,
+        on_delete=models.CASCADE,
+        related_name="owner_positions"
+    )
+    share_class = models.CharField(choices=Share.SHARE_CLASS_CHOICES, max_length=8)
+    amount = models.BigIntegerField(default=0)
+    shares = models.IntegerField(default=0)
 
-            organization_data["persons_owner"] = data["persons_owner"]
-            if person_owner:
-                organization_data["persons_owner"].extend([person_owner])
+    # Adds the shares to the positions of their owner kind ({owner} column), the new positions are created in the
+    # order of their first share
+    ADD_SHARES_SQL = """
+        INSERT INTO holders_position (organization_owned_id, {owner}, share_class, amount, shares)
+        SELECT organization_owned_id, {owner}, share_class, SUM(amount), COUNT(*)
+        FROM holders_share
+        WHERE id = ANY(%s) AND {owner} IS NOT NULL
+        GROUP BY organization_owned_id, {owner}, share_class
+        ORDER BY MIN(id)
+        ON CONFLICT (organization_owned_id, {owner}, share_class) WHERE {owner} IS NOT NULL DO UPDATE SET
+            amount = holders_position.amount + EXCLUDED.amount, shares = holders_position.shares + EXCLUDED.shares
+    """
 
-            rodb.update_organization_element({"_id": self.organization_owned.pk}, organization_data)
+    # Adds a share that is about to be inserted to its position, and returns the position with it
+    ADD_SHARE_SQL = """
+        INSERT INTO holders_position (organization_owned_id, {owner}, share_class, amount, shares)
+        VALUES (%s, %s, %s, %s, 1)
+        ON CONFLICT (organization_owned_id, {owner}, share_class) WHERE {owner} IS NOT NULL DO UPDATE SET
+            amount = holders_position.amount + EXCLUDED.amount, shares = holders_position.shares + 1
+        RETURNING amount, shares
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["organization_owned", "organization_owner", "share_class"],
+                condition=Q(organization_owner__isnull=False),
+                name="unique_organization_position",
+            ),
+            models.UniqueConstraint(
+                fields=["organization_owned", "person_owner", "share_class"],
+                condition=Q(person_owner__isnull=False),
+                name="unique_person_position",
+            ),
+            models.CheckConstraint(
+                check=(
+                    Q(organization_owner__isnull=False, person_owner__isnull=True) |
+                    Q(organization_owner__isnull=True, person_owner__isnull=False)
+                ),
+                name="position_only_one_kind_of_owner",
+            ),
+        ]
+
+    def __str__(self) -> str:
+        return "{} {}".format(self.organization_owned_id, self.share_class)
+
+    @classmethod
+    def add_share(cls, share: "Share") -> Tuple[int, int]:
+        """
+        Add the share to its position, creating it if it doesn't exist yet, before the share is inserted. Returns
+        the amount and the number of shares of the position with the share.
+        """
+        owner = "organization_owner_id" if share.organization_owner_id else "person_owner_id"
+        with connection.cursor() as cursor:
+            cursor.execute(cls.ADD_SHARE_SQL.format(owner=owner), [
+                share.organization_owned_id, getattr(share, owner), share.share_class, share.amount,
+            ])
+            return cursor.fetchone()
+
+    @classmethod
+    def add_shares(cls, share_ids: Iterable[int]):
+        """
+        Add the new shares to their positions, creating the positions that don't exist yet, with one upsert per
+        owner kind
+        """
+        share_ids = list(share_ids)
+        with connection.cursor() as cursor:
+            for owner in ("organization_owner_id", "person_owner_id"):
+                cursor.execute(cls.ADD_SHARES_SQL.format(owner=owner), [share_ids])
+
+
+class RegistryImport(models.Model):
+    """
+    Checkpoint of a shareholder registry import. It is updated in the same transaction as every imported batch,
+    so an interrupted import continues from the last imported batch.
+    """
+    source = models.CharField(max_length=255, unique=True)
+    offset = models.BigIntegerField(default=0)
+    rows = models.BigIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return self.source
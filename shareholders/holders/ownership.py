@@ -0,0 +1,78 @@
+from typing import Any, Dict, List
+
+from django.conf import settings
+from django.db import connection
+
+# Owners of the organization through the chains of organizations that own it. Every step reads the owners of the
+# organizations of the previous one, grouped by owner, with the indexes by organization_owned, and multiplies the
+# fraction of the chain by the fraction that the owner has of the organization. The total of the organization is a
+# window over the same groups, so its shares are read once per step instead of once per owner. The chains end in
+# persons, in organizations without owners or at max_depth, below min_fraction or when an organization is already in
+# the chain (cross holdings).
+ULTIMATE_OWNERS_SQL = """
+    WITH RECURSIVE chain (organization_id, person_id, fraction, depth, path) AS (
+        SELECT %(orgnr)s::integer, NULL::bigint, 1.0::float8, 0, ARRAY[%(orgnr)s::integer]
+        UNION ALL
+        SELECT o.organization_owner_id, o.person_owner_id, c.fraction * o.amount / o.total, c.depth + 1,
+            c.path || o.organization_owner_id
+        FROM chain c
+        CROSS JOIN LATERAL (
+            SELECT s.organization_owner_id, s.person_owner_id, SUM(s.amount)::float8 AS amount,
+                NULLIF(SUM(SUM(s.amount)) OVER (), 0)::float8 AS total
+            FROM holders_share s
+            WHERE s.organization_owned_id = c.organization_id
+            GROUP BY s.organization_owner_id, s.person_owner_id
+        ) o
+        WHERE c.organization_id IS NOT NULL
+            AND c.depth < %(max_depth)s
+            AND c.fraction * o.amount / o.total >= %(min_fraction)s
+            AND (o.organization_owner_id IS NULL OR o.organization_owner_id <> ALL(c.path))
+    )
+    SELECT 'person', p.id, p.name, p.country, SUM(c.fraction), MIN(c.depth)
+    FROM chain c
+    JOIN holders_person p ON p.id = c.person_id
+    GROUP BY p.id
+    UNION ALL
+    SELECT 'organization', o.orgnr, o.name, o.country, SUM(c.fraction), MIN(c.depth)
+    FROM chain c
+    JOIN holders_organization o ON o.orgnr = c.organization_id
+    WHERE c.depth > 0 AND (
+        c.depth = %(max_depth)s
+        OR NOT EXISTS (SELECT 1 FROM holders_share s WHERE s.organization_owned_id = c.organization_id)
+    )
+    GROUP BY o.orgnr
+"""
+
+
+def ultimate_owners(orgnr: int, max_depth: int = None, min_percentage: float = None) -> List[Dict[str, Any]]:
+    """
+    Ultimate owners of the organization: the persons and the organizations without owners (or at max_depth) that own
+    it directly or through other organizations, with their effective percentage (the product of the percentages
+    along every chain, added up for all the chains) and the depth of their shortest chain. Sorted by percentage, the
+    largest first.
+
+    The chains are cut after max_depth organizations and when the effective percentage is lower than
+    min_percentage, so the small stakes are left out. The cross holdings are followed only once per chain.
+    """
+    if max_depth is None:
+        max_depth = settings.ULTIMATE_OWNERS["MAX_DEPTH"]
+    if min_percentage is None:
+        min_percentage = settings.ULTIMATE_OWNERS["MIN_PERCENTAGE"]
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            ULTIMATE_OWNERS_SQL,
+            {"orgnr": orgnr, "max_depth": max_depth, "min_fraction": min_percentage / 100},
+        )
+        owners = [
+            {
+                "owner_type": owner_type,
+                "id": _id,
+                "name": name,
+                "country": country,
+                "percentage": 100 * fraction,
+                "depth": depth,
+            }
+            for owner_type, _id, name, country, fraction, depth in cursor.fetchall()
+        ]
+    return sorted(owners, key=lambda owner: (-owner["percentage"], owner["owner_type"], owner["id"]))
@@ -0,0 +1,541 @@
+import heapq
+import zlib
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from django.conf import settings
+from django.db.models import Count, Exists, OuterRef, Q, QuerySet, Subquery, Sum
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from .cache import invalidate_organizations
+from .leaderboard import controllers, recompute_owner_stats, refresh_leaderboards
+from .models import Organization, Position, Share
+from .read_only import ReadOnlyDB
+from .utils import prepare_data_for_read_only_db
+
+# Direct exchange where the shares are published with the partition of the owned organization as routing key
+PROJECTION_EXCHANGE = "shares.projection"
+
+# The messages of the partition queues that can't be parsed are dead-lettered into this exchange, and kept in its queue
+DEAD_LETTER_EXCHANGE = "shares.projection.dead"
+DEAD_LETTER_QUEUE = "read_only_db.dead"
+
+# Arguments of the partition queues, they must be the same wherever the queues are declared
+PARTITION_QUEUE_ARGUMENTS = {
+    "x-single-active-consumer": True,
+    "x-dead-letter-exchange": DEAD_LETTER_EXCHANGE,
+}
+
+OWNER_LISTS = {
+    "organization": "organizations_owner",
+    "person": "persons_owner",
+}
+
+# Fields of an organization document that doesn't own nor is owned yet
+EMPTY_ORGANIZATION = {
+    "total_shares": 0,
+    "number_of_owners": 0,
+    "number_of_holdings": 0,
+    "has_foreign_owners": False,
+    "has_multiple_share_class": False,
+    "share_classes": [],
+    "share_class_totals": {},
+    "top_owners": [],
+    "owner_square_sum": 0.0,
+}
+
+
+class ConcurrentUpdateError(Exception):
+    pass
+
+
+def partition_of(orgnr: int) -> int:
+    """
+    Partition of the organization's shares. All the shares of an organization go to the same partition, which is
+    consumed by only one listener at a time, so they are saved in order.
+    """
+    return zlib.crc32(str(orgnr).encode()) % settings.READ_ONLY_PARTITIONS
+
+
+def partition_queue(partition: int) -> str:
+    return "read_only_db.{}".format(partition)
+
+
+def partition_queues() -> Dict[str, str]:
+    """
+    Queue of every partition, with its routing key
+    """
+    return {partition_queue(partition): str(partition) for partition in range(settings.READ_ONLY_PARTITIONS)}
+
+
+def owner_key(share: Union[Share, Position]) -> str:
+    """
+    Identify the owner of the share (or position) among organizations and persons, e.g. "organization:10" or
+    "person:3"
+    """
+    if share.organization_owner_id:
+        return "organization:{}".format(share.organization_owner_id)
+    return "person:{}".format(share.person_owner_id)
+
+
+def owner_entry(position: Position) -> Dict[str, Any]:
+    """
+    Owner of the position as it is saved in the organizations_owner or persons_owner list of an owner bucket
+    """
+    entry = prepare_data_for_read_only_db(position.organization_owner or position.person_owner)
+    entry.update({
+        "share_class": position.share_class,
+        "amount": position.amount,
+    })
+    return entry
+
+
+def holding_entry(position: Position) -> Dict[str, Any]:
+    """
+    Position as it is saved in the holdings of the owner
+    """
+    return {
+        "orgnr": position.organization_owned_id,
+        "name": position.organization_owned.name,
+        "share_class": position.share_class,
+        "amount": position.amount,
+    }
+
+
+def top_owner_entry(key: str, name: str, amount: int) -> Dict[str, Any]:
+    """
+    Owner as it is saved in the top_owners of the organization, with the amount of all its shares
+    """
+    return {"key": key, "name": name, "amount": amount}
+
+
+def with_positions(shares: QuerySet) -> QuerySet:
+    """
+    Annotate the shares with the positions of their owner in the organization up to the share (by id), as Share.save
+    keeps them: owner_amount and owner_shares of all the classes, and position_amount and position_shares of the
+    share's class. Only one of the owner columns of a share is set, and NULL never matches in the other one.
+    """
+    same_owner = Share.objects.filter(
+        Q(organization_owner=OuterRef("organization_owner")) | Q(person_owner=OuterRef("person_owner")),
+        organization_owned=OuterRef("organization_owned"),
+        id__lte=OuterRef("id"),
+    ).order_by().values("organization_owned")
+    same_position = same_owner.filter(share_class=OuterRef("share_class"))
+    return shares.annotate(
+        owner_amount=Subquery(same_owner.annotate(total=Sum("amount")).values("total")),
+        owner_shares=Subquery(same_owner.annotate(shares=Count("id")).values("shares")),
+        position_amount=Subquery(same_position.annotate(total=Sum("amount")).values("total")),
+        position_shares=Subquery(same_position.annotate(shares=Count("id")).values("shares")),
+    )
+
+
+def share_position(share: Share) -> Position:
+    """
+    Position of the share's owner and class up to the share. The amounts are read with with_positions if the share
+    doesn't have them.
+    """
+    if not hasattr(share, "position_amount"):
+        positions = with_positions(Share.objects.filter(pk=share.pk)).get()
+        share.owner_amount = positions.owner_amount
+        share.owner_shares = positions.owner_shares
+        share.position_amount = positions.position_amount
+        share.position_shares = positions.position_shares
+    return Position(
+        organization_owned=share.organization_owned,
+        organization_owner=share.organization_owner,
+        person_owner=share.person_owner,
+        share_class=share.share_class,
+        amount=share.position_amount,
+        shares=share.position_shares,
+    )
+
+
+def concentration_operations(share: Share) -> Tuple[float, List[UpdateOne]]:
+    """
+    Change of the sum of the squared amounts of the owners of the owned organization, and the updates of its
+    top_owners for the share. The amounts of the owners only grow, so an owner that leaves the top owners never
+    comes back with its old amount: the owner's entry is replaced if the share makes it larger, and the list is kept
+    sorted and cut to the CONCENTRATION["TOP_OWNERS"] largest.
+
+    Both are computed from the amounts up to the share, so they add up to the same result in any order.
+    """
+    share_position(share)
+    previous = share.owner_amount - share.amount
+    key = owner_key(share)
+    entry = top_owner_entry(key, (share.organization_owner or share.person_owner).name, share.owner_amount)
+    return float(share.owner_amount ** 2 - previous ** 2), [
+        UpdateOne(
+            {
+                "_id": share.organization_owned_id,
+                "top_owners": {"$elemMatch": {"key": key, "amount": {"$lt": share.owner_amount}}},
+            },
+            {"$pull": {"top_owners": {"key": key}}},
+        ),
+        UpdateOne(
+            {"_id": share.organization_owned_id, "top_owners.key": {"$ne": key}},
+            {"$push": {"top_owners": {
+                "$each": [entry],
+                "$sort": {"amount": -1, "key": 1},
+                "$slice": settings.CONCENTRATION["TOP_OWNERS"],
+            }}},
+        ),
+    ]
+
+
+def top_owners(amounts: Dict[str, int], names: Dict[str, str]) -> List[Dict[str, Any]]:
+    """
+    top_owners of an organization from the amounts of all its owners, in the order of concentration_operations
+    """
+    largest = heapq.nsmallest(
+        settings.CONCENTRATION["TOP_OWNERS"], amounts.items(), key=lambda item: (-item[1], item[0])
+    )
+    return [top_owner_entry(key, names[key], amount) for key, amount in largest]
+
+
+def organization_header(organization: Organization) -> Dict[str, Any]:
+    header = prepare_data_for_read_only_db(organization)
+    del header["_id"]
+    return header
+
+
+def share_operations(share: Share) -> List[UpdateOne]:
+    """
+    Atomic updates that add the share to the read-only documents of the owned organization and of the owner
+    organization, the owner's position is saved in a bucket by bucket_operations. They don't read the documents and
+    only need the positions of the share's owner (see share_position), so the cost doesn't depend on the size of the
+    organization. The operations must be applied in order.
+
+    The first share of the owner in the organization (owner_shares) adds a new owner to the owned organization and
+    a new holding to the owner organization, so their counters don't need the keys of the owners or holdings. The
+    share_classes set is kept to know if the share adds a new share class, and share_class_totals has the total of
+    shares of every class.
+    """
+    owner = share.organization_owner or share.person_owner
+    foreign = owner.country != "Norway"
+
+    square_sum, top_owners_operations = concentration_operations(share)
+    new_owner = int(share.owner_shares == 1)
+    update = {
+        "$inc": {
+            "total_shares": share.amount,
+            "number_of_owners": new_owner,
+            "share_class_totals.{}".format(share.share_class): share.amount,
+            "owner_square_sum": square_sum,
+            "version": 1,
+        },
+        "$addToSet": {"share_classes": share.share_class},
+        "$currentDate": {"updated_at": True},
+    }
+    if foreign:
+        update["$set"] = {"has_foreign_owners": True}
+    updated = {"total_shares", "number_of_owners", "share_class_totals", "owner_square_sum", "share_classes"} | set(
+        update.get("$set", {})
+    )
+    update["$setOnInsert"] = dict(organization_header(share.organization_owned), **{
+        field: value for field, value in EMPTY_ORGANIZATION.items() if field not in updated
+    })
+
+    operations = [
+        UpdateOne({"_id": share.organization_owned_id}, update, upsert=True),
+        UpdateOne(
+            {
+                "_id": share.organization_owned_id,
+                "share_classes.1": {"$exists": True},
+                "has_multiple_share_class": False,
+            },
+            {"$set": {"has_multiple_share_class": True}},
+        ),
+        *top_owners_operations,
+    ]
+
+    if share.organization_owner_id and new_owner:
+        operations.append(UpdateOne(
+            {"_id": share.organization_owner_id},
+            {
+                "$inc": {"number_of_holdings": 1, "version": 1},
+                "$currentDate": {"updated_at": True},
+                "$setOnInsert": dict(organization_header(share.organization_owner), **{
+                    field: value for field, value in EMPTY_ORGANIZATION.items() if field != "number_of_holdings"
+                }),
+            },
+            upsert=True,
+        ))
+
+    return operations
+
+
+def bucket_operations(shares: List[Share]) -> List[UpdateOne]:
+    """
+    Atomic updates of the positions of the shares in the owner buckets of their owned organizations. The positions
+    that aren't in a bucket yet (read with one query) are added to the tail bucket, the only one that isn't full, or
+    to a new bucket if all of them are full, the others get the largest amount of their shares. The amounts of the
+    positions only grow, so the shares can be applied in any order.
+    """
+    positions = {}
+    for share in shares:
+        position = share_position(share)
+        owner = position.organization_owner or position.person_owner
+        key = (share.organization_owned_id, OWNER_LISTS[owner_key(share).split(":")[0]], owner.pk, share.share_class)
+        if key not in positions or positions[key].amount < position.amount:
+            positions[key] = position
+    listed = ReadOnlyDB().find_bucket_positions(positions)
+
+    operations = []
+    for key, position in positions.items():
+        orgnr, owner_list, owner_id, share_class = key
+        if key in listed:
+            operations.append(UpdateOne(
+                {"organization": orgnr, owner_list: {"$elemMatch": {"_id": owner_id, "share_class": share_class}}},
+                {"$max": {"{}.$.amount".format(owner_list): position.amount}},
+            ))
+            continue
+        other_list, = set(OWNER_LISTS.values()) - {owner_list}
+        operations.append(UpdateOne(
+            {"organization": orgnr, "count": {"$lt": settings.READ_ONLY_OWNER_BUCKET_SIZE}},
+            {"$push": {owner_list: owner_entry(position)}, "$inc": {"count": 1}, "$setOnInsert": {other_list: []}},
+            upsert=True,
+        ))
+    return operations
+
+
+def holding_operations(share: Share) -> List[UpdateOne]:
+    """
+    Atomic updates that add the share's position to the holdings document of the owner if it isn't there yet, and
+    keep the largest amount of the position, so the shares of a position can be applied in any order
+    """
+    position = share_position(share)
+    key = owner_key(share)
+    same_position = {"orgnr": share.organization_owned_id, "share_class": share.share_class}
+    return [
+        UpdateOne({"_id": key}, {"$setOnInsert": {"holdings": []}}, upsert=True),
+        UpdateOne(
+            {"_id": key, "holdings": {"$not": {"$elemMatch": same_position}}},
+            {"$push": {"holdings": holding_entry(position)}},
+        ),
+        UpdateOne(
+            {"_id": key, "holdings": {"$elemMatch": same_position}},
+            {"$max": {"holdings.$.amount": position.amount}, "$inc": {"version": 1}},
+        ),
+    ]
+
+
+def owner_stats_operations(shares: List[Share],
+                           changed: Dict[int, Tuple[Optional[str], Optional[str]]]) -> List[UpdateOne]:
+    """
+    Atomic updates of the stats of the owners of the shares, and of the controlled companies of the owners that lost
+    or got the control (old and new controller) of the changed organizations. The first share of an owner in an
+    organization (counted from its positions, as amounts can be 0) is a new holding.
+    """
+    operations = []
+    for share in shares:
+        share_position(share)
+        operations.append(UpdateOne(
+            {"_id": owner_key(share)},
+            {
+                "$inc": {"number_of_holdings": int(share.owner_shares == 1), "total_shares": share.amount},
+                "$set": {"name": (share.organization_owner or share.person_owner).name},
+                "$setOnInsert": {"controlled_companies": 0},
+            },
+            upsert=True,
+        ))
+    for old, new in changed.values():
+        if old:
+            operations.append(UpdateOne({"_id": old}, {"$inc": {"controlled_companies": -1}}))
+        if new:
+            operations.append(UpdateOne({"_id": new}, {"$inc": {"controlled_companies": 1}}))
+    return operations
+
+
+def project_owner_stats(shares: List[Share], before: Dict[int, Optional[str]], recompute: bool = False):
+    """
+    Update the stats of the owners of the shares, and of the owners that got or lost the control of an organization
+    (before has the controllers of the owned organizations before the shares were projected), and the leaderboards.
+    With recompute the stats are computed again instead.
+    """
+    after = controllers(before)
+    changed = {orgnr: (before[orgnr], after[orgnr]) for orgnr in before if before[orgnr] != after[orgnr]}
+    owner_keys = {owner_key(share) for share in shares} | {key for pair in changed.values() for key in pair if key}
+    if recompute:
+        recompute_owner_stats(owner_keys)
+    else:
+        ReadOnlyDB().update_owner_stats(owner_stats_operations(shares, changed))
+        refresh_leaderboards(owner_keys)
+
+
+def project_shares(share_ids: Iterable[int], recompute: bool = False) -> int:
+    """
+    Save a batch of shares into the ReadOnly DB: the shares are loaded with one query and their updates, grouped
+    by organization, are applied with one bulk write.
+
+    With recompute (or the "full" projection) the documents of the affected organizations are computed again
+    instead, which is idempotent, e.g. for shares that could have been already applied.
+    """
+    shares = list(
+        with_positions(Share.objects.filter(pk__in=list(share_ids))).select_related(
+            "organization_owned", "organization_owner", "person_owner"
+        ).order_by("organization_owned", "pk")
+    )
+
+    owned = {share.organization_owned_id for share in shares}
+    orgnrs = owned | {share.organization_owner_id for share in shares if share.organization_owner_id}
+    recompute = recompute or settings.READ_ONLY_PROJECTION == "full"
+    before = controllers(owned)
+    if recompute:
+        recompute_organizations(orgnrs, owned=owned)
+        recompute_holdings({owner_key(share) for share in shares})
+    else:
+        rodb = ReadOnlyDB()
+        rodb.update_organizations([operation for share in shares for operation in share_operations(share)])
+        rodb.update_owner_buckets(bucket_operations(shares))
+        rodb.update_holdings([operation for share in shares for operation in holding_operations(share)])
+    project_owner_stats(shares, before, recompute)
+    invalidate_organizations(orgnrs)
+    return len(shares)
+
+
+def recompute(collection: str, ids: Iterable[Any], build, attempts: int = 5):
+    """
+    Compute again (with build) and replace the documents with optimistic concurrency: a document is replaced only
+    if its version didn't change since before it was computed, otherwise it is computed again.
+    """
+    rodb = ReadOnlyDB()
+    pending = set(ids)
+    for _ in range(attempts):
+        versions = rodb.organization_versions(pending, collection)
+        pending = rodb.replace_organizations(build(pending), versions, collection)
+        if not pending:
+            return
+    raise ConcurrentUpdateError("Documents {} were updated while they were computed".format(sorted(pending)))
+
+
+def recompute_organizations(orgnrs: Iterable[int], owned: Iterable[int] = None, attempts: int = 5):
+    """
+    Recompute the organizations and replace the owner buckets of the owned ones (all of them by default). The
+    buckets of an organization are only written by the listener of its partition, so they don't need a version.
+    """
+    orgnrs = set(orgnrs)
+    owned = orgnrs if owned is None else set(owned)
+    buckets = {}
+
+    def build(pending):
+        for document, organization_buckets in build_organization_documents(orgnrs=pending):
+            buckets[document["_id"]] = organization_buckets
+            yield document
+
+    recompute(ReadOnlyDB.organization_collection, orgnrs, build, attempts)
+    ReadOnlyDB().replace_owner_buckets(owned, [bucket for orgnr in owned for bucket in buckets.get(orgnr, [])])
+
+
+def recompute_holdings(owner_keys: Iterable[str], attempts: int = 5):
+    recompute(
+        ReadOnlyDB.holdings_collection, owner_keys, lambda pending: build_holding_documents(owner_keys=pending),
+        attempts,
+    )
+
+
+def build_organization_documents(first_orgnr: int = None, last_orgnr: int = None,
+                                 orgnrs: Iterable[int] = None) -> Iterator[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    """
+    Build the read-only documents of the organizations with orgnr between first_orgnr and last_orgnr (or in orgnrs)
+    that own or are owned, with their owner buckets, with two queries (organizations with their stats and owner
+    positions) instead of the queries per share of the incremental projection.
+    """
+    if orgnrs is not None:
+        lookups = {"in": list(orgnrs)}
+    else:
+        lookups = {"gte": first_orgnr, "lte": last_orgnr}
+
+    def orgnr_filter(field):
+        return {"{}__{}".format(field, lookup): value for lookup, value in lookups.items()}
+
+    organizations = Organization.objects.filter(
+        Q(Exists(Share.objects.filter(organization_owned=OuterRef("pk")))) |
+        Q(Exists(Share.objects.filter(organization_owner=OuterRef("pk")))),
+        **orgnr_filter("orgnr")
+    ).with_stats().order_by("orgnr")
+
+    owners = defaultdict(lambda: {"share_classes": [], "share_class_totals": {}})
+    amounts = defaultdict(lambda: defaultdict(int))
+    names = {}
+    buckets = defaultdict(list)
+    positions = Position.objects.filter(**orgnr_filter("organization_owned")).select_related(
+        "organization_owner", "person_owner"
+    ).order_by("id")
+    for position in positions.iterator():
+        document = owners[position.organization_owned_id]
+        organization_buckets = buckets[position.organization_owned_id]
+        if not organization_buckets or organization_buckets[-1]["count"] == settings.READ_ONLY_OWNER_BUCKET_SIZE:
+            organization_buckets.append(empty_bucket(position.organization_owned_id))
+        key = owner_key(position)
+        amounts[position.organization_owned_id][key] += position.amount
+        names[key] = (position.organization_owner or position.person_owner).name
+        organization_buckets[-1][OWNER_LISTS[key.split(":")[0]]].append(owner_entry(position))
+        organization_buckets[-1]["count"] += 1
+        if position.share_class not in document["share_classes"]:
+            document["share_classes"].append(position.share_class)
+        totals = document["share_class_totals"]
+        totals[position.share_class] = totals.get(position.share_class, 0) + position.amount
+
+    updated_at = datetime.utcnow()
+    for organization in organizations:
+        document = dict(EMPTY_ORGANIZATION, updated_at=updated_at, **organization.read_only_data())
+        document.update(owners.pop(organization.pk, {}))
+        owner_amounts = amounts.pop(organization.pk, {})
+        document["top_owners"] = top_owners(owner_amounts, names)
+        document["owner_square_sum"] = float(sum(amount ** 2 for amount in owner_amounts.values()))
+        yield document, buckets.pop(organization.pk, [])
+
+
+def empty_bucket(orgnr: int) -> Dict[str, Any]:
+    return dict({"_id": ObjectId(), "organization": orgnr, "count": 0}, **{name: [] for name in OWNER_LISTS.values()})
+
+
+def build_holding_documents(owner_keys: Iterable[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Build the holdings documents of the owners (e.g. "organization:10" or "person:3"), or of every owner, with one
+    query of their positions ordered by owner.
+    """
+    positions = Position.objects.select_related("organization_owned").order_by(
+        "organization_owner", "person_owner", "id"
+    )
+    if owner_keys is not None:
+        ids = defaultdict(list)
+        for key in owner_keys:
+            kind, _id = key.split(":")
+            ids[kind].append(int(_id))
+        positions = positions.filter(
+            Q(organization_owner__in=ids["organization"]) | Q(person_owner__in=ids["person"])
+        )
+
+    document = None
+    for position in positions.iterator():
+        key = owner_key(position)
+        if document is None or document["_id"] != key:
+            if document is not None:
+                yield document
+            document = {"_id": key, "holdings": []}
+        document["holdings"].append(holding_entry(position))
+    if document is not None:
+        yield document
+
+
+def organization_ranges(chunk_size: int) -> List[tuple]:
+    """
+    Split the organizations that own or are owned into (first_orgnr, last_orgnr) ranges of chunk_size organizations
+    """
+    orgnrs = Organization.objects.filter(
+        Q(Exists(Share.objects.filter(organization_owned=OuterRef("pk")))) |
+        Q(Exists(Share.objects.filter(organization_owner=OuterRef("pk"))))
+    ).values_list("orgnr", flat=True).order_by("orgnr")
+    ranges = []
+    chunk = []
+    for orgnr in orgnrs.iterator():
+        chunk.append(orgnr)
+        if len(chunk) == chunk_size:
+            ranges.append((chunk[0], chunk[-1]))
+            chunk = []
+    if chunk:
+        ranges.append((chunk[0], chunk[-1]))
+    return ranges
@@ -1,28 +1,254 @@
+import asyncio
 import os
-from typing import Any, Dict
+import threading
+import time
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-from pymongo import MongoClient
+from bson import ObjectId
+from django.conf import settings
+from pymongo import ASCENDING, DESCENDING, IndexModel, InsertOne, MongoClient, ReplaceOne, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+
+
+class PoolStatistics(monitoring.ConnectionPoolListener):
+    """
+    Connection pool listener that keeps counters about the MongoClient pool. The most interesting value is the time
+    that the threads wait to check out a connection, if it grows the pool is too small for the load.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connections_created = 0
+            self.connections_closed = 0
+            self.checked_out = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.waiting = 0
+            self.total_wait_ms = 0.0
+            self.max_wait_ms = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "connections_open": self.connections_created - self.connections_closed,
+                "connections_created": self.connections_created,
+                "connections_closed": self.connections_closed,
+                "checked_out": self.checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "waiting": self.waiting,
+                "avg_wait_ms": self.total_wait_ms / self.checkouts if self.checkouts else 0.0,
+                "max_wait_ms": self.max_wait_ms,
+            }
+
+    def _stop_waiting(self) -> float:
+        waited = (time.monotonic() - getattr(self._local, "started", time.monotonic())) * 1000
+        self.waiting -= 1
+        return waited
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_closed += 1
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self._stop_waiting()
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            waited = self._stop_waiting()
+            self.checkouts += 1
+            self.checked_out += 1
+            self.total_wait_ms += waited
+            self.max_wait_ms = max(self.max_wait_ms, waited)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+
+class ClientRegistry:
+    """
+    Process-wide registry of MongoClients. MongoClient is thread-safe and keeps its own connection pool, so we create
+    only one client per connection settings and per process. The clients are not shared with forked processes
+    (e.g. preforking WSGI servers), the child process creates its own clients the first time it needs them.
+
+    The listeners are added to the clients created after they were appended, e.g. to record the commands in tests.
+    """
+    def __init__(self):
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._statistics = {}
+        self._pid = os.getpid()
+
+    def reset(self):
+        """
+        Forget every client without closing them. It is called in the forked child, where the parent's sockets
+        must not be used nor closed.
+        """
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._statistics = {}
+        self._pid = os.getpid()
+
+    def get_client(self, alias: str = "default") -> MongoClient:
+        if self._pid != os.getpid():
+            self.reset()
+
+        client = self._clients.get(alias)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(alias)
+                if client is None:
+                    statistics = PoolStatistics()
+                    client = self._create_client(statistics)
+                    self._statistics[alias] = statistics
+                    self._clients[alias] = client
+        return client
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+            self._statistics = {}
+
+    def statistics(self) -> Dict[str, Dict[str, Any]]:
+        return {alias: statistics.as_dict() for alias, statistics in self._statistics.items()}
+
+    def _create_client(self, statistics: PoolStatistics) -> MongoClient:
+        return MongoClient(
+            database_uri(), connect=False, event_listeners=[statistics] + self.listeners, **client_options()
+        )
+
+
+def database_uri() -> str:
+    config = settings.READ_ONLY_DATABASE
+    return "mongodb://{user}:{password}@{host}:{port}".format(
+        user=config["USER"],
+        password=config["PASSWORD"],
+        host=config["HOST"],
+        port=config["PORT"],
+    )
+
+
+def client_options() -> Dict[str, Any]:
+    options = dict(settings.READ_ONLY_DATABASE.get("OPTIONS", {}))
+    if isinstance(options.get("w"), str) and options["w"].isdigit():
+        options["w"] = int(options["w"])
+    return options
+
+
+clients = ClientRegistry()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=clients.reset)
+
+# Fields of the organization documents written by compute_group_analytics, with their value for the organizations
+# without shares. They aren't computed by the projection, so they are kept when a document is replaced
+GROUP_FIELDS = {
+    "group_id": None,
+    "parent_company": None,
+    "in_cross_holding": False,
+    "component_id": None,
+}
 
 
 class ReadOnlyDB:
     """
     Read-only database abstraction. This class was created to abstract the mongodb implementation. So, if you
     in the future want to change to other NO-SQL database you have to only change this class.
+
+    Instances are cheap, they use the process-wide pooled client from the registry.
     """
     client = None
     database = None
     organization_collection = "organization"
+    holdings_collection = "holdings"
+    owners_collection = "owners"
+    ultimate_owners_collection = "ultimate_owners"
+    owner_stats_collection = "owner_stats"
+    leaderboard_collection = "leaderboard"
+
+    # Indexes of every collection besides _id, they are created by ensure_read_indexes
+    indexes = {
+        organization_collection: [
+            IndexModel([("country", ASCENDING)], name="country", background=True),
+            IndexModel([("share_classes", ASCENDING)], name="share_classes", background=True),
+        ],
+        owners_collection: [
+            IndexModel([("organization", ASCENDING), ("_id", ASCENDING)], name="organization_id", background=True),
+            IndexModel([("organization", ASCENDING), ("count", ASCENDING)], name="organization_count", background=True),
+            IndexModel([("organizations_owner._id", ASCENDING)], name="organizations_owner_id", background=True),
+            IndexModel([("persons_owner._id", ASCENDING)], name="persons_owner_id", background=True),
+        ],
+        holdings_collection: [
+            IndexModel([("holdings.orgnr", ASCENDING)], name="holdings_orgnr", background=True),
+        ],
+        ultimate_owners_collection: [
+            IndexModel([("requests", DESCENDING)], name="requests", background=True),
+        ],
+        owner_stats_collection: [
+            IndexModel([("rebuilt_at", ASCENDING)], name="rebuilt_at", background=True),
+        ],
+    }
 
     def __init__(self):
-        self.client = MongoClient(
-            "mongodb://{user}:{password}@{host}:{port}".format(
-                user=os.getenv("MONGO_USER"),
-                password=os.getenv("MONGO_PASSWORD"),
-                host=os.getenv("MONGO_HOST"),
-                port=os.getenv("MONGO_PORT"),
-            )
-        )
-        self.database = self.client[os.getenv("MONGO_DB")]
+        self.client = clients.get_client()
+        self.database = self.client[settings.READ_ONLY_DATABASE["NAME"]]
+
+    @staticmethod
+    def pool_stats() -> Dict[str, Dict[str, Any]]:
+        return clients.statistics()
+
+    def ensure_indexes(self, prune: bool = False) -> Dict[str, List[str]]:
+        """
+        Create the missing indexes of the registry, in background so the collections aren't blocked. With
+        prune the indexes that aren't in the registry are dropped.
+        """
+        created = {}
+        for name, indexes in self.indexes.items():
+            collection = self.database[name]
+            existing = set(collection.index_information())
+            missing = [index for index in indexes if index.document["name"] not in existing]
+            if missing:
+                collection.create_indexes(missing)
+            created[name] = [index.document["name"] for index in missing]
+
+            if prune:
+                declared = {index.document["name"] for index in indexes} | {"_id_"}
+                for index in existing - declared:
+                    collection.drop_index(index)
+        return created
 
     def add_new_organization_share(self, data: Dict[str, Any]):
         collection = self.database[self.organization_collection]
@@ -36,6 +262,470 @@ class ReadOnlyDB:
         collection = self.database[self.organization_collection]
         return collection.find(spec)
 
+    def find_organization_owners(self, _id: int, after: Tuple[ObjectId, str, int] = None, limit: int = None,
+                                 total_shares: int = None) -> Optional[Iterator[Dict[str, Any]]]:
+        """
+        Owners of the organization, in the order they were added, or None if the organization doesn't exist. Every
+        owner has its owner_type ("organization" or "person"), and the bucket and position where it is saved, that
+        are the cursor to read the owners after it. The buckets are read one by one while the iterator is consumed.
+
+        Only the amounts are stored, so a new share never makes the percentages stale, they are computed by the
+        server with the current total of shares (that is read from the organization if it isn't given) while it
+        reads the buckets.
+        """
+        if total_shares is None:
+            organization = self.find_organization_element_fields(_id, ["total_shares"])
+            if organization is None:
+                return None
+            total_shares = organization["total_shares"]
+
+        pipeline = self.owners_pipeline(_id, total_shares, after, limit)
+        return self.database[self.owners_collection].aggregate(pipeline, batchSize=settings.READ_ONLY_PAGE_SIZE)
+
+    def find_organization_element_fields(self, _id: int, fields: List[str]) -> Optional[Dict[str, Any]]:
+        """
+        Only the given fields of the organization document
+        """
+        return self.database[self.organization_collection].find_one({"_id": _id}, {field: True for field in fields})
+
+    def find_organizations_fields(self, ids: Iterable[int], fields: List[str]) -> Dict[int, Dict[str, Any]]:
+        """
+        Only the given fields of the organization documents, by _id, read with one query. The organizations that
+        don't exist are not in the result.
+        """
+        documents = self.database[self.organization_collection].find(
+            {"_id": {"$in": list(ids)}}, {field: True for field in fields}
+        )
+        return {document.pop("_id"): document for document in documents}
+
+    def update_owner_buckets(self, operations: List[UpdateOne]):
+        """
+        Apply the update operations of the owner buckets in order with one bulk write.
+        """
+        if operations:
+            self.database[self.owners_collection].bulk_write(operations, ordered=True)
+
+    def find_bucket_positions(self, positions: Iterable[Tuple[int, str, Any, str]]) -> Set[Tuple[int, str, Any, str]]:
+        """
+        The positions, as (organization, owner list, owner _id, share class), that are already in an owner bucket,
+        read with one query
+        """
+        positions = set(positions)
+        if not positions:
+            return set()
+        owner_lists = {owner_list for _, owner_list, _, _ in positions}
+        buckets = self.database[self.owners_collection].find(
+            {"$or": [
+                {"organization": orgnr, owner_list: {"$elemMatch": {"_id": _id, "share_class": share_class}}}
+                for orgnr, owner_list, _id, share_class in positions
+            ]},
+            dict({"organization": True}, **{
+                "{}.{}".format(owner_list, field): True
+                for owner_list in owner_lists for field in ("_id", "share_class")
+            }),
+        )
+        found = {
+            (bucket["organization"], owner_list, owner["_id"], owner["share_class"])
+            for bucket in buckets for owner_list in owner_lists for owner in bucket.get(owner_list, [])
+        }
+        return found & positions
+
+    def replace_owner_buckets(self, orgnrs: Iterable[int], buckets: List[Dict[str, Any]], collection: str = None):
+        """
+        Replace the owner buckets of the organizations. The new buckets are inserted before the old ones are deleted,
+        so the owners never disappear while they are replaced.
+        """
+        collection = self.database[collection or self.owners_collection]
+        ids = [bucket["_id"] for bucket in buckets]
+        if buckets:
+            collection.insert_many(buckets, ordered=True)
+        collection.delete_many({"organization": {"$in": list(orgnrs)}, "_id": {"$nin": ids}})
+
     def update_organization_element(self, spec: Dict[str, Any], data: Dict[str, Any]) -> Dict[str, Any]:
         collection = self.database[self.organization_collection]
         return collection.update(spec, data)
+
+    def update_organizations(self, operations: List[UpdateOne]):
+        """
+        Apply the update operations in order with one bulk write.
+        """
+        if operations:
+            self.database[self.organization_collection].bulk_write(operations, ordered=True)
+
+    def find_holdings(self, owner_key: str, after: int = None, limit: int = None) -> Iterator[Dict[str, Any]]:
+        """
+        Holdings of the owner (e.g. "organization:10") with their position, that is the cursor to read the holdings
+        after it, and their percentage of the current total of shares of the owned organization. The totals are
+        looked up by _id, so the cost depends only on the size of the owner's portfolio.
+        """
+        pipeline = self.holdings_pipeline(owner_key, after, limit)
+        return self.database[self.holdings_collection].aggregate(pipeline, batchSize=settings.READ_ONLY_PAGE_SIZE)
+
+    def holdings_exist(self, owner_key: str) -> bool:
+        return self.database[self.holdings_collection].count_documents({"_id": owner_key}, limit=1) > 0
+
+    @staticmethod
+    def owners_pipeline(_id: int, total_shares: int, after: Tuple[ObjectId, str, int] = None,
+                        limit: int = None) -> List[Dict[str, Any]]:
+        """
+        Owners of the organization's buckets, in the order of the buckets, the organizations of a bucket first. The
+        position of an owner is its index in the list of its owner_type, that doesn't change when owners of the other
+        type are pushed into the bucket, so (bucket, owner_type, position) is a stable cursor.
+        """
+        def with_percentage(owners, owner_type):
+            if total_shares:
+                percentage = {"$divide": [{"$multiply": [100, "$$owner.amount"]}, total_shares]}
+            else:
+                percentage = {"$literal": 0}
+            return {
+                "$map": {
+                    "input": {"$range": [0, {"$size": owners}]},
+                    "as": "position",
+                    "in": {
+                        "$let": {
+                            "vars": {"owner": {"$arrayElemAt": [owners, "$$position"]}},
+                            "in": {
+                                "$mergeObjects": ["$$owner", {
+                                    "percentage": percentage,
+                                    "owner_type": {"$literal": owner_type},
+                                    "position": "$$position",
+                                }]
+                            },
+                        }
+                    },
+                }
+            }
+
+        match = {"organization": _id}
+        if after:
+            match["_id"] = {"$gte": after[0]}
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"_id": ASCENDING}},
+            {
+                "$project": {
+                    "owners": {
+                        "$concatArrays": [
+                            with_percentage("$organizations_owner", "organization"),
+                            with_percentage("$persons_owner", "person"),
+                        ]
+                    },
+                }
+            },
+            {"$unwind": "$owners"},
+        ]
+        if after:
+            bucket, owner_type, position = after
+            pipeline.append({"$match": {"$or": [
+                {"_id": {"$gt": bucket}},
+                {"owners.owner_type": {"$gt": owner_type}},
+                {"owners.owner_type": owner_type, "owners.position": {"$gt": position}},
+            ]}})
+        if limit:
+            pipeline.append({"$limit": limit})
+        pipeline.append({"$replaceRoot": {"newRoot": {"$mergeObjects": ["$owners", {"bucket": "$_id"}]}}})
+        return pipeline
+
+    @classmethod
+    def holdings_pipeline(cls, owner_key: str, after: int = None, limit: int = None) -> List[Dict[str, Any]]:
+        total = {"$arrayElemAt": ["$total.total_shares", 0]}
+        percentage = {
+            "$let": {
+                "vars": {"total": total},
+                "in": {
+                    "$cond": [
+                        {"$gt": ["$$total", 0]},
+                        {"$divide": [{"$multiply": [100, "$holdings.amount"]}, "$$total"]},
+                        0,
+                    ]
+                },
+            }
+        }
+        pipeline = [
+            {"$match": {"_id": owner_key}},
+            {"$unwind": {"path": "$holdings", "includeArrayIndex": "position"}},
+        ]
+        if after is not None:
+            pipeline.append({"$match": {"position": {"$gt": after}}})
+        if limit:
+            pipeline.append({"$limit": limit})
+        pipeline.extend([
+            {
+                "$lookup": {
+                    "from": cls.organization_collection,
+                    "localField": "holdings.orgnr",
+                    "foreignField": "_id",
+                    "pipeline": [{"$project": {"total_shares": True}}],
+                    "as": "total",
+                }
+            },
+            {
+                "$replaceRoot": {
+                    "newRoot": {"$mergeObjects": ["$holdings", {"position": "$position", "percentage": percentage}]}
+                }
+            },
+        ])
+        return pipeline
+
+    def update_holdings(self, operations: List[UpdateOne]):
+        """
+        Apply the update operations of the holdings in order with one bulk write.
+        """
+        if operations:
+            self.database[self.holdings_collection].bulk_write(operations, ordered=True)
+
+    def find_ultimate_owners(self, _id: int, max_depth: int, min_percentage: float) -> Optional[Dict[str, Any]]:
+        """
+        Precomputed ultimate owners of the organization with the given cut-offs, or None
+        """
+        return self.database[self.ultimate_owners_collection].find_one(
+            {"_id": _id, "max_depth": max_depth, "min_percentage": min_percentage, "owners": {"$exists": True}}
+        )
+
+    def record_ultimate_owners_request(self, _id: int):
+        """
+        Count a request of the ultimate owners of the organization, without waiting for the write
+        """
+        collection = self.database[self.ultimate_owners_collection].with_options(write_concern=WriteConcern(w=0))
+        collection.update_one({"_id": _id}, {"$inc": {"requests": 1}}, upsert=True)
+
+    def most_requested_ultimate_owners(self, limit: int) -> List[int]:
+        documents = self.database[self.ultimate_owners_collection].find(
+            {"requests": {"$gt": 0}}, {"_id": True}, sort=[("requests", DESCENDING)], limit=limit
+        )
+        return [document["_id"] for document in documents]
+
+    def save_ultimate_owners(self, _id: int, owners: List[Dict[str, Any]], max_depth: int, min_percentage: float):
+        self.database[self.ultimate_owners_collection].update_one(
+            {"_id": _id},
+            {
+                "$set": {"owners": owners, "max_depth": max_depth, "min_percentage": min_percentage},
+                "$currentDate": {"computed_at": True},
+            },
+            upsert=True,
+        )
+
+    def expire_ultimate_owners(self, keep: Iterable[int], decay: float):
+        """
+        Remove the precomputed ultimate owners of the organizations that aren't in keep, and multiply every request
+        counter by decay, so the most requested organizations are the ones of the recent requests.
+        """
+        collection = self.database[self.ultimate_owners_collection]
+        collection.update_many(
+            {"_id": {"$nin": list(keep)}, "owners": {"$exists": True}},
+            {"$unset": {"owners": True, "max_depth": True, "min_percentage": True, "computed_at": True}},
+        )
+        collection.update_many({"requests": {"$gt": 0}}, {"$mul": {"requests": decay}})
+
+    def update_owner_stats(self, operations: List[UpdateOne]):
+        """
+        Apply the update operations of the owner stats in order with one bulk write.
+        """
+        if operations:
+            self.database[self.owner_stats_collection].bulk_write(operations, ordered=True)
+
+    def find_owner_stats(self, owner_keys: Iterable[str]) -> List[Dict[str, Any]]:
+        return list(self.database[self.owner_stats_collection].find({"_id": {"$in": list(owner_keys)}}))
+
+    def replace_owner_stats(self, documents: Iterable[Dict[str, Any]]):
+        """
+        Replace (or insert) the stats of the owners with one unordered bulk write
+        """
+        requests = [ReplaceOne({"_id": document["_id"]}, document, upsert=True) for document in documents]
+        if requests:
+            self.database[self.owner_stats_collection].bulk_write(requests, ordered=False)
+
+    def expire_owner_stats(self, rebuilt_at: datetime):
+        """
+        Remove the stats of a previous rebuild that weren't rebuilt, the owners that don't own shares anymore
+        """
+        self.database[self.owner_stats_collection].delete_many({"rebuilt_at": {"$lt": rebuilt_at}})
+
+    def find_leaderboards(self) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Entries of every leaderboard, by metric
+        """
+        return {document["_id"]: document["entries"] for document in self.database[self.leaderboard_collection].find()}
+
+    def find_leaderboard(self, metric: str, limit: int) -> Optional[Dict[str, Any]]:
+        """
+        Leaderboard of the metric with only its first limit entries
+        """
+        return self.database[self.leaderboard_collection].find_one({"_id": metric}, {"entries": {"$slice": limit}})
+
+    def update_leaderboards(self, operations: List[UpdateOne]):
+        """
+        Apply the update operations of the leaderboards in order with one bulk write.
+        """
+        if operations:
+            self.database[self.leaderboard_collection].bulk_write(operations, ordered=True)
+
+    def replace_leaderboard(self, metric: str, entries: List[Dict[str, Any]], rebuilt_at: datetime):
+        self.database[self.leaderboard_collection].replace_one(
+            {"_id": metric}, {"entries": entries, "updated_at": rebuilt_at, "rebuilt_at": rebuilt_at}, upsert=True
+        )
+
+    def organization_versions(self, ids: Iterable[Any], collection: str = None) -> Dict[Any, Any]:
+        """
+        Current version of the existing documents
+        """
+        collection = self.database[collection or self.organization_collection]
+        return {
+            document["_id"]: document.get("version")
+            for document in collection.find({"_id": {"$in": list(ids)}}, {"version": True})
+        }
+
+    def replace_organizations(self, documents: Iterable[Dict[str, Any]], versions: Dict[Any, Any],
+                              collection: str = None) -> set:
+        """
+        Replace the documents whose version is still the one in versions (the documents that aren't in versions
+        are inserted) with one bulk write, and return the ids of the documents that were modified meanwhile. The
+        GROUP_FIELDS of the current documents are kept.
+        """
+        expected = {}
+        requests = []
+        kept = {field: "${}".format(field) for field in GROUP_FIELDS}
+        for document in documents:
+            version = versions.get(document["_id"])
+            document["version"] = expected[document["_id"]] = (version or 0) + 1
+            if document["_id"] in versions:
+                requests.append(UpdateOne(
+                    {"_id": document["_id"], "version": version},
+                    [{"$replaceWith": {"$mergeObjects": [kept, {"$literal": document}]}}],
+                ))
+            else:
+                requests.append(InsertOne(document))
+        if not requests:
+            return set()
+
+        try:
+            self.database[collection or self.organization_collection].bulk_write(requests, ordered=False)
+        except BulkWriteError as exc:
+            if any(error["code"] != 11000 for error in exc.details["writeErrors"]):
+                raise
+
+        current = self.organization_versions(expected, collection)
+        return {_id for _id, version in expected.items() if current.get(_id) != version}
+
+    def iter_organization_fields(self, fields: List[str], batch_size: int = 10000) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Given fields of every organization, in batches
+        """
+        cursor = self.database[self.organization_collection].find(
+            {}, {field: True for field in fields}, batch_size=batch_size
+        )
+        batch = []
+        for document in cursor:
+            batch.append(document)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def update_organization_fields(self, changes: Dict[int, Dict[str, Any]]):
+        """
+        Set the fields of the organizations, as a new version of the documents
+        """
+        requests = [
+            UpdateOne({"_id": _id}, {"$set": fields, "$inc": {"version": 1}, "$currentDate": {"updated_at": True}})
+            for _id, fields in changes.items()
+        ]
+        if requests:
+            self.database[self.organization_collection].bulk_write(requests, ordered=False)
+
+    def copy_group_fields(self, target: str):
+        """
+        Copy the GROUP_FIELDS of the organizations into the documents of the target collection (e.g. a rebuilt
+        one) on the server, the organizations that aren't in the target are skipped
+        """
+        self.database[self.organization_collection].aggregate([
+            {"$match": {"$or": [{field: {"$exists": True}} for field in GROUP_FIELDS]}},
+            {"$project": {field: True for field in GROUP_FIELDS}},
+            {"$merge": {"into": target, "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}},
+        ])
+
+    def insert_organizations(self, documents: Iterable[Dict[str, Any]], collection: str = None) -> int:
+        """
+        Insert the documents with one unordered bulk write, so the server can apply them in parallel.
+        """
+        requests = [InsertOne(document) for document in documents]
+        if not requests:
+            return 0
+        result = self.database[collection or self.organization_collection].bulk_write(requests, ordered=False)
+        return result.inserted_count
+
+    def replace_organization_collection(self, collection: str, target: str = None):
+        """
+        Atomically replace the organization collection (or the target collection) with the given collection.
+        """
+        target = target or self.organization_collection
+        if collection in self.database.list_collection_names():
+            self.database[collection].rename(target, dropTarget=True)
+        else:
+            self.database.drop_collection(target)
+
+
+class AsyncClientRegistry:
+    """
+    Registry of motor clients, one per event loop (a motor client can only be used in the loop where it was created)
+    with the same connection settings as the pymongo clients. The clients of closed loops are closed.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def get_client(self):
+        # Imported here, so the sync code doesn't need motor
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.get(loop)
+            if client is None:
+                for closed in [other for other in self._clients if other.is_closed()]:
+                    self._clients.pop(closed).close()
+                client = self._clients[loop] = AsyncIOMotorClient(
+                    database_uri(), io_loop=loop, **client_options()
+                )
+        return client
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+
+
+async_clients = AsyncClientRegistry()
+
+
+class AsyncReadOnlyDB:
+    """
+    Read methods of ReadOnlyDB for coroutines, with the motor client of the running event loop. The queries are the
+    same ones, so they return the same documents.
+    """
+    organization_collection = ReadOnlyDB.organization_collection
+    holdings_collection = ReadOnlyDB.holdings_collection
+    owners_collection = ReadOnlyDB.owners_collection
+
+    def __init__(self):
+        self.client = async_clients.get_client()
+        self.database = self.client[settings.READ_ONLY_DATABASE["NAME"]]
+
+    async def find_organization_element_fields(self, _id: int, fields: List[str]) -> Optional[Dict[str, Any]]:
+        return await self.database[self.organization_collection].find_one(
+            {"_id": _id}, {field: True for field in fields}
+        )
+
+    def find_organization_owners(self, _id: int, total_shares: int, after: Tuple[ObjectId, str, int] = None,
+                                 limit: int = None) -> AsyncIterator[Dict[str, Any]]:
+        pipeline = ReadOnlyDB.owners_pipeline(_id, total_shares, after, limit)
+        return self.database[self.owners_collection].aggregate(pipeline, batchSize=settings.READ_ONLY_PAGE_SIZE)
+
+    def find_holdings(self, owner_key: str, after: int = None, limit: int = None) -> AsyncIterator[Dict[str, Any]]:
+        pipeline = ReadOnlyDB.holdings_pipeline(owner_key, after, limit)
+        return self.database[self.holdings_collection].aggregate(pipeline, batchSize=settings.READ_ONLY_PAGE_SIZE)
+
+    async def holdings_exist(self, owner_key: str) -> bool:
+        return await self.database[self.holdings_collection].count_documents({"_id": owner_key}, limit=1) > 0
@@ -1,6 +1,8 @@
-from rest_framework.serializers import ModelSerializer
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+from rest_framework.serializers import ChoiceField, IntegerField, ListSerializer, ModelSerializer, Serializer
 
-from .models import Organization, Person, Share
+from .models import Organization, OrganizationStats, Person, Position, Share
 
 
 class OrganizationSerializer(ModelSerializer):
@@ -19,3 +21,58 @@ class ShareSerializer(ModelSerializer):
     class Meta:
         model = Share
         fields = ['organization_owner', 'person_owner', 'organization_owned', 'share_class', 'amount']
+
+
+class BulkShareListSerializer(ListSerializer):
+    """
+    Validate the referenced organizations and persons of all the shares with one query per model
+    and insert all of them in one transaction.
+    """
+    batch_size = 1000
+
+    def validate(self, attrs):
+        organizations = {item["organization_owned_id"] for item in attrs}
+        organizations.update(item["organization_owner_id"] for item in attrs if item.get("organization_owner_id"))
+        persons = {item["person_owner_id"] for item in attrs if item.get("person_owner_id")}
+
+        organizations = set(Organization.objects.filter(orgnr__in=organizations).values_list("orgnr", flat=True))
+        persons = set(Person.objects.filter(pk__in=persons).values_list("pk", flat=True))
+
+        errors = []
+        for item in attrs:
+            error = {}
+            for field in ("organization_owner", "organization_owned"):
+                pk = item.get("{}_id".format(field))
+                if pk is not None and pk not in organizations:
+                    error[field] = ['Invalid pk "{}" - object does not exist.'.format(pk)]
+            pk = item.get("person_owner_id")
+            if pk is not None and pk not in persons:
+                error["person_owner"] = ['Invalid pk "{}" - object does not exist.'.format(pk)]
+            errors.append(error)
+
+        if any(errors):
+            raise ValidationError(errors)
+        return attrs
+
+    def create(self, validated_data):
+        with transaction.atomic():
+            shares = Share.objects.bulk_create([Share(**item) for item in validated_data], batch_size=self.batch_size)
+            OrganizationStats.refresh({share.organization_owned_id for share in shares})
+            Position.add_shares(share.pk for share in shares)
+        return shares
+
+
+class BulkShareSerializer(Serializer):
+    organization_owner = IntegerField(source="organization_owner_id", required=False, allow_null=True)
+    person_owner = IntegerField(source="person_owner_id", required=False, allow_null=True)
+    organization_owned = IntegerField(source="organization_owned_id")
+    share_class = ChoiceField(choices=Share.SHARE_CLASS_CHOICES)
+    amount = IntegerField(default=0)
+
+    class Meta:
+        list_serializer_class = BulkShareListSerializer
+
+    def validate(self, attrs):
+        if (attrs.get("organization_owner_id") is None) == (attrs.get("person_owner_id") is None):
+            raise ValidationError("A share must have either an organization_owner or a person_owner.")
+        return attrs
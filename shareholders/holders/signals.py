@@ -1,18 +1,58 @@
 import os
+from collections import defaultdict
+from typing import List
 
+from django.db import transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from .models import Share
-from .amqp import Amqp
+from .amqp import AmqpPublisher, get_publisher
+from .projection import PARTITION_QUEUE_ARGUMENTS, PROJECTION_EXCHANGE, partition_of, partition_queues, project_shares
+
+
+def projection_publisher() -> AmqpPublisher:
+    """
+    Publisher of the shares into the partitions. It declares the partition queues too, so the shares published
+    before the listener of a partition ever ran aren't lost.
+    """
+    return get_publisher(
+        PROJECTION_EXCHANGE, "direct", queues=partition_queues(), queue_arguments=PARTITION_QUEUE_ARGUMENTS
+    )
 
 
 @receiver(post_save, sender=Share)
 def save_in_read_only_db(sender, instance, *args, **kwargs):
     """
     After save it into write-only database (a.k.a psql) we have to save it into read-only db as well.
+
+    The message is published once the transaction is committed, otherwise the listener could read the share
+    before it exists for it.
     """
     if os.getenv("WRITE_READ_ONLY_ASYNC"):
-        amqp = Amqp()
-        amqp.publish(str(instance.id))
+        share_id = str(instance.id)
+        partition = str(partition_of(instance.organization_owned_id))
+        transaction.on_commit(
+            lambda: projection_publisher().publish(share_id, routing_key=partition)
+        )
     else:
         instance.save_in_ro_db()
+
+
+def save_shares_in_read_only_db(shares: List[Share]):
+    """
+    bulk_create doesn't send post_save, so the shares created in bulk are sent to the read-only db here
+    with one message per organization, published into the partition of the organization.
+    """
+    if os.getenv("WRITE_READ_ONLY_ASYNC"):
+        organizations = defaultdict(list)
+        for share in shares:
+            organizations[share.organization_owned_id].append(str(share.id))
+
+        def publish():
+            publisher = projection_publisher()
+            for orgnr, share_ids in organizations.items():
+                publisher.publish("\n".join(share_ids), routing_key=str(partition_of(orgnr)))
+
+        transaction.on_commit(publish)
+    else:
+        project_shares([share.pk for share in shares])
@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+from ..read_only import ReadOnlyDB, clients
+
+EXPLAINED_COMMANDS = {"find", "aggregate", "count", "distinct"}
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """
+    Keep the read commands sent to the ReadOnly DB
+    """
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        if event.command_name in EXPLAINED_COMMANDS:
+            self.commands.append(event.command)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def collection_scans(plan) -> list:
+    """
+    Stages of the explained plan (and of its sub plans) that scan a whole collection
+    """
+    if isinstance(plan, list):
+        return [stage for item in plan for stage in collection_scans(item)]
+    if not isinstance(plan, dict):
+        return []
+
+    scans = [plan] if plan.get("stage") == "COLLSCAN" else []
+    for key, value in plan.items():
+        if key != "rejectedPlans":
+            scans.extend(collection_scans(value))
+    return scans
+
+
+class QueryPlanTestMixin:
+    """
+    assertNoCollectionScans explains every query sent to the ReadOnly DB in the block and fails if any of them scans
+    a whole collection, e.g.:
+
+        with self.assertNoCollectionScans():
+            self.client.get('/api/1/owners')
+    """
+    @contextmanager
+    def assertNoCollectionScans(self):
+        recorder = CommandRecorder()
+        clients.close()
+        clients.listeners.append(recorder)
+        try:
+            yield recorder
+        finally:
+            clients.listeners.remove(recorder)
+            clients.close()
+
+        self.assertTrue(recorder.commands, "No query was sent to the read only database")
+        database = ReadOnlyDB().database
+        for command in recorder.commands:
+            command = {key: value for key, value in command.items() if not key.startswith("$") and key != "lsid"}
+            plan = database.command({"explain": command, "verbosity": "queryPlanner"})
+            scans = collection_scans(plan)
+            self.assertFalse(scans, "{} scans a whole collection: {}".format(command, scans))
@@ -0,0 +1,149 @@
+import threading
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+from pika.exceptions import AMQPConnectionError, NackError
+
+from ..amqp import AmqpPublisher
+
+
+class FakeAmqp:
+    """
+    Amqp without a broker: it records the published messages, and raises the errors of FakeAmqp.errors in order
+    """
+    instances = []
+    errors = []
+    sending = threading.Event()
+    release = threading.Event()
+
+    def __init__(self, exchange="shares", exchange_type="fanout"):
+        self.published = []
+        self.closed = False
+        self.connection = self
+        FakeAmqp.instances.append(self)
+
+    def enable_confirms(self):
+        pass
+
+    def declare_queue(self, queue_name, routing_key="", exchange="shares", arguments=None):
+        pass
+
+    def publish(self, message, exchange="shares", routing_key=""):
+        FakeAmqp.sending.set()
+        FakeAmqp.release.wait(5)
+        if FakeAmqp.errors:
+            raise FakeAmqp.errors.pop(0)
+        self.published.append((routing_key, message))
+
+    def process_data_events(self, time_limit=None):
+        pass
+
+    def close_connection(self):
+        self.closed = True
+
+
+@patch("holders.amqp.Amqp", FakeAmqp)
+class TestAmqpPublisher(SimpleTestCase):
+    def setUp(self):
+        FakeAmqp.instances = []
+        FakeAmqp.errors = []
+        FakeAmqp.sending.clear()
+        FakeAmqp.release.set()
+
+    def publisher(self, **kwargs):
+        publisher = AmqpPublisher(**dict({"flush_interval_ms": 200}, **kwargs))
+        publisher.reconnect_delay = 0
+        publisher.publish_timeout = 0.05
+        self.addCleanup(publisher.close)
+        # cleanups run in reverse order: a thread waiting to send is released before closing
+        self.addCleanup(FakeAmqp.release.set)
+        return publisher
+
+    @staticmethod
+    def published():
+        return [message for amqp in FakeAmqp.instances for message in amqp.published]
+
+    def test_batches_by_routing_key(self):
+        publisher = self.publisher()
+        publisher.publish("1", routing_key="a")
+        publisher.publish("2", routing_key="b")
+        publisher.publish("3", routing_key="a")
+        publisher.flush()
+
+        self.assertCountEqual(self.published(), [("a", "1\n3"), ("b", "2")])
+
+    def test_reconnects_and_sends_again(self):
+        FakeAmqp.errors = [AMQPConnectionError()]
+        publisher = self.publisher()
+        with self.assertLogs("holders.amqp", "ERROR"):
+            publisher.publish("1")
+            publisher.flush()
+
+        self.assertEqual(len(FakeAmqp.instances), 2)
+        self.assertTrue(FakeAmqp.instances[0].closed)
+        self.assertEqual(FakeAmqp.instances[1].published, [("", "1")])
+
+    def test_rejected_message_is_dropped(self):
+        FakeAmqp.errors = [NackError([])]
+        publisher = self.publisher()
+        with self.assertLogs("holders.amqp", "ERROR"):
+            publisher.publish("1")
+            publisher.flush()
+        publisher.publish("2")
+        publisher.flush()
+
+        self.assertEqual(self.published(), [("", "2")])
+        self.assertEqual(len(FakeAmqp.instances), 1)
+        self.assertEqual(publisher.dropped, 1)
+
+    def test_full_buffer_drops_instead_of_blocking(self):
+        FakeAmqp.release.clear()
+        publisher = self.publisher(batch_size=1, max_buffer=1)
+        publisher.publish("1")
+        FakeAmqp.sending.wait(5)
+
+        self.assertTrue(publisher.publish("2"))
+        with self.assertLogs("holders.amqp", "ERROR"):
+            self.assertFalse(publisher.publish("3"))
+            # closing doesn't wait for room either
+            publisher.close()
+        self.assertEqual(publisher.dropped, 1)
+
+        FakeAmqp.release.set()
+        publisher.flush()
+        self.assertEqual(self.published(), [("", "1"), ("", "2")])
+
+    def test_dead_thread_is_started_again(self):
+        FakeAmqp.errors = [RuntimeError("unexpected")]
+        publisher = self.publisher()
+        # the thread dies with the error, that is logged by the publisher instead of threading
+        with self.assertLogs("holders.amqp", "ERROR"), patch("threading.excepthook"):
+            publisher.publish("1")
+            publisher._thread.join(5)
+            self.assertFalse(publisher._thread.is_alive())
+
+            publisher.publish("2")
+        publisher.flush()
+
+        self.assertTrue(publisher._thread.is_alive())
+        self.assertEqual(self.published(), [("", "2")])
+
+    def test_new_thread_after_fork(self):
+        publisher = self.publisher()
+        publisher.publish("1")
+        publisher.flush()
+        parent_thread = publisher._thread
+
+        # as seen from a child process, where the thread of the parent doesn't exist
+        publisher._buffer.put(None)
+        parent_thread.join(5)
+        publisher._pid = -1
+        with patch("holders.amqp.logger") as logger:
+            publisher.publish("2")
+        publisher.flush()
+
+        self.assertIsNot(publisher._thread, parent_thread)
+        self.assertEqual(len(FakeAmqp.instances), 2)
+        self.assertEqual(FakeAmqp.instances[1].published, [("", "2")])
+        # the thread didn't die, it doesn't exist in the child process
+        logger.error.assert_not_called()
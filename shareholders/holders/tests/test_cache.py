@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from ..cache import InvalidationListener, LRUCache
+
+
+class TestLRUCache(TestCase):
+    def test_hit_and_miss(self):
+        cache = LRUCache(max_size=10, ttl=60)
+
+        self.assertEqual(cache.get(1, lambda: "one"), "one")
+        self.assertEqual(cache.get(1, lambda: "other"), "one")
+
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_eviction(self):
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.get(1, lambda: "one")
+        cache.get(2, lambda: "two")
+        cache.get(1, lambda: "one")
+        cache.get(3, lambda: "three")
+
+        # 2 was the least recently used
+        self.assertEqual(cache.get(2, lambda: "new"), "new")
+        self.assertEqual(cache.stats()["evictions"], 2)
+
+    def test_ttl(self):
+        cache = LRUCache(max_size=10, ttl=0.01)
+        cache.get(1, lambda: "one")
+        time.sleep(0.02)
+        self.assertEqual(cache.get(1, lambda: "new"), "new")
+
+    def test_invalidate(self):
+        cache = LRUCache(max_size=10, ttl=60)
+        cache.get(1, lambda: "one")
+        cache.invalidate([1])
+        self.assertEqual(cache.get(1, lambda: "new"), "new")
+        self.assertEqual(cache.stats()["invalidations"], 1)
+
+    def test_concurrent_misses_are_coalesced(self):
+        cache = LRUCache(max_size=10, ttl=60)
+        loads = []
+        loading = threading.Event()
+
+        def loader():
+            loads.append(1)
+            loading.wait(1)
+            return "one"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get(1, loader))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while cache.stats()["coalesced"] < 4:
+            time.sleep(0.001)
+        loading.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(results, ["one"] * 5)
+
+    def test_invalidated_while_loading(self):
+        cache = LRUCache(max_size=10, ttl=60)
+
+        def loader():
+            cache.invalidate([1])
+            return "stale"
+
+        self.assertEqual(cache.get(1, loader), "stale")
+        self.assertEqual(cache.get(1, lambda: "new"), "new")
+
+    async def test_async_misses_are_coalesced(self):
+        cache = LRUCache(max_size=10, ttl=60)
+        loads = []
+
+        async def loader():
+            loads.append(1)
+            await asyncio.sleep(0.01)
+            return "one"
+
+        results = await asyncio.gather(*(cache.aget(1, loader) for _ in range(5)))
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(results, ["one"] * 5)
+        self.assertEqual(await cache.aget(1, loader), "one")
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    async def test_async_invalidated_while_loading(self):
+        cache = LRUCache(max_size=10, ttl=60)
+
+        async def loader():
+            cache.invalidate([1])
+            return "stale"
+
+        self.assertEqual(await cache.aget(1, loader), "stale")
+        self.assertEqual(cache.stats()["size"], 0)
+
+
+class TestInvalidationListener(TestCase):
+    def test_on_message(self):
+        cache = LRUCache(max_size=10, ttl=60)
+        listener = InvalidationListener(cache)
+        for key in (1, 2, 3):
+            cache.get(key, lambda: key)
+
+        listener.on_message(None, None, None, b"1\n2")
+        self.assertEqual(cache.stats()["size"], 1)
+
+        listener.on_message(None, None, None, b"*")
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_dead_thread_is_started_again(self):
+        listener = InvalidationListener(LRUCache(max_size=10, ttl=60))
+        # a thread that stops at once, as if it died
+        with patch.object(InvalidationListener, "_run"):
+            listener.ensure_running()
+            thread = listener._thread
+            thread.join(5)
+
+            with self.assertLogs("holders.cache", "ERROR"):
+                listener.ensure_running()
+            self.assertIsNot(listener._thread, thread)
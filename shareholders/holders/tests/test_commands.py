@@ -0,0 +1,339 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from io import StringIO
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import TestCase, override_settings
+from pika.spec import Basic
+
+from ..management.commands.save_read_only_db import Command as SaveReadOnlyDbCommand
+from ..models import Organization, Person, RegistryImport, Share
+from ..read_only import ReadOnlyDB
+
+REGISTRY = (
+    "Orgnr;Selskap;Aksjeklasse;Navn aksjonær;Fødselsår/orgnr;Postnr/sted;Landkode;Antall aksjer;Antall aksjer selskap\n"
+    "910000001;BEAUFORT AS;Ordinære aksjer;HOLDING AS;910000002;0150 OSLO;NOR;60;100\n"
+    "910000001;BEAUFORT AS;Ordinære aksjer;AGUSTIN;1994;S2300 RAFAELA;ARG;40;100\n"
+    "910000002;HOLDING AS;B-aksjer;AGUSTIN;1994;S2300 RAFAELA;ARG;10;10\n"
+    "not a row\n"
+)
+
+
+class TestImportRegistry(TestCase):
+    def setUp(self):
+        registry = tempfile.NamedTemporaryFile("w", suffix=".csv", encoding="utf-8", delete=False)
+        registry.write(REGISTRY)
+        registry.close()
+        self.path = registry.name
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_import(self):
+        call_command("import_registry", self.path, stdout=StringIO())
+
+        self.assertEqual(Organization.objects.count(), 2)
+        self.assertEqual(Organization.objects.get(orgnr=910000002).postal_code, "0150")
+        self.assertEqual(Person.objects.get().country, "ARG")
+        self.assertEqual(Person.objects.get().birth_date.year, 1994)
+        self.assertEqual(Share.objects.count(), 3)
+        self.assertEqual(Share.objects.get(organization_owned=910000002).share_class, "B-aksje")
+        self.assertTrue(RegistryImport.objects.get().finished)
+
+    def test_import_again_doesnt_duplicate(self):
+        call_command("import_registry", self.path, stdout=StringIO())
+        call_command("import_registry", self.path, "--restart", stdout=StringIO())
+
+        self.assertEqual(Person.objects.count(), 1)
+        self.assertEqual(Share.objects.count(), 3)
+
+    def test_resume_from_checkpoint(self):
+        with open(self.path, "rb") as registry:
+            registry.readline()
+            registry.readline()
+            offset = registry.tell()
+        RegistryImport.objects.create(source=os.path.abspath(self.path), offset=offset, rows=1)
+
+        call_command("import_registry", self.path, "--batch-size", "1", stdout=StringIO())
+
+        self.assertEqual(Share.objects.count(), 2)
+        self.assertEqual(RegistryImport.objects.get().rows, 3)
+
+
+class TestRebuildReadModel(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        self.owner = Organization.objects.create(name="Another one", postal_code="S2300", country="Sweden", orgnr=2)
+        self.person = Person.objects.create(name="Agustin", postal_code="S2300", country="Norway")
+
+        Share.objects.create(
+            organization_owner=self.owner, organization_owned=self.organization, share_class="A-aksjer", amount=30,
+        )
+        Share.objects.create(
+            person_owner=self.person, organization_owned=self.organization, share_class="B-aksje", amount=10,
+        )
+        Share.objects.create(
+            person_owner=self.person, organization_owned=self.owner, share_class="A-aksjer", amount=5,
+        )
+
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+
+    def test_rebuild(self):
+        rodb = ReadOnlyDB()
+        rodb.database.drop_collection(rodb.organization_collection)
+
+        call_command("rebuild_read_model", "--workers", "1", stdout=StringIO())
+
+        document = rodb.find_organization_element({"_id": 1})
+        self.assertEqual(document["total_shares"], 40)
+        self.assertEqual(document["number_of_owners"], 2)
+        self.assertEqual(document["number_of_holdings"], 0)
+        self.assertTrue(document["has_foreign_owners"])
+        self.assertTrue(document["has_multiple_share_class"])
+        organization_owner, person_owner = rodb.find_organization_owners(1)
+        self.assertEqual(organization_owner["name"], "Another one")
+        self.assertEqual(person_owner["amount"], 10)
+
+        document = rodb.find_organization_element({"_id": 2})
+        self.assertEqual(document["number_of_holdings"], 1)
+        self.assertFalse(document["has_foreign_owners"])
+        self.assertEqual(rodb.database[rodb.organization_collection].count_documents({}), 2)
+
+    @staticmethod
+    def owners(orgnr):
+        # the buckets are new, but the owners and their positions in the buckets are the same
+        return [dict(owner, bucket=None) for owner in ReadOnlyDB().find_organization_owners(orgnr)]
+
+    def test_rebuild_matches_incremental_projection(self):
+        rodb = ReadOnlyDB()
+        collection = rodb.database[rodb.organization_collection]
+        incremental = {document["_id"]: document for document in collection.find()}
+        incremental_owners = {orgnr: self.owners(orgnr) for orgnr in incremental}
+
+        call_command("rebuild_read_model", "--workers", "1", stdout=StringIO())
+
+        self.assertEqual({orgnr: self.owners(orgnr) for orgnr in incremental}, incremental_owners)
+        for document in collection.find():
+            self.assertCountEqual(document.pop("share_classes"), incremental[document["_id"]].pop("share_classes"))
+            # the version only counts the updates
+            incremental[document["_id"]].pop("version")
+            self.assertGreaterEqual(document.pop("updated_at"), incremental[document["_id"]].pop("updated_at"))
+            self.assertEqual(document, incremental[document["_id"]])
+
+    def test_rebuild_holdings(self):
+        rodb = ReadOnlyDB()
+        collection = rodb.database[rodb.holdings_collection]
+        incremental = {document.pop("_id"): document.pop("holdings") for document in collection.find()}
+
+        call_command("rebuild_read_model", "--workers", "1", stdout=StringIO())
+
+        self.assertEqual({document.pop("_id"): document.pop("holdings") for document in collection.find()}, incremental)
+        self.assertEqual(list(rodb.find_holdings("person:{}".format(self.person.pk)))[1]["percentage"], 100)
+
+    def test_rebuild_replaces_documents(self):
+        rodb = ReadOnlyDB()
+        rodb.add_new_organization_share({"_id": 99})
+
+        call_command("rebuild_read_model", "--workers", "1", stdout=StringIO())
+
+        self.assertIsNone(rodb.find_organization_element({"_id": 99}))
+
+
+class RecordingAmqp:
+    def __init__(self):
+        self.acks = []
+        self.nacks = []
+        self.sleeps = []
+
+    @contextmanager
+    def heartbeats(self):
+        yield
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+    def ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+    def nack(self, delivery_tag, multiple=False, requeue=True):
+        self.nacks.append((delivery_tag, multiple, requeue))
+
+
+class TestSaveReadOnlyDb(TestCase):
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+
+    def test_invalid_message_is_dead_lettered_alone(self):
+        organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        person = Person.objects.create(name="Agustin", postal_code="S2300", country="Argentina")
+        share = Share.objects.create(
+            person_owner=person, organization_owned=organization, amount=10, share_class="A-aksjer"
+        )
+        amqp = RecordingAmqp()
+        batch = [
+            (Basic.Deliver(delivery_tag=1), str(share.pk).encode()),
+            (Basic.Deliver(delivery_tag=2), b"not a share"),
+            (Basic.Deliver(delivery_tag=3), str(share.pk).encode()),
+        ]
+
+        SaveReadOnlyDbCommand().save_batch(amqp, batch)
+
+        self.assertEqual(amqp.nacks, [(2, False, False)])
+        self.assertEqual(amqp.acks, [(3, True)])
+
+    def test_failed_batch_is_requeued_after_a_delay(self):
+        amqp = RecordingAmqp()
+        command = SaveReadOnlyDbCommand()
+        batch = [(Basic.Deliver(delivery_tag=1), b"1")]
+
+        with patch("holders.management.commands.save_read_only_db.project_shares", side_effect=OperationalError):
+            command.save_batch(amqp, batch)
+            command.save_batch(amqp, batch)
+
+        self.assertEqual(amqp.nacks, [(1, True, True), (1, True, True)])
+        self.assertEqual(amqp.sleeps, [1, 2])
+        self.assertEqual(amqp.acks, [])
+
+
+class TestEnsureReadIndexes(TestCase):
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+        read_only_db.database.drop_collection(read_only_db.ultimate_owners_collection)
+        read_only_db.database.drop_collection(read_only_db.owner_stats_collection)
+
+    def test_ensure_read_indexes(self):
+        rodb = ReadOnlyDB()
+        collection = rodb.database[rodb.organization_collection]
+        collection.create_index("name", name="unknown")
+
+        call_command("ensure_read_indexes", stdout=StringIO())
+        self.assertIn("country", collection.index_information())
+        self.assertIn("organizations_owner_id", rodb.database[rodb.owners_collection].index_information())
+        self.assertEqual(rodb.ensure_indexes(), {name: [] for name in rodb.indexes})
+
+        call_command("ensure_read_indexes", "--prune", stdout=StringIO())
+        self.assertNotIn("unknown", collection.index_information())
+
+
+class TestPrecomputeUltimateOwners(TestCase):
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+        read_only_db.database.drop_collection(read_only_db.ultimate_owners_collection)
+
+    def test_precompute_most_requested(self):
+        organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        other = Organization.objects.create(name="Other", postal_code="S2300", country="Norway", orgnr=2)
+        person = Person.objects.create(name="Agustin", postal_code="S2300", country="Argentina")
+        Share.objects.create(person_owner=person, organization_owned=organization, amount=10, share_class="A-aksjer")
+        Share.objects.create(person_owner=person, organization_owned=other, amount=10, share_class="A-aksjer")
+        rodb = ReadOnlyDB()
+        requests = [{"_id": 1, "requests": 2}, {"_id": 2, "requests": 1}]
+        rodb.database[rodb.ultimate_owners_collection].insert_many(requests)
+
+        call_command("precompute_ultimate_owners", "--top", "1", stdout=StringIO())
+
+        config = settings.ULTIMATE_OWNERS
+        precomputed = rodb.find_ultimate_owners(1, config["MAX_DEPTH"], config["MIN_PERCENTAGE"])
+        self.assertEqual([owner["id"] for owner in precomputed["owners"]], [person.pk])
+        self.assertEqual(precomputed["requests"], 1)
+        self.assertIsNone(rodb.find_ultimate_owners(2, config["MAX_DEPTH"], config["MIN_PERCENTAGE"]))
+
+        # the precomputed owners are returned with the default cut-offs, until they are precomputed again
+        other_person = Person.objects.create(name="Other", postal_code="S2300", country="Norway")
+        Share.objects.create(
+            person_owner=other_person, organization_owned=organization, amount=10, share_class="A-aksjer"
+        )
+        response = self.client.get('/api/1/ultimate-owners')
+        self.assertEqual(len(response.json()["owners"]), 1)
+        response = self.client.get('/api/1/ultimate-owners', {"max_depth": 5})
+        self.assertEqual(len(response.json()["owners"]), 2)
+
+
+class TestComputeGroupAnalytics(TestCase):
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+
+    def test_compute_group_analytics(self):
+        parent = Organization.objects.create(name="Parent", postal_code="S2300", country="Norway", orgnr=1)
+        child = Organization.objects.create(name="Child", postal_code="S2300", country="Norway", orgnr=2)
+        Share.objects.create(organization_owner=parent, organization_owned=child, amount=60, share_class="A-aksjer")
+        Share.objects.create(organization_owner=child, organization_owned=parent, amount=10, share_class="A-aksjer")
+        etag = self.client.get('/api/2/summary')["ETag"]
+
+        call_command("compute_group_analytics", stdout=StringIO())
+
+        response = self.client.get('/api/2/summary')
+        self.assertEqual(response.json()["group_id"], 1)
+        self.assertEqual(response.json()["parent_company"], 1)
+        self.assertTrue(response.json()["in_cross_holding"])
+        self.assertNotEqual(response["ETag"], etag)
+
+        # the full projection keeps them
+        with override_settings(READ_ONLY_PROJECTION="full"):
+            Share.objects.create(organization_owner=parent, organization_owned=child, amount=5, share_class="B-aksje")
+        self.assertEqual(self.client.get('/api/2/summary').json()["group_id"], 1)
+
+        # and the rebuild too
+        call_command("rebuild_read_model", "--workers", "1", stdout=StringIO())
+        self.assertEqual(self.client.get('/api/2/summary').json()["parent_company"], 1)
+
+
+class TestRebuildLeaderboards(TestCase):
+    def setUp(self):
+        self.tearDown()
+
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        for collection in (
+            read_only_db.organization_collection, read_only_db.holdings_collection, read_only_db.owners_collection,
+            read_only_db.owner_stats_collection, read_only_db.leaderboard_collection,
+        ):
+            read_only_db.database.drop_collection(collection)
+
+    @override_settings(LEADERBOARD_SIZE=2)
+    def test_rebuild_leaderboards(self):
+        owned = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        people = [Person.objects.create(name=name, postal_code="S2300", country="Norway") for name in "ABC"]
+        for person, amount in zip(people, (10, 30, 20)):
+            Share.objects.create(person_owner=person, organization_owned=owned, amount=amount, share_class="A-aksjer")
+
+        rodb = ReadOnlyDB()
+        incremental = rodb.find_leaderboards()
+        self.assertEqual([entry["value"] for entry in incremental["shares"]], [30, 20])
+
+        # drift: the stats of an owner and the leaderboards are lost
+        rodb.database[rodb.owner_stats_collection].delete_one({"_id": "person:{}".format(people[1].pk)})
+        rodb.database.drop_collection(rodb.leaderboard_collection)
+
+        out = StringIO()
+        call_command("rebuild_leaderboards", stdout=out)
+        self.assertIn("Leaderboards of 3 owners", out.getvalue())
+        leaderboards = rodb.find_leaderboards()
+        self.assertEqual(leaderboards["shares"], incremental["shares"])
+        # ties are sorted by key
+        keys = sorted("person:{}".format(person.pk) for person in people)
+        self.assertEqual([(entry["key"], entry["value"]) for entry in leaderboards["holdings"]], [
+            (keys[0], 1), (keys[1], 1),
+        ])
+        self.assertEqual(leaderboards["controlled"], [])
+        self.assertEqual(rodb.database[rodb.owner_stats_collection].count_documents({}), 3)
@@ -0,0 +1,105 @@
+from unittest.mock import patch
+
+import numpy as np
+from django.test import SimpleTestCase, TestCase
+
+from ..graph import CSRGraph, OwnershipGraph, node_key, ownership_graph
+from ..models import Organization, Person, Share
+from ..read_only import ReadOnlyDB
+
+
+class TestCSRGraph(TestCase):
+    def setUp(self):
+        # 2 owns 60% of 1, and half of 2 is owned by 3, that is owned by 2
+        edges = np.array([[2, 1, 60], [-7, 1, 40], [-8, 2, 50], [3, 2, 50], [2, 3, 100]])
+        self.graph = CSRGraph(edges[:, 0], edges[:, 1], edges[:, 2])
+
+    def test_stats(self):
+        stats = self.graph.stats()
+        self.assertEqual((stats["nodes"], stats["edges"]), (5, 5))
+
+    def test_downstream(self):
+        organizations = self.graph.downstream(self.graph.index(3), max_depth=10, min_percentage=0)
+        self.assertEqual(organizations, [
+            {"orgnr": 2, "depth": 1, "percentage": 50},
+            {"orgnr": 1, "depth": 2, "percentage": 30},
+        ])
+        self.assertEqual(len(self.graph.downstream(self.graph.index(3), max_depth=1, min_percentage=0)), 1)
+        self.assertEqual(len(self.graph.downstream(self.graph.index(3), max_depth=10, min_percentage=40)), 1)
+
+    def test_upstream(self):
+        owners = self.graph.upstream(self.graph.index(1), max_depth=10)
+        self.assertEqual(
+            {(owner["owner_type"], owner["id"], owner["depth"]) for owner in owners},
+            {("person", 7, 1), ("organization", 2, 1), ("person", 8, 2), ("organization", 3, 2)},
+        )
+
+    def test_path(self):
+        path = self.graph.path(self.graph.index(node_key("person", 8)), self.graph.index(1), max_depth=10)
+        self.assertEqual(path, [
+            {"owner_type": "person", "id": 8, "orgnr": 2, "percentage": 50},
+            {"owner_type": "organization", "id": 2, "orgnr": 1, "percentage": 60},
+        ])
+        self.assertIsNone(self.graph.path(self.graph.index(1), self.graph.index(2), max_depth=10))
+
+
+class TestOwnershipGraph(TestCase):
+    # The graph is refreshed in the test thread: the background rebuild wouldn't see the test transaction
+    def setUp(self):
+        ownership_graph.refresh()
+
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+        ownership_graph.clear()
+
+    def test_graph_is_updated_with_the_new_shares(self):
+        organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        holding = Organization.objects.create(name="Holding", postal_code="S2300", country="Norway", orgnr=2)
+        person = Person.objects.create(name="Agustin", postal_code="S2300", country="Argentina")
+        Share.objects.create(
+            organization_owner=holding, organization_owned=organization, amount=10, share_class="A-aksjer"
+        )
+        ownership_graph.clear()
+        ownership_graph.refresh()
+
+        response = self.client.get('/api/2/graph/downstream')
+        self.assertEqual(response.json()["organizations"], [{"orgnr": 1, "depth": 1, "percentage": 100}])
+
+        Share.objects.create(person_owner=person, organization_owned=organization, amount=30, share_class="A-aksjer")
+        Share.objects.create(person_owner=person, organization_owned=holding, amount=10, share_class="A-aksjer")
+        ownership_graph.refresh()
+        response = self.client.get('/api/2/graph/downstream')
+        self.assertEqual(response.json()["organizations"], [{"orgnr": 1, "depth": 1, "percentage": 25}])
+
+        response = self.client.get('/api/graph/path', {"source": "person:{}".format(person.pk), "target": 1})
+        self.assertEqual(len(response.json()["path"]), 1)
+        response = self.client.get('/api/1/graph/upstream')
+        self.assertEqual(len(response.json()["owners"]), 2)
+        self.assertEqual(self.client.get('/api/graph/stats').json()["edges"], 3)
+
+    def test_not_in_graph(self):
+        self.assertEqual(self.client.get('/api/1/graph/downstream').status_code, 404)
+        self.assertEqual(self.client.get('/api/graph/path', {"source": "x:1", "target": 1}).status_code, 400)
+
+
+class TestOwnershipGraphRebuild(SimpleTestCase):
+    def test_invalidations_are_applied_in_the_background(self):
+        graph = OwnershipGraph()
+        graph.rebuild_delay = 0
+        edges = [
+            (np.array([2]), np.array([1]), np.array([60])),
+            (np.array([2, -7]), np.array([1, 1]), np.array([60, 40])),
+        ]
+        with patch.object(graph, "read_edges", side_effect=edges):
+            loaded = graph.graph()
+            graph.invalidate([1])
+
+            # the requests use the previous graph until the new one is ready
+            self.assertIs(graph.graph(), loaded)
+            graph._thread.join(5)
+
+        self.assertEqual(graph.graph().edges, 2)
+        self.assertFalse(graph._thread.is_alive())
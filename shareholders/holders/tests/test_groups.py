@@ -0,0 +1,43 @@
+import numpy as np
+from django.test import TestCase
+
+from ..graph import CSRGraph
+from ..groups import GroupAnalytics
+
+
+class TestGroupAnalytics(TestCase):
+    def setUp(self):
+        edges = np.array([
+            # 10 controls 11 that controls 12, and the person 5 owns 10
+            [10, 11, 60], [-5, 11, 40], [11, 12, 80], [-5, 12, 20], [-5, 10, 100],
+            # 20 and 21 own 30% of each other
+            [20, 21, 30], [21, 20, 30], [-6, 20, 70], [-6, 21, 70],
+            # 30 and 31 control each other
+            [30, 31, 60], [31, 30, 70], [-7, 30, 30], [-7, 31, 40],
+        ])
+        self.analytics = GroupAnalytics(CSRGraph(edges[:, 0], edges[:, 1], edges[:, 2]))
+
+    def fields(self, orgnr):
+        return self.analytics.fields([orgnr])[0]
+
+    def test_control_tree(self):
+        self.assertEqual(self.fields(10), {
+            "group_id": 10, "parent_company": None, "in_cross_holding": False, "component_id": 10,
+        })
+        self.assertEqual(self.fields(12)["group_id"], 10)
+        self.assertEqual(self.fields(12)["parent_company"], 11)
+
+    def test_cross_holding(self):
+        self.assertTrue(self.fields(21)["in_cross_holding"])
+        self.assertIsNone(self.fields(21)["group_id"])
+        self.assertEqual(self.fields(21)["component_id"], 20)
+
+    def test_control_cycle(self):
+        self.assertEqual((self.fields(30)["group_id"], self.fields(31)["group_id"]), (30, 30))
+        self.assertEqual(self.fields(30)["parent_company"], 31)
+        self.assertTrue(self.fields(30)["in_cross_holding"])
+
+    def test_organization_without_shares(self):
+        self.assertEqual(self.fields(99), {
+            "group_id": None, "parent_company": None, "in_cross_holding": False, "component_id": None,
+        })
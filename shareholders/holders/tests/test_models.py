@@ -1,9 +1,10 @@
 from datetime import datetime
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.db.utils import IntegrityError
 
-from ..models import Person, Organization, Share
+from ..models import Person, Organization, OrganizationStats, Position, Share
+from ..projection import partition_of, project_shares, with_positions
 from ..read_only import ReadOnlyDB
 
 
@@ -63,6 +64,8 @@ class TestShare(TestCase):
     def tearDown(self):
         read_only_db = ReadOnlyDB()
         read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
 
     def test_company_and_person_as_owners(self):
         with self.assertRaises(IntegrityError):
@@ -85,16 +88,17 @@ class TestShare(TestCase):
         )
 
         rodb_field = rodb.database[rodb.organization_collection].find_one()
+        bucket = rodb.database[rodb.owners_collection].find_one({"organization": 10})
 
         self.assertEqual(rodb_field["name"], "Agustin")
         self.assertEqual(rodb_field["total_shares"], 10)
         self.assertEqual(rodb_field["_id"], 10)
         self.assertEqual(rodb_field["postal_code"], "S2300")
         self.assertEqual(rodb_field["country"], "Argentina")
-        self.assertEqual(rodb_field["persons_owner"][0]["postal_code"], "S2300")
-        self.assertEqual(rodb_field["persons_owner"][0]["country"], "Argentina")
-        self.assertEqual(rodb_field["persons_owner"][0]["amount"], 10)
-        self.assertEqual(rodb_field["persons_owner"][0]["share_class"], "A-aksjer")
+        self.assertEqual(bucket["persons_owner"][0]["postal_code"], "S2300")
+        self.assertEqual(bucket["persons_owner"][0]["country"], "Argentina")
+        self.assertEqual(bucket["persons_owner"][0]["amount"], 10)
+        self.assertEqual(bucket["persons_owner"][0]["share_class"], "A-aksjer")
 
     def test_organization_amount_owners(self):
         Share.objects.create(
@@ -145,7 +149,38 @@ class TestShare(TestCase):
             share_class="A-aksjer",
         )
 
-        self.assertEqual(self.organization.has_foreign_owners, True)
+        self.assertEqual(self.organization_2.has_foreign_owners, True)
+        self.assertEqual(self.organization.has_foreign_owners, False)
+
+    def test_foreign_owner_counted_once(self):
+        Share.objects.create(
+            person_owner=self.person,
+            organization_owned=self.organization_2,
+            amount=10,
+            share_class="A-aksjer",
+        )
+        Share.objects.create(
+            person_owner=self.person,
+            organization_owned=self.organization_2,
+            amount=10,
+            share_class="B-aksje",
+        )
+
+        stats = OrganizationStats.objects.get(organization=self.organization_2)
+        self.assertEqual(stats.foreign_owners, 1)
+        self.assertEqual(stats.share_classes, 2)
+
+    def test_refresh_stats(self):
+        Share.objects.bulk_create([
+            Share(person_owner=self.person, organization_owned=self.organization_2, amount=1, share_class="A-aksjer"),
+            Share(person_owner=self.person, organization_owned=self.organization_2, amount=1, share_class="B-aksje"),
+        ])
+
+        OrganizationStats.refresh([self.organization_2.pk])
+
+        stats = OrganizationStats.objects.get(organization=self.organization_2)
+        self.assertEqual(stats.foreign_owners, 1)
+        self.assertEqual(stats.share_classes, 2)
 
     def test_organization_doesnt_have_foreign_holding(self):
         Share.objects.create(
@@ -188,3 +223,276 @@ class TestShare(TestCase):
         )
 
         self.assertEqual(self.organization.has_multiple_share_class, True)
+
+
+class TestOrganizationStats(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(
+            name="Agustin",
+            postal_code="S2300",
+            country="Norway",
+            orgnr=10,
+        )
+        self.organization_2 = Organization.objects.create(
+            name="Beaufort",
+            postal_code="S2300",
+            country="Sweden",
+            orgnr=11,
+        )
+        self.person = Person.objects.create(
+            name="Agustin",
+            postal_code="S2300",
+            country="Norway",
+        )
+        Share.objects.create(
+            person_owner=self.person, organization_owned=self.organization, amount=10, share_class="A-aksjer",
+        )
+        Share.objects.create(
+            person_owner=self.person, organization_owned=self.organization, amount=5, share_class="B-aksje",
+        )
+        Share.objects.create(
+            organization_owner=self.organization_2, organization_owned=self.organization, amount=5,
+            share_class="A-aksjer",
+        )
+        Share.objects.create(
+            organization_owner=self.organization, organization_owned=self.organization_2, amount=1,
+            share_class="A-aksjer",
+        )
+
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+
+    def test_with_stats(self):
+        with self.assertNumQueries(1):
+            organizations = {organization.pk: organization for organization in Organization.objects.with_stats()}
+
+            self.assertEqual(organizations[10].total_shares, 20)
+            self.assertEqual(organizations[10].number_of_owners, 2)
+            self.assertEqual(organizations[10].number_of_holdings, 1)
+            self.assertEqual(organizations[10].has_foreign_owners, True)
+            self.assertEqual(organizations[10].has_multiple_share_class, True)
+
+            self.assertEqual(organizations[11].total_shares, 1)
+            self.assertEqual(organizations[11].number_of_owners, 1)
+            self.assertEqual(organizations[11].number_of_holdings, 1)
+            self.assertEqual(organizations[11].has_foreign_owners, False)
+            self.assertEqual(organizations[11].has_multiple_share_class, False)
+
+    def test_with_stats_matches_properties(self):
+        organization = Organization.objects.with_stats().get(pk=10)
+        self.organization.refresh_from_db()
+
+        self.assertEqual(organization.total_shares, self.organization.total_shares)
+        self.assertEqual(organization.number_of_owners, self.organization.number_of_owners)
+        self.assertEqual(organization.number_of_holdings, self.organization.number_of_holdings)
+        self.assertEqual(organization.has_multiple_share_class, self.organization.has_multiple_share_class)
+
+
+class TestShareProjection(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        self.owner = Organization.objects.create(name="Another one", postal_code="S2300", country="Norway", orgnr=2)
+        self.person = Person.objects.create(name="Agustin", postal_code="S2300", country="Argentina")
+
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+
+    @staticmethod
+    def owners(orgnr):
+        owners = {"organizations_owner": [], "persons_owner": []}
+        for owner in ReadOnlyDB().find_organization_owners(orgnr):
+            owners["{}s_owner".format(owner["owner_type"])].append(owner)
+        return owners
+
+    def test_incremental_projection(self):
+        Share.objects.create(
+            person_owner=self.person, organization_owned=self.organization, amount=10, share_class="A-aksjer",
+        )
+        Share.objects.create(
+            person_owner=self.person, organization_owned=self.organization, amount=5, share_class="A-aksjer",
+        )
+        document = ReadOnlyDB().find_organization_element({"_id": 1})
+        self.assertEqual(document["total_shares"], 15)
+        self.assertEqual(document["number_of_owners"], 1)
+        self.assertEqual([owner["amount"] for owner in self.owners(1)["persons_owner"]], [15])
+        self.assertEqual(document["has_foreign_owners"], True)
+        self.assertEqual(document["has_multiple_share_class"], False)
+
+        Share.objects.create(
+            organization_owner=self.owner, organization_owned=self.organization, amount=5, share_class="B-aksje",
+        )
+        document = ReadOnlyDB().find_organization_element({"_id": 1})
+        self.assertEqual(document["total_shares"], 20)
+        self.assertEqual(document["number_of_owners"], 2)
+        self.assertEqual(document["has_multiple_share_class"], True)
+        self.assertEqual(self.owners(1)["organizations_owner"][0]["name"], "Another one")
+
+        document = ReadOnlyDB().find_organization_element({"_id": 2})
+        self.assertEqual(document["number_of_holdings"], 1)
+        self.assertEqual(self.owners(2)["organizations_owner"], [])
+
+    def test_incremental_projection_doesnt_query_aggregates(self):
+        share, = Share.objects.bulk_create([
+            Share(organization_owner=self.owner, organization_owned=self.organization, amount=5, share_class="B-aksje")
+        ])
+
+        # The owner's amount is loaded with the share, as in project_shares
+        share = with_positions(Share.objects.filter(pk=share.pk)).select_related(
+            "organization_owned", "organization_owner"
+        ).get()
+        with self.assertNumQueries(0):
+            share.save_in_ro_db()
+
+    @override_settings(CONCENTRATION={"TOP_OWNERS": 2, "FREE_FLOAT_THRESHOLD": 50})
+    def test_concentration(self):
+        other = Person.objects.create(name="Other", postal_code="S2300", country="Norway")
+        owners = [
+            ({"person_owner": self.person}, 10), ({"organization_owner": self.owner}, 5),
+            ({"person_owner": other}, 8), ({"person_owner": self.person}, 2),
+        ]
+        shares = [
+            Share.objects.create(organization_owned=self.organization, amount=amount, share_class="A-aksjer", **owner)
+            for owner, amount in owners
+        ]
+        read_only_db = ReadOnlyDB()
+        document = read_only_db.find_organization_element({"_id": 1})
+        self.assertEqual(document["owner_square_sum"], 12 ** 2 + 5 ** 2 + 8 ** 2)
+        self.assertEqual(
+            [(owner["key"], owner["amount"]) for owner in document["top_owners"]],
+            [("person:{}".format(self.person.pk), 12), ("person:{}".format(other.pk), 8)],
+        )
+
+        project_shares([share.pk for share in shares], recompute=True)
+        rebuilt = read_only_db.find_organization_element({"_id": 1})
+        self.assertEqual(rebuilt["owner_square_sum"], document["owner_square_sum"])
+        self.assertEqual(rebuilt["top_owners"], document["top_owners"])
+
+    def test_positions(self):
+        shares = [
+            Share.objects.create(
+                person_owner=self.person, organization_owned=self.organization, amount=amount, share_class=share_class,
+            )
+            for amount, share_class in ((10, "A-aksjer"), (5, "B-aksje"), (3, "A-aksjer"), (2, "A-aksjer"))
+        ]
+        self.assertEqual(
+            list(Position.objects.order_by("id").values_list("share_class", "amount", "shares")),
+            [("A-aksjer", 15, 3), ("B-aksje", 5, 1)],
+        )
+
+        read_only_db = ReadOnlyDB()
+        self.assertEqual(
+            [(owner["share_class"], owner["amount"]) for owner in self.owners(1)["persons_owner"]],
+            [("A-aksjer", 15), ("B-aksje", 5)],
+        )
+        holdings = read_only_db.find_holdings("person:{}".format(self.person.pk))
+        self.assertEqual([(holding["share_class"], holding["amount"]) for holding in holdings], [
+            ("A-aksjer", 15), ("B-aksje", 5),
+        ])
+        document = read_only_db.find_organization_element({"_id": 1})
+        self.assertEqual(document["share_class_totals"], {"A-aksjer": 15, "B-aksje": 5})
+
+        project_shares([share.pk for share in shares], recompute=True)
+        self.assertEqual(
+            [(owner["share_class"], owner["amount"]) for owner in self.owners(1)["persons_owner"]],
+            [("A-aksjer", 15), ("B-aksje", 5)],
+        )
+        self.assertEqual(
+            read_only_db.find_organization_element({"_id": 1})["share_class_totals"], {"A-aksjer": 15, "B-aksje": 5}
+        )
+
+    def test_project_shares(self):
+        shares = Share.objects.bulk_create([
+            Share(person_owner=self.person, organization_owned=self.organization, amount=10, share_class="A-aksjer"),
+            Share(
+                organization_owner=self.owner, organization_owned=self.organization, amount=5, share_class="A-aksjer",
+            ),
+        ])
+
+        self.assertEqual(project_shares([share.pk for share in shares]), 2)
+        project_shares([share.pk for share in shares], recompute=True)
+
+        document = ReadOnlyDB().find_organization_element({"_id": 1})
+        self.assertEqual(document["total_shares"], 15)
+        self.assertEqual(document["number_of_owners"], 2)
+        self.assertEqual(len(self.owners(1)["persons_owner"]), 1)
+
+    @override_settings(READ_ONLY_PROJECTION="full")
+    def test_full_projection(self):
+        Share.objects.create(
+            person_owner=self.person, organization_owned=self.organization, amount=10, share_class="A-aksjer",
+        )
+        Share.objects.create(
+            organization_owner=self.owner, organization_owned=self.organization, amount=5, share_class="B-aksje",
+        )
+
+        document = ReadOnlyDB().find_organization_element({"_id": 1})
+        self.assertEqual(document["total_shares"], 15)
+        self.assertEqual(document["number_of_owners"], 2)
+        self.assertEqual(document["has_multiple_share_class"], True)
+        self.assertEqual(document["share_class_totals"], {"A-aksjer": 10, "B-aksje": 5})
+        self.assertEqual(
+            [(owner["key"], owner["amount"]) for owner in document["top_owners"]],
+            [("person:{}".format(self.person.pk), 10), ("organization:2", 5)],
+        )
+        owners = self.owners(1)
+        self.assertEqual([owner["amount"] for owner in owners["persons_owner"]], [10])
+        self.assertEqual([owner["amount"] for owner in owners["organizations_owner"]], [5])
+        self.assertEqual(ReadOnlyDB().find_organization_element({"_id": 2})["number_of_holdings"], 1)
+        self.assertEqual(
+            [(holding["orgnr"], holding["amount"]) for holding in ReadOnlyDB().find_holdings("organization:2")],
+            [(1, 5)],
+        )
+
+    def test_recompute_increments_version(self):
+        share = Share.objects.create(
+            person_owner=self.person, organization_owned=self.organization, amount=10, share_class="A-aksjer",
+        )
+        self.assertEqual(ReadOnlyDB().find_organization_element({"_id": 1})["version"], 1)
+
+        project_shares([share.pk], recompute=True)
+        document = ReadOnlyDB().find_organization_element({"_id": 1})
+        self.assertEqual(document["version"], 2)
+        self.assertEqual(document["total_shares"], 10)
+
+    def test_replace_with_stale_version(self):
+        Share.objects.create(
+            person_owner=self.person, organization_owned=self.organization, amount=10, share_class="A-aksjer",
+        )
+        read_only_db = ReadOnlyDB()
+        document = read_only_db.find_organization_element({"_id": 1})
+
+        conflicts = read_only_db.replace_organizations([dict(document, total_shares=0)], {1: 0})
+        self.assertEqual(conflicts, {1})
+        self.assertEqual(read_only_db.find_organization_element({"_id": 1})["total_shares"], 10)
+
+    @override_settings(READ_ONLY_PARTITIONS=8)
+    def test_partition_of(self):
+        self.assertEqual(partition_of(1), partition_of(1))
+        self.assertTrue(all(0 <= partition_of(orgnr) < 8 for orgnr in range(100)))
+
+    @override_settings(READ_ONLY_OWNER_BUCKET_SIZE=2)
+    def test_owner_buckets(self):
+        people = [
+            Person.objects.create(name="Person {}".format(amount), postal_code="S2300", country="Norway")
+            for amount in (1, 2, 3, 4, 5)
+        ]
+        shares = [
+            Share.objects.create(
+                person_owner=person, organization_owned=self.organization, amount=amount, share_class="A-aksjer",
+            )
+            for person, amount in zip(people, (1, 2, 3, 4, 5))
+        ]
+        collection = ReadOnlyDB().database[ReadOnlyDB.owners_collection]
+        self.assertEqual([bucket["count"] for bucket in collection.find().sort("_id")], [2, 2, 1])
+        self.assertEqual([owner["amount"] for owner in self.owners(1)["persons_owner"]], [1, 2, 3, 4, 5])
+
+        project_shares([share.pk for share in shares], recompute=True)
+        self.assertEqual([bucket["count"] for bucket in collection.find().sort("_id")], [2, 2, 1])
+        self.assertEqual([owner["amount"] for owner in self.owners(1)["persons_owner"]], [1, 2, 3, 4, 5])
+        self.assertEqual(self.owners(1)["persons_owner"][4]["percentage"], 100 * 5 / 15)
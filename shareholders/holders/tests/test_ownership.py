@@ -0,0 +1,58 @@
+from django.test import TestCase
+
+from ..models import Organization, Person, Share
+from ..ownership import ultimate_owners
+from ..read_only import ReadOnlyDB
+
+
+class TestUltimateOwners(TestCase):
+    def setUp(self):
+        organizations = {
+            orgnr: Organization.objects.create(name=str(orgnr), postal_code="S2300", country="Norway", orgnr=orgnr)
+            for orgnr in (1, 2, 3)
+        }
+        self.person = Person.objects.create(name="Agustin", postal_code="S2300", country="Argentina")
+        self.other_person = Person.objects.create(name="Other", postal_code="S2300", country="Norway")
+
+        # 2 owns 60% of 1, and half of it is owned by 3, that is owned by 2
+        shares = [
+            (organizations[2], None, organizations[1], 40),
+            (organizations[2], None, organizations[1], 20),
+            (None, self.other_person, organizations[1], 40),
+            (None, self.person, organizations[2], 50),
+            (organizations[3], None, organizations[2], 50),
+            (organizations[2], None, organizations[3], 100),
+        ]
+        for organization_owner, person_owner, organization_owned, amount in shares:
+            Share.objects.create(
+                organization_owner=organization_owner, person_owner=person_owner,
+                organization_owned=organization_owned, amount=amount, share_class="A-aksjer",
+            )
+
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+
+    @staticmethod
+    def percentages(owners):
+        return {(owner["owner_type"], owner["id"]): round(owner["percentage"], 6) for owner in owners}
+
+    def test_ultimate_owners(self):
+        owners = ultimate_owners(1, max_depth=10, min_percentage=0)
+
+        # the cross holding of 2 and 3 is followed once
+        self.assertEqual(
+            self.percentages(owners), {("person", self.other_person.pk): 40, ("person", self.person.pk): 30}
+        )
+        self.assertEqual(owners[0]["name"], "Other")
+        self.assertEqual(owners[1]["depth"], 2)
+
+    def test_max_depth(self):
+        owners = ultimate_owners(1, max_depth=1, min_percentage=0)
+        self.assertEqual(self.percentages(owners), {("organization", 2): 60, ("person", self.other_person.pk): 40})
+
+    def test_min_percentage(self):
+        owners = ultimate_owners(1, max_depth=10, min_percentage=35)
+        self.assertEqual(self.percentages(owners), {("person", self.other_person.pk): 40})
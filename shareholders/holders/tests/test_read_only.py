@@ -1,8 +1,26 @@
 from django.test import TestCase
 
-from ..read_only import ReadOnlyDB
+from ..read_only import ReadOnlyDB, clients
 
 
 class TestReadOnlyDB(TestCase):
     def test_connect_to_read_only_db(self):
         ReadOnlyDB()
+
+    def test_client_is_shared(self):
+        self.assertIs(ReadOnlyDB().client, ReadOnlyDB().client)
+
+    def test_new_client_after_reset(self):
+        client = ReadOnlyDB().client
+        clients.reset()
+        self.assertIsNot(ReadOnlyDB().client, client)
+
+    def test_pool_stats(self):
+        rodb = ReadOnlyDB()
+        rodb.find_organization_element({"_id": 1})
+
+        stats = ReadOnlyDB.pool_stats()["default"]
+
+        self.assertGreaterEqual(stats["checkouts"], 1)
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertGreaterEqual(stats["max_wait_ms"], 0)
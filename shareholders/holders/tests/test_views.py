@@ -1,11 +1,16 @@
+import json
+import re
 from datetime import datetime
+from unittest.mock import patch
 
-from django.test import TestCase, Client
+from django.test import AsyncClient, TestCase, Client
 
 from rest_framework.status import HTTP_400_BAD_REQUEST, HTTP_201_CREATED
 
+from ..cache import VALIDATOR_FIELDS, organization_cache
 from ..models import Organization, Person, Share
 from ..read_only import ReadOnlyDB
+from .query_plans import QueryPlanTestMixin
 
 
 class TestOrganization(TestCase):
@@ -93,6 +98,9 @@ class TestShareOwner(TestCase):
     def tearDown(self):
         read_only_db = ReadOnlyDB()
         read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+        organization_cache.clear()
 
     def test_get_share_owners(self):
         organization_owned = Organization.objects.create(
@@ -135,15 +143,83 @@ class TestShareOwner(TestCase):
         self.assertEqual(response.json()["organizations_owner"][0]["name"], "Another one")
         self.assertEqual(response.json()["persons_owner"][0]["name"], "Agustin")
 
+        # a new share restates the percentages of the existing owners, and it is added to the position of its owner
+        data["amount"] = 9
+        self.client.post('/api/share/', data=data)
+        response = self.client.get('/api/1/owners')
+        self.assertEqual(response.json()["organizations_owner"][0]["percentage"], 33.333333333333336)
+        self.assertEqual(len(response.json()["persons_owner"]), 1)
+        self.assertEqual(response.json()["persons_owner"][0]["amount"], 20)
+        self.assertAlmostEqual(response.json()["persons_owner"][0]["percentage"], 100 * 20 / 30)
+
     def test_share_owners_not_found(self):
         response = self.client.get('/api/1/owners')
         self.assertEqual(response.status_code, 404)
 
+    def test_share_owners_pages(self):
+        organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        for orgnr in (2, 3, 4):
+            Share.objects.create(
+                organization_owner=Organization.objects.create(
+                    name="Owner {}".format(orgnr), postal_code="S2300", country="Norway", orgnr=orgnr,
+                ),
+                organization_owned=organization, amount=orgnr, share_class="A-aksjer",
+            )
+
+        response = self.client.get('/api/1/owners', {"limit": 2})
+        self.assertEqual([owner["_id"] for owner in response.json()["organizations_owner"]], [2, 3])
+        url, = re.match(r'<(.*)>; rel="next"', response["Link"]).groups()
+
+        response = self.client.get(url)
+        self.assertEqual([owner["_id"] for owner in response.json()["organizations_owner"]], [4])
+        self.assertNotIn("Link", response)
+
+        self.assertEqual(self.client.get('/api/1/owners', {"after": "x"}).status_code, HTTP_400_BAD_REQUEST)
+
+    def test_share_owners_pages_are_stable(self):
+        organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+
+        def add_owner(**owner):
+            Share.objects.create(organization_owned=organization, amount=1, share_class="A-aksjer", **owner)
+
+        add_owner(organization_owner=Organization.objects.create(
+            name="Owner", postal_code="S2300", country="Norway", orgnr=2,
+        ))
+        for name in ("A", "B"):
+            add_owner(person_owner=Person.objects.create(name=name, postal_code="S2300", country="Norway"))
+
+        response = self.client.get('/api/1/owners', {"limit": 2})
+        self.assertEqual([owner["name"] for owner in response.json()["persons_owner"]], ["A"])
+        url, = re.match(r'<(.*)>; rel="next"', response["Link"]).groups()
+
+        # a new organization owner in the same bucket doesn't move the persons after the cursor
+        add_owner(organization_owner=Organization.objects.create(
+            name="Other", postal_code="S2300", country="Norway", orgnr=3,
+        ))
+        response = self.client.get(url)
+        self.assertEqual(response.json()["organizations_owner"], [])
+        self.assertEqual([owner["name"] for owner in response.json()["persons_owner"]], ["B"])
+
+    def test_share_owners_ndjson(self):
+        organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        person = Person.objects.create(name="Agustin", postal_code="S2300", country="Argentina")
+        Share.objects.create(person_owner=person, organization_owned=organization, amount=10, share_class="A-aksjer")
+
+        response = self.client.get('/api/1/owners', HTTP_ACCEPT="application/x-ndjson")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        owner, = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual(owner["name"], "Agustin")
+        self.assertEqual(owner["owner_type"], "person")
+        self.assertEqual(owner["percentage"], 100)
+
 
 class TestShareHolding(TestCase):
     def tearDown(self):
         read_only_db = ReadOnlyDB()
         read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+        organization_cache.clear()
 
     def test_get_share_holding(self):
         organization_owned_1 = Organization.objects.create(
@@ -187,6 +263,20 @@ class TestShareHolding(TestCase):
         response = self.client.get('/api/4/holding')
         self.assertEqual(response.json()[0]["name"], "Beaufort")
         self.assertEqual(response.json()[1]["name"], "Beaufort 2")
+        self.assertEqual(response.json()[1], {
+            "orgnr": 2, "name": "Beaufort 2", "share_class": "A-aksjer", "amount": 12, "percentage": 100,
+        })
+
+        response = self.client.get('/api/4/holding', {"limit": 1})
+        self.assertEqual([holding["orgnr"] for holding in response.json()], [1])
+        url, = re.match(r'<(.*)>; rel="next"', response["Link"]).groups()
+        self.assertEqual([holding["orgnr"] for holding in self.client.get(url).json()], [2])
+
+        response = self.client.get('/api/4/holding', {"after": 0}, HTTP_ACCEPT="application/x-ndjson")
+        holdings = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual(holdings, [{
+            "orgnr": 2, "name": "Beaufort 2", "share_class": "A-aksjer", "amount": 12, "percentage": 100, "cursor": "1",
+        }])
 
     def test_share_holding_not_found(self):
         response = self.client.get('/api/1/holding')
@@ -197,6 +287,9 @@ class TestSummary(TestCase):
     def tearDown(self):
         read_only_db = ReadOnlyDB()
         read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+        organization_cache.clear()
 
     def test_get_summary(self):
         organization_1 = Organization.objects.create(
@@ -258,7 +351,347 @@ class TestSummary(TestCase):
         self.assertEqual(response.json()["number_of_holdings"], 0)
         self.assertEqual(response.json()["has_foreign_owners"], True)
         self.assertEqual(response.json()["has_multiple_share_class"], True)
+        self.assertEqual(response.json()["share_class_totals"], {"A-aksjer": 22, "B-aksje": 12})
+
+    def test_summary_not_modified(self):
+        organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        person = Person.objects.create(name="Agustin", postal_code="S2300", country="Argentina")
+        Share.objects.create(person_owner=person, organization_owned=organization, amount=10, share_class="A-aksjer")
+
+        response = self.client.get('/api/1/summary')
+        self.assertIn("Last-Modified", response)
+        etag = response["ETag"]
+
+        response = self.client.get('/api/1/summary', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        Share.objects.create(person_owner=person, organization_owned=organization, amount=5, share_class="A-aksjer")
+        response = self.client.get('/api/1/summary', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+        response = self.client.get('/api/1/owners', HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_not_modified_without_cache_reads_the_validators(self):
+        organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        person = Person.objects.create(name="Agustin", postal_code="S2300", country="Argentina")
+        Share.objects.create(person_owner=person, organization_owned=organization, amount=10, share_class="A-aksjer")
+        etag = self.client.get('/api/1/summary')["ETag"]
+
+        with patch.object(organization_cache, "max_size", 0), \
+                patch.object(ReadOnlyDB, "find_organization_element_fields",
+                             autospec=True, side_effect=ReadOnlyDB.find_organization_element_fields) as find:
+            response = self.client.get('/api/1/summary', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        find.assert_called_once_with(find.call_args[0][0], 1, VALIDATOR_FIELDS)
 
     def test_summary_not_found(self):
         response = self.client.get('/api/1/summary')
         self.assertEqual(response.status_code, 404)
+
+    def test_concentration(self):
+        organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        owner = Organization.objects.create(name="Holding", postal_code="S2300", country="Norway", orgnr=2)
+        people = [
+            Person.objects.create(name="Person {}".format(i), postal_code="S2300", country="Norway") for i in range(3)
+        ]
+        owners = [({"person_owner": person}, amount) for person, amount in zip(people, (20, 4, 6))]
+        for owner_field, amount in owners + [({"organization_owner": owner}, 70)]:
+            Share.objects.create(organization_owned=organization, amount=amount, share_class="A-aksjer", **owner_field)
+
+        summary = self.client.get('/api/1/summary').json()
+        self.assertEqual(summary["largest_owner_percentage"], 70)
+        self.assertEqual(summary["top_5_owners_percentage"], 100)
+        self.assertAlmostEqual(summary["hhi"], 70 ** 2 + 20 ** 2 + 4 ** 2 + 6 ** 2)
+        self.assertAlmostEqual(summary["free_float_percentage"], 4)
+
+        response = self.client.get('/api/1/top-owners', {"n": 2})
+        self.assertEqual(response.json()["owners"], [
+            {"owner_type": "organization", "id": 2, "name": "Holding", "amount": 70, "percentage": 70},
+            {"owner_type": "person", "id": people[0].pk, "name": "Person 0", "amount": 20, "percentage": 20},
+        ])
+        response = self.client.get('/api/1/top-owners', HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+        self.assertIsNone(self.client.get('/api/2/summary').json()["hhi"])
+        self.assertEqual(self.client.get('/api/1/top-owners', {"n": 0}).status_code, HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/3/top-owners').status_code, 404)
+
+    def test_batch_summary(self):
+        organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        owner = Organization.objects.create(name="Another one", postal_code="S2300", country="Argentina", orgnr=2)
+        Share.objects.create(organization_owner=owner, organization_owned=organization, amount=1, share_class="B-aksje")
+
+        response = self.client.get('/api/summary', {"orgnr": "1,2,99"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["organizations"]["1"], self.client.get('/api/1/summary').json())
+        self.assertEqual(response.json()["organizations"]["2"]["number_of_holdings"], 1)
+        self.assertEqual(response.json()["missing"], [99])
+
+        response = self.client.post('/api/summary', {"orgnr": [2, 99, 100]}, content_type="application/json")
+        self.assertEqual(list(response.json()["organizations"]), ["2"])
+        self.assertEqual(response.json()["missing"], [99, 100])
+
+    def test_batch_summary_bad_request(self):
+        self.assertEqual(self.client.get('/api/summary', {"orgnr": "1,a"}).status_code, HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/summary').status_code, HTTP_400_BAD_REQUEST)
+        response = self.client.post('/api/summary', {"orgnr": 1}, content_type="application/json")
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
+
+
+class TestUltimateOwners(TestCase):
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+        read_only_db.database.drop_collection(read_only_db.ultimate_owners_collection)
+
+    def test_get_ultimate_owners(self):
+        organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        holding = Organization.objects.create(name="Holding", postal_code="S2300", country="Norway", orgnr=2)
+        person = Person.objects.create(name="Agustin", postal_code="S2300", country="Argentina")
+        Share.objects.create(
+            organization_owner=holding, organization_owned=organization, amount=10, share_class="A-aksjer"
+        )
+        Share.objects.create(person_owner=person, organization_owned=holding, amount=10, share_class="A-aksjer")
+
+        response = self.client.get('/api/1/ultimate-owners')
+        self.assertEqual(response.json()["owners"], [{
+            "owner_type": "person", "id": person.pk, "name": "Agustin", "country": "Argentina", "percentage": 100,
+            "depth": 2,
+        }])
+
+        response = self.client.get('/api/1/ultimate-owners', {"max_depth": 1})
+        self.assertEqual(response.json()["owners"][0]["owner_type"], "organization")
+
+    def test_ultimate_owners_bad_request(self):
+        Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        self.assertEqual(self.client.get('/api/1/ultimate-owners', {"max_depth": 0}).status_code, 400)
+        self.assertEqual(self.client.get('/api/1/ultimate-owners', {"min_percentage": "a"}).status_code, 400)
+
+    def test_ultimate_owners_not_found(self):
+        response = self.client.get('/api/1/ultimate-owners')
+        self.assertEqual(response.status_code, 404)
+
+
+class TestLeaderboard(TestCase):
+    def setUp(self):
+        # other tests leave their owners in the leaderboards
+        self.tearDown()
+
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        for collection in (
+            read_only_db.organization_collection, read_only_db.holdings_collection, read_only_db.owners_collection,
+            read_only_db.owner_stats_collection, read_only_db.leaderboard_collection,
+        ):
+            read_only_db.database.drop_collection(collection)
+        organization_cache.clear()
+
+    def leaderboard(self, metric):
+        response = self.client.get('/api/leaderboard/{}'.format(metric))
+        return [(owner["owner_type"], owner["id"], owner["value"]) for owner in response.json()["owners"]]
+
+    def test_leaderboard(self):
+        for orgnr in (1, 2):
+            Organization.objects.create(name="Company", postal_code="S2300", country="Norway", orgnr=orgnr)
+        holding = Organization.objects.create(name="Holding", postal_code="S2300", country="Norway", orgnr=10)
+        person = Person.objects.create(name="Agustin", postal_code="S2300", country="Norway")
+        for owner, owned, amount in (
+            ({"organization_owner": holding}, 1, 60), ({"person_owner": person}, 2, 30),
+            ({"organization_owner": holding}, 2, 10), ({"person_owner": person}, 1, 40),
+        ):
+            Share.objects.create(organization_owned_id=owned, amount=amount, share_class="A-aksjer", **owner)
+
+        self.assertEqual(self.leaderboard("holdings"), [("organization", 10, 2), ("person", person.pk, 2)])
+        self.assertEqual(self.leaderboard("shares"), [("organization", 10, 70), ("person", person.pk, 70)])
+        self.assertEqual(self.leaderboard("controlled"), [("organization", 10, 1), ("person", person.pk, 1)])
+
+        # the person gets the majority of the organization 1
+        Share.objects.create(person_owner=person, organization_owned_id=1, amount=30, share_class="B-aksje")
+        self.assertEqual(self.leaderboard("controlled"), [("person", person.pk, 2)])
+        self.assertEqual(self.leaderboard("shares"), [("person", person.pk, 100), ("organization", 10, 70)])
+        self.assertEqual(self.leaderboard("holdings"), [("organization", 10, 2), ("person", person.pk, 2)])
+
+        response = self.client.get('/api/leaderboard/shares', {"limit": 1})
+        self.assertEqual(response.json()["owners"], [
+            {"owner_type": "person", "id": person.pk, "name": "Agustin", "value": 100},
+        ])
+        self.assertEqual(self.client.get('/api/leaderboard/shares', {"limit": 0}).status_code, HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/leaderboard/names').status_code, 404)
+
+        # a share without amount starts a holding too, the next ones don't
+        other = Person.objects.create(name="Other", postal_code="S2300", country="Norway")
+        for amount in (0, 5):
+            Share.objects.create(person_owner=other, organization_owned_id=2, amount=amount, share_class="A-aksjer")
+        self.assertIn(("person", other.pk, 1), self.leaderboard("holdings"))
+
+
+class TestAsyncViews(TestCase):
+    def setUp(self):
+        organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        owner = Organization.objects.create(name="Another one", postal_code="S2300", country="Argentina", orgnr=2)
+        person = Person.objects.create(name="Agustin", postal_code="S2300", country="Argentina")
+        Share.objects.create(person_owner=person, organization_owned=organization, amount=10, share_class="A-aksjer")
+        Share.objects.create(organization_owner=owner, organization_owned=organization, amount=3, share_class="B-aksje")
+        paths = ["/api/1/owners", "/api/2/holding", "/api/1/summary"]
+        self.sync_responses = {path: self.client.get(path, {"limit": 1}) for path in paths}
+
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+        organization_cache.clear()
+
+    async def test_same_responses_as_sync_views(self):
+        client = AsyncClient()
+        for path, expected in self.sync_responses.items():
+            response = await client.get(path.replace("/api/", "/api/async/"), {"limit": 1})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), expected.json())
+            self.assertEqual(response.get("ETag"), expected.get("ETag"))
+            self.assertEqual(bool(response.get("Link")), bool(expected.get("Link")))
+
+    async def test_async_not_modified(self):
+        client = AsyncClient()
+        etag = self.sync_responses["/api/1/summary"]["ETag"]
+        response = await client.get("/api/async/1/summary", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    async def test_async_not_found(self):
+        client = AsyncClient()
+        for path in ("/api/async/3/owners", "/api/async/3/holding", "/api/async/3/summary"):
+            response = await client.get(path)
+            self.assertEqual(response.status_code, 404)
+
+
+class TestReadOnlyCacheStats(TestCase):
+    def test_get_cache_stats(self):
+        response = self.client.get('/api/read-only/cache')
+        self.assertEqual(
+            set(response.json()),
+            {"size", "max_size", "hits", "misses", "coalesced", "evictions", "invalidations"},
+        )
+
+
+class TestReadOnlyPoolStats(TestCase):
+    def test_get_pool_stats(self):
+        ReadOnlyDB().find_organization_element({"_id": 1})
+
+        response = self.client.get('/api/read-only/stats')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("checkouts", response.json()["default"])
+
+
+class TestBulkShare(TestCase):
+    def setUp(self):
+        self.organization = Organization.objects.create(
+            name="Agustin",
+            postal_code="S2300",
+            country="Argentina",
+            orgnr=10,
+        )
+        self.person = Person.objects.create(
+            name="Agustin",
+            postal_code="S2300",
+            country="Argentina",
+        )
+
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+        organization_cache.clear()
+
+    def test_create_shares(self):
+        data = [
+            {
+                "organization_owner": self.organization.orgnr,
+                "organization_owned": self.organization.orgnr,
+                "share_class": "A-aksjer",
+                "amount": 10,
+            },
+            {
+                "person_owner": self.person.id,
+                "organization_owned": self.organization.orgnr,
+                "share_class": "B-aksje",
+                "amount": 5,
+            },
+        ]
+        response = self.client.post('/api/share/bulk/', data=data, content_type="application/json")
+
+        self.assertEqual(response.status_code, HTTP_201_CREATED)
+        self.assertEqual(response.json()["created"], 2)
+        self.assertEqual(Share.objects.count(), 2)
+        self.assertEqual(ReadOnlyDB().find_organization_element({"_id": 10})["total_shares"], 15)
+
+    def test_create_shares_ndjson(self):
+        data = (
+            '{"person_owner": %d, "organization_owned": 10, "share_class": "A-aksjer", "amount": 1}\n'
+            '{"person_owner": %d, "organization_owned": 10, "share_class": "A-aksjer", "amount": 2}\n'
+        ) % (self.person.id, self.person.id)
+        response = self.client.post('/api/share/bulk/', data=data, content_type="application/x-ndjson")
+
+        self.assertEqual(response.status_code, HTTP_201_CREATED)
+        self.assertEqual(Share.objects.count(), 2)
+
+    def test_create_shares_unknown_reference(self):
+        data = [
+            {"person_owner": self.person.id, "organization_owned": 10, "share_class": "A-aksjer", "amount": 1},
+            {"person_owner": self.person.id, "organization_owned": 99, "share_class": "A-aksjer", "amount": 1},
+        ]
+        response = self.client.post('/api/share/bulk/', data=data, content_type="application/json")
+
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()[0], {})
+        self.assertIn("organization_owned", response.json()[1])
+        self.assertEqual(Share.objects.count(), 0)
+
+    def test_create_shares_two_owners(self):
+        data = [{
+            "person_owner": self.person.id,
+            "organization_owner": 10,
+            "organization_owned": 10,
+            "share_class": "A-aksjer",
+        }]
+        response = self.client.post('/api/share/bulk/', data=data, content_type="application/json")
+
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
+
+
+class TestQueryPlans(QueryPlanTestMixin, TestCase):
+    def setUp(self):
+        organization = Organization.objects.create(name="Beaufort", postal_code="S2300", country="Norway", orgnr=1)
+        owner = Organization.objects.create(name="Another one", postal_code="S2300", country="Norway", orgnr=2)
+        person = Person.objects.create(name="Agustin", postal_code="S2300", country="Argentina")
+        Share.objects.create(
+            organization_owner=owner, organization_owned=organization, amount=10, share_class="A-aksjer",
+        )
+        Share.objects.create(person_owner=person, organization_owned=organization, amount=5, share_class="B-aksje")
+        ReadOnlyDB().ensure_indexes()
+
+    def tearDown(self):
+        read_only_db = ReadOnlyDB()
+        read_only_db.database.drop_collection(read_only_db.organization_collection)
+        read_only_db.database.drop_collection(read_only_db.holdings_collection)
+        read_only_db.database.drop_collection(read_only_db.owners_collection)
+        organization_cache.clear()
+
+    def test_views_use_indexes(self):
+        with self.assertNoCollectionScans():
+            self.client.get('/api/1/owners')
+            self.client.get('/api/2/holding')
+            self.client.get('/api/1/summary')
+
+    def test_owner_lookup_uses_index(self):
+        with self.assertNoCollectionScans():
+            rodb = ReadOnlyDB()
+            list(rodb.database[rodb.owners_collection].find({"organizations_owner._id": 2}))
+            list(ReadOnlyDB().find_organizations_element({"country": "Norway"}))
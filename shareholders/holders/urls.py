@@ -1,12 +1,25 @@
 from django.urls import path
 
+from . import async_views
+
 from .views import (
     OrganizationViewSet,
     PersonViewSet,
     ShareViewSet,
+    BulkShareViewSet,
     ShareOwnersViewSet,
     ShareHoldingViewSet,
-    OrganizationSummaryViewSet
+    OrganizationSummaryViewSet,
+    BatchSummaryViewSet,
+    TopOwnersViewSet,
+    UltimateOwnersViewSet,
+    GraphDownstreamViewSet,
+    GraphUpstreamViewSet,
+    GraphPathViewSet,
+    GraphStatsViewSet,
+    LeaderboardViewSet,
+    ReadOnlyPoolStatsViewSet,
+    ReadOnlyCacheStatsViewSet,
 )
 
 
@@ -14,7 +27,21 @@ urlpatterns = [
     path('organization/', OrganizationViewSet.as_view()),
     path('person/', PersonViewSet.as_view()),
     path('share/', ShareViewSet.as_view()),
+    path('share/bulk/', BulkShareViewSet.as_view()),
     path('<int:orgnr>/owners', ShareOwnersViewSet.as_view()),
     path('<int:orgnr>/holding', ShareHoldingViewSet.as_view()),
     path('<int:orgnr>/summary', OrganizationSummaryViewSet.as_view()),
+    path('<int:orgnr>/top-owners', TopOwnersViewSet.as_view()),
+    path('<int:orgnr>/ultimate-owners', UltimateOwnersViewSet.as_view()),
+    path('<int:orgnr>/graph/downstream', GraphDownstreamViewSet.as_view()),
+    path('<int:orgnr>/graph/upstream', GraphUpstreamViewSet.as_view()),
+    path('graph/path', GraphPathViewSet.as_view()),
+    path('graph/stats', GraphStatsViewSet.as_view()),
+    path('summary', BatchSummaryViewSet.as_view()),
+    path('leaderboard/<str:metric>', LeaderboardViewSet.as_view()),
+    path('async/<int:orgnr>/owners', async_views.share_owners),
+    path('async/<int:orgnr>/holding', async_views.share_holding),
+    path('async/<int:orgnr>/summary', async_views.organization_summary),
+    path('read-only/stats', ReadOnlyPoolStatsViewSet.as_view()),
+    path('read-only/cache', ReadOnlyCacheStatsViewSet.as_view()),
 ]
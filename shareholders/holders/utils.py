@@ -1,14 +1,26 @@
+from datetime import date, datetime
 from typing import Dict, Any
 
 from django.db import models
 
 
+def read_only_value(value: Any) -> Any:
+    """
+    BSON doesn't support dates without time
+    """
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+    return value
+
+
 def prepare_data_for_read_only_db(instance: models.Model) -> Dict[str, Any]:
     """
     Transform the data from django ORM object to python dict in order to save it into read only db.
     """
-    data = instance.__dict__.copy()
-    del data["_state"]
+    data = {
+        field.attname: read_only_value(getattr(instance, field.attname))
+        for field in instance._meta.concrete_fields
+        if not field.primary_key  # the original pk for write only database is saved as _id
+    }
     data["_id"] = instance.pk
-    del data[instance._meta.pk.name]  # delete the original pk for write only database
     return data
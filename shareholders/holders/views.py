@@ -1,11 +1,34 @@
-from django.http import JsonResponse
+import json
+from datetime import datetime, timezone
+from typing import Tuple
+from urllib.parse import urlencode
 
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework.status import HTTP_201_CREATED, HTTP_404_NOT_FOUND
+from rest_framework.status import HTTP_201_CREATED, HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND
 
-from .serializers import OrganizationSerializer, PersonSerializer, ShareSerializer
-from .read_only import ReadOnlyDB
+from .cache import cached_organization, organization_cache, organization_validator_fields
+from .concentration import concentration_metrics, top_owners
+from .graph import get_ownership_graph, node_key
+from .leaderboard import METRICS
+from .models import Organization
+from .ownership import ultimate_owners
+from .parsers import NDJSONParser
+from .projection import OWNER_LISTS
+from .renderers import NDJSONRenderer
+from .serializers import BulkShareSerializer, OrganizationSerializer, PersonSerializer, ShareSerializer
+from .read_only import GROUP_FIELDS, ReadOnlyDB
+from .signals import save_shares_in_read_only_db
 
 
 class OrganizationViewSet(APIView):
@@ -41,54 +64,496 @@ class ShareViewSet(APIView):
             return JsonResponse(serializer.data, status=HTTP_201_CREATED)
 
 
+class BulkShareViewSet(APIView):
+    """
+    Add a list of shares to the database, as a JSON array or as NDJSON (one share per line)
+    """
+    parser_classes = [JSONParser, NDJSONParser]
+
+    def post(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return JsonResponse({"detail": "Expected a list of shares."}, status=HTTP_400_BAD_REQUEST)
+
+        serializer = BulkShareSerializer(data=request.data, many=True)
+        if serializer.is_valid(raise_exception=True):
+            shares = serializer.save()
+            save_shares_in_read_only_db(shares)
+            return JsonResponse(
+                {"created": len(shares), "ids": [share.pk for share in shares]},
+                status=HTTP_201_CREATED,
+            )
+
+
+def page_limit(request, streaming: bool):
+    """
+    Max entries of the page, from the limit parameter. A page has READ_ONLY_PAGE_SIZE entries by default, a stream
+    has no limit.
+    """
+    limit = request.GET.get("limit")
+    if limit is None:
+        return None if streaming else settings.READ_ONLY_PAGE_SIZE
+    limit = int(limit)
+    if not 0 < limit <= settings.READ_ONLY_MAX_PAGE_SIZE:
+        raise ValueError("limit must be between 1 and {}".format(settings.READ_ONLY_MAX_PAGE_SIZE))
+    return limit
+
+
+def paginate(entries, limit: int, cursor_of):
+    """
+    Read the page from the entries, that have one more entry when there is a next page, and return it with the
+    cursor of its last entry if there is a next page.
+    """
+    page = []
+    cursor = None
+    for entry in entries:
+        if len(page) == limit:
+            return page, cursor
+        cursor = cursor_of(entry)
+        page.append(entry)
+    return page, None
+
+
+def owner_after(after: str):
+    """
+    Bucket, owner type and position of the owners cursor
+    """
+    if after is None:
+        return None
+    bucket, owner_type, position = after.split("-")
+    if owner_type not in OWNER_LISTS:
+        raise ValueError("Unknown owner type {}".format(owner_type))
+    return ObjectId(bucket), owner_type, int(position)
+
+
+def holding_after(after: str):
+    return int(after) if after is not None else None
+
+
+def group_owners(page) -> dict:
+    data = {"organizations_owner": [], "persons_owner": []}
+    for owner in page:
+        data["{}s_owner".format(owner.pop("owner_type"))].append(owner)
+    return data
+
+
+def paginated_response(request, data, cursor: str, limit: int) -> JsonResponse:
+    response = JsonResponse(data, safe=False)
+    if cursor is not None:
+        url = request.build_absolute_uri(request.path)
+        response["Link"] = '<{}?{}>; rel="next"'.format(url, urlencode({"after": cursor, "limit": limit}))
+    return response
+
+
+def organization_validators(organization, variant: str = "") -> dict:
+    """
+    ETag and Last-Modified of the responses built from the organization document, from its version and the time it
+    was updated, that change whenever a share of the organization is saved in the read-only database.
+    """
+    if not organization.get("updated_at"):
+        return {}
+    timestamp = organization["updated_at"].replace(tzinfo=timezone.utc).timestamp()
+    return {
+        "etag": '"{}-{}{}"'.format(organization.get("version") or 0, int(timestamp * 1000), variant),
+        "last_modified": int(timestamp),
+    }
+
+
+def not_modified_response(request, validators):
+    """
+    304 response if the client has the current version (If-None-Match or If-Modified-Since), otherwise None
+    """
+    response = get_conditional_response(request, **validators) if validators else None
+    return with_validators(response, validators) if response is not None else None
+
+
+def is_conditional(request) -> bool:
+    return "HTTP_IF_NONE_MATCH" in request.META or "HTTP_IF_MODIFIED_SINCE" in request.META
+
+
+def not_modified_organization(request, organization, variant: str = ""):
+    """
+    304 response if the client has the current version of the organization (its version and updated_at), otherwise
+    None
+    """
+    if organization is None:
+        return None
+    return not_modified_response(request, organization_validators(organization, variant))
+
+
+def with_validators(response, validators):
+    if validators:
+        response["ETag"] = validators["etag"]
+        response["Last-Modified"] = http_date(validators["last_modified"])
+    return response
+
+
+def ndjson_response(entries) -> StreamingHttpResponse:
+    """
+    Stream the entries while they are read from the cursor, one JSON object per line
+    """
+    lines = (json.dumps(entry, cls=DjangoJSONEncoder) + "\n" for entry in entries)
+    return StreamingHttpResponse(lines, content_type=NDJSONRenderer.media_type)
+
+
 class ShareOwnersViewSet(APIView):
     """
-    Get information about the owners of the organization
+    Get information about the owners of the organization.
+
+    The owners are paginated with the after (cursor of the last owner of the previous page, that is sent in the Link
+    header) and limit parameters, or streamed as NDJSON (Accept: application/x-ndjson) with the cursor of every owner.
+    The responses have an ETag, so polling clients get a 304 without reading the owners if nothing changed.
     """
+    renderer_classes = [JSONRenderer, NDJSONRenderer]
+
+    @staticmethod
+    def owner_cursor(owner) -> str:
+        return "{}-{}-{}".format(owner.pop("bucket"), owner["owner_type"], owner.pop("position"))
+
     def get(self, request, orgnr):
-        rodb = ReadOnlyDB()
-        data = rodb.find_organization_element({"_id": orgnr})
+        streaming = request.accepted_renderer.format == NDJSONRenderer.format
+        try:
+            limit = page_limit(request, streaming)
+            after = owner_after(request.query_params.get("after"))
+        except (InvalidId, ValueError) as exc:
+            return JsonResponse({"detail": "Invalid page: {}".format(exc)}, status=HTTP_400_BAD_REQUEST)
 
-        if not data:
+        variant = "-ndjson" if streaming else ""
+        if is_conditional(request):
+            response = not_modified_organization(request, organization_validator_fields(orgnr), variant)
+            if response is not None:
+                patch_vary_headers(response, ["Accept"])
+                return response
+
+        organization = cached_organization(orgnr)
+        if organization is None:
             return Response(status=HTTP_404_NOT_FOUND)
 
-        else:
-            return JsonResponse(
-                {
-                    "organizations_owner": data["organizations_owner"],
-                    "persons_owner": data["persons_owner"]
-                }
+        validators = organization_validators(organization, variant)
+        response = not_modified_response(request, validators)
+        if response is None:
+            owners = ReadOnlyDB().find_organization_owners(
+                orgnr, after=after, limit=limit if streaming else limit + 1, total_shares=organization["total_shares"]
             )
+            if streaming:
+                response = ndjson_response(dict(owner, cursor=self.owner_cursor(owner)) for owner in owners)
+            else:
+                page, cursor = paginate(owners, limit, self.owner_cursor)
+                response = paginated_response(request, group_owners(page), cursor, limit)
+
+        patch_vary_headers(response, ["Accept"])
+        return with_validators(response, validators)
 
 
 class ShareHoldingViewSet(APIView):
     """
-    Get information about the shares that the organization bought
+    Get information about the shares that the organization bought, paginated with the after (position of the last
+    holding of the previous page, that is sent in the Link header) and limit parameters, or streamed as NDJSON.
     """
+    renderer_classes = [JSONRenderer, NDJSONRenderer]
+
+    @staticmethod
+    def holding_cursor(holding) -> str:
+        return str(holding.pop("position"))
+
     def get(self, request, orgnr):
-        rodb = ReadOnlyDB()
-        data = [x for x in rodb.find_organizations_element({"organizations_owner": {"$elemMatch": {"_id": orgnr}}})]
+        streaming = request.accepted_renderer.format == NDJSONRenderer.format
+        try:
+            limit = page_limit(request, streaming)
+            after = holding_after(request.query_params.get("after"))
+        except ValueError as exc:
+            return JsonResponse({"detail": "Invalid page: {}".format(exc)}, status=HTTP_400_BAD_REQUEST)
 
-        if not data:
+        rodb = ReadOnlyDB()
+        owner_key = "organization:{}".format(orgnr)
+        if not rodb.holdings_exist(owner_key):
             return Response(status=HTTP_404_NOT_FOUND)
+
+        holdings = rodb.find_holdings(owner_key, after=after, limit=limit if streaming else limit + 1)
+        if streaming:
+            return ndjson_response(dict(holding, cursor=self.holding_cursor(holding)) for holding in holdings)
+
         else:
-            return JsonResponse(data, safe=False)
+            page, cursor = paginate(holdings, limit, self.holding_cursor)
+            return paginated_response(request, page, cursor, limit)
 
 
 class OrganizationSummaryViewSet(APIView):
     """
-    Organization's summary
+    Organization's summary, with its ownership concentration, with an ETag and Last-Modified for conditional
+    requests
     """
+    fields = ["number_of_owners", "number_of_holdings", "has_foreign_owners", "has_multiple_share_class"]
+    group_fields = ["group_id", "parent_company", "in_cross_holding"]
+    concentration_fields = ["total_shares", "share_class_totals", "top_owners", "owner_square_sum"]
+
+    @classmethod
+    def summary(cls, organization) -> dict:
+        data = {field: organization[field] for field in cls.fields}
+        data.update({field: organization.get(field, GROUP_FIELDS[field]) for field in cls.group_fields})
+        data["share_class_totals"] = organization.get("share_class_totals", {})
+        data.update(concentration_metrics(organization))
+        return data
+
     def get(self, request, orgnr):
-        rodb = ReadOnlyDB()
-        data = rodb.find_organization_element({"_id": orgnr})
+        if is_conditional(request):
+            response = not_modified_organization(request, organization_validator_fields(orgnr))
+            if response is not None:
+                return response
+
+        data = cached_organization(orgnr)
 
         if not data:
             return Response(status=HTTP_404_NOT_FOUND)
         else:
-            return JsonResponse({
-                "number_of_owners": data["number_of_owners"],
-                "number_of_holdings": data["number_of_holdings"],
-                "has_foreign_owners": data["has_foreign_owners"],
-                "has_multiple_share_class": data["has_multiple_share_class"],
+            validators = organization_validators(data)
+            response = not_modified_response(request, validators)
+            if response is None:
+                response = JsonResponse(self.summary(data))
+            return with_validators(response, validators)
+
+
+class BatchSummaryViewSet(APIView):
+    """
+    Summaries of many organizations in one request: GET with ?orgnr=1,2,3 or POST with {"orgnr": [1, 2, 3]} for
+    long lists. They are read with one query, the organizations that don't exist are listed in "missing".
+    """
+    def get(self, request):
+        values = [value for param in request.query_params.getlist("orgnr") for value in param.split(",") if value]
+        return self.summaries(values)
+
+    def post(self, request):
+        values = request.data.get("orgnr") if isinstance(request.data, dict) else None
+        if not isinstance(values, list):
+            return JsonResponse({"detail": "Expected a list of orgnr."}, status=HTTP_400_BAD_REQUEST)
+        return self.summaries(values)
+
+    def summaries(self, values) -> JsonResponse:
+        try:
+            orgnrs = list(dict.fromkeys(int(value) for value in values))
+        except (TypeError, ValueError):
+            return JsonResponse({"detail": "Every orgnr must be an integer."}, status=HTTP_400_BAD_REQUEST)
+        if not 0 < len(orgnrs) <= settings.READ_ONLY_MAX_BATCH_SIZE:
+            return JsonResponse(
+                {"detail": "Expected between 1 and {} orgnr.".format(settings.READ_ONLY_MAX_BATCH_SIZE)},
+                status=HTTP_400_BAD_REQUEST,
+            )
+
+        organizations = ReadOnlyDB().find_organizations_fields(
+            orgnrs,
+            OrganizationSummaryViewSet.fields + OrganizationSummaryViewSet.group_fields +
+            OrganizationSummaryViewSet.concentration_fields,
+        )
+        return JsonResponse({
+            "organizations": {
+                orgnr: OrganizationSummaryViewSet.summary(organizations[orgnr])
+                for orgnr in orgnrs if orgnr in organizations
+            },
+            "missing": [orgnr for orgnr in orgnrs if orgnr not in organizations],
+        })
+
+
+class TopOwnersViewSet(APIView):
+    """
+    Largest owners of the organization (n, 10 by default), with an ETag and Last-Modified for conditional requests.
+    They are kept in the organization's document, so the owners aren't read.
+    """
+    def get(self, request, orgnr):
+        try:
+            n = int(request.query_params.get("n", 10))
+            if not 0 < n <= settings.CONCENTRATION["TOP_OWNERS"]:
+                raise ValueError("n must be between 1 and {}".format(settings.CONCENTRATION["TOP_OWNERS"]))
+        except ValueError as exc:
+            return JsonResponse({"detail": "Invalid n: {}".format(exc)}, status=HTTP_400_BAD_REQUEST)
+
+        if is_conditional(request):
+            response = not_modified_organization(request, organization_validator_fields(orgnr))
+            if response is not None:
+                return response
+
+        organization = cached_organization(orgnr)
+        if organization is None:
+            return Response(status=HTTP_404_NOT_FOUND)
+
+        validators = organization_validators(organization)
+        response = not_modified_response(request, validators)
+        if response is None:
+            response = JsonResponse({
+                "orgnr": orgnr,
+                "total_shares": organization["total_shares"],
+                "owners": top_owners(organization, n),
             })
+        return with_validators(response, validators)
+
+
+class LeaderboardViewSet(APIView):
+    """
+    Largest holders of the registry by metric: holdings (organizations held), shares (total shares held) or
+    controlled (organizations where they have the majority of the shares). The leaderboards are precomputed, so it
+    reads only the first limit entries (10 by default) of one document.
+    """
+    def get(self, request, metric):
+        if metric not in METRICS:
+            return JsonResponse(
+                {"detail": "Unknown metric, expected one of: {}.".format(", ".join(METRICS))}, status=HTTP_404_NOT_FOUND
+            )
+        try:
+            limit = int(request.query_params.get("limit", 10))
+            if not 0 < limit <= settings.LEADERBOARD_SIZE:
+                raise ValueError("limit must be between 1 and {}".format(settings.LEADERBOARD_SIZE))
+        except ValueError as exc:
+            return JsonResponse({"detail": "Invalid limit: {}".format(exc)}, status=HTTP_400_BAD_REQUEST)
+
+        leaderboard = ReadOnlyDB().find_leaderboard(metric, limit) or {"entries": []}
+        owners = []
+        for entry in leaderboard["entries"]:
+            owner_type, _id = entry["key"].split(":")
+            owners.append({"owner_type": owner_type, "id": int(_id), "name": entry["name"], "value": entry["value"]})
+        return JsonResponse({"metric": metric, "updated_at": leaderboard.get("updated_at"), "owners": owners})
+
+
+def cut_offs(request, config) -> Tuple[int, float]:
+    """
+    max_depth and min_percentage parameters of the traversals, with the defaults and limits of the config
+    """
+    max_depth = int(request.query_params.get("max_depth", config["MAX_DEPTH"]))
+    min_percentage = float(request.query_params.get("min_percentage", config["MIN_PERCENTAGE"]))
+    if not 0 < max_depth <= config["MAX_DEPTH_LIMIT"]:
+        raise ValueError("max_depth must be between 1 and {}".format(config["MAX_DEPTH_LIMIT"]))
+    if not 0 <= min_percentage <= 100:
+        raise ValueError("min_percentage must be between 0 and 100")
+    return max_depth, min_percentage
+
+
+def invalid_cut_offs(exc) -> JsonResponse:
+    return JsonResponse({"detail": "Invalid cut-off: {}".format(exc)}, status=HTTP_400_BAD_REQUEST)
+
+
+class UltimateOwnersViewSet(APIView):
+    """
+    Persons (and organizations without owners) that own the organization directly or through chains of
+    organizations, with their effective percentage. max_depth and min_percentage cut the chains. The owners of the
+    most requested organizations are precomputed with the default cut-offs.
+    """
+    def get(self, request, orgnr):
+        config = settings.ULTIMATE_OWNERS
+        try:
+            max_depth, min_percentage = cut_offs(request, config)
+        except ValueError as exc:
+            return invalid_cut_offs(exc)
+
+        rodb = ReadOnlyDB()
+        data = None
+        if max_depth == config["MAX_DEPTH"] and min_percentage == config["MIN_PERCENTAGE"]:
+            data = rodb.find_ultimate_owners(orgnr, max_depth, min_percentage)
+        if data is None:
+            if not Organization.objects.filter(orgnr=orgnr).exists():
+                return Response(status=HTTP_404_NOT_FOUND)
+            data = {
+                "owners": ultimate_owners(orgnr, max_depth, min_percentage),
+                "computed_at": datetime.utcnow(),
+            }
+        rodb.record_ultimate_owners_request(orgnr)
+
+        return JsonResponse({
+            "orgnr": orgnr,
+            "max_depth": max_depth,
+            "min_percentage": min_percentage,
+            "computed_at": data["computed_at"],
+            "owners": data["owners"],
+        })
+
+
+def not_in_graph() -> JsonResponse:
+    return JsonResponse({"detail": "Not in the ownership graph."}, status=HTTP_404_NOT_FOUND)
+
+
+class GraphDownstreamViewSet(APIView):
+    """
+    Organizations that the organization owns directly or through other organizations, with its effective percentage,
+    from the in-memory ownership graph
+    """
+    def get(self, request, orgnr):
+        try:
+            max_depth, min_percentage = cut_offs(request, settings.OWNERSHIP_GRAPH)
+        except ValueError as exc:
+            return invalid_cut_offs(exc)
+
+        graph = get_ownership_graph()
+        node = graph.index(node_key("organization", orgnr))
+        if node is None:
+            return not_in_graph()
+        return JsonResponse({
+            "orgnr": orgnr,
+            "max_depth": max_depth,
+            "min_percentage": min_percentage,
+            "organizations": graph.downstream(node, max_depth, min_percentage),
+        })
+
+
+class GraphUpstreamViewSet(APIView):
+    """
+    Organizations and persons that own the organization directly or through other organizations, from the in-memory
+    ownership graph
+    """
+    def get(self, request, orgnr):
+        try:
+            max_depth, _ = cut_offs(request, settings.OWNERSHIP_GRAPH)
+        except ValueError as exc:
+            return invalid_cut_offs(exc)
+
+        graph = get_ownership_graph()
+        node = graph.index(node_key("organization", orgnr))
+        if node is None:
+            return not_in_graph()
+        return JsonResponse({"orgnr": orgnr, "max_depth": max_depth, "owners": graph.upstream(node, max_depth)})
+
+
+class GraphPathViewSet(APIView):
+    """
+    Shortest chain of holdings from the source (an orgnr, or person:<id>) to the target organization
+    """
+    def get(self, request):
+        try:
+            max_depth, _ = cut_offs(request, settings.OWNERSHIP_GRAPH)
+            source = request.query_params["source"]
+            owner_type, _, _id = source.rpartition(":")
+            if owner_type not in ("", "organization", "person"):
+                raise ValueError("unknown owner type {}".format(owner_type))
+            source_key = node_key(owner_type or "organization", int(_id))
+            target = int(request.query_params["target"])
+        except (KeyError, ValueError) as exc:
+            return JsonResponse({"detail": "Invalid path: {}".format(exc)}, status=HTTP_400_BAD_REQUEST)
+
+        graph = get_ownership_graph()
+        source_node = graph.index(source_key)
+        target_node = graph.index(node_key("organization", target))
+        if source_node is None or target_node is None:
+            return not_in_graph()
+        path = graph.path(source_node, target_node, max_depth)
+        if path is None:
+            return JsonResponse({"detail": "No ownership path."}, status=HTTP_404_NOT_FOUND)
+        return JsonResponse({"source": source, "target": target, "path": path})
+
+
+class GraphStatsViewSet(APIView):
+    """
+    Size of the in-memory ownership graph of this process
+    """
+    def get(self, request):
+        return JsonResponse(get_ownership_graph().stats())
+
+
+class ReadOnlyPoolStatsViewSet(APIView):
+    """
+    Connection pool statistics of the read-only database clients of this process
+    """
+    def get(self, request):
+        return JsonResponse(ReadOnlyDB.pool_stats())
+
+
+class ReadOnlyCacheStatsViewSet(APIView):
+    """
+    Statistics of the organization cache of this process
+    """
+    def get(self, request):
+        return JsonResponse(organization_cache.stats())
@@ -89,6 +89,106 @@ DATABASES = {
     }
 }
 
+# Read-only database (MongoDB). OPTIONS are passed as they are to the MongoClient, so every option
+# supported by pymongo can be added here.
+
+READ_ONLY_DATABASE = {
+    'NAME': os.getenv('MONGO_DB'),
+    'USER': os.getenv('MONGO_USER'),
+    'PASSWORD': os.getenv('MONGO_PASSWORD'),
+    'HOST': os.getenv('MONGO_HOST'),
+    'PORT': os.getenv('MONGO_PORT'),
+    'OPTIONS': {
+        'maxPoolSize': int(os.getenv('MONGO_MAX_POOL_SIZE', 100)),
+        'minPoolSize': int(os.getenv('MONGO_MIN_POOL_SIZE', 0)),
+        'maxIdleTimeMS': int(os.getenv('MONGO_MAX_IDLE_TIME_MS', 60000)),
+        'waitQueueTimeoutMS': int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000)),
+        'connectTimeoutMS': int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+        'socketTimeoutMS': int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', 10000)),
+        'serverSelectionTimeoutMS': int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+        'readPreference': os.getenv('MONGO_READ_PREFERENCE', 'primary'),
+        'w': os.getenv('MONGO_WRITE_CONCERN', '1'),
+    },
+}
+
+# How a new share is saved into the read-only database: "incremental" applies atomic updates to the organization
+# documents, "full" computes the documents again from the write-only database.
+
+READ_ONLY_PROJECTION = os.getenv('READ_ONLY_PROJECTION', 'incremental')
+
+# The shares are published into READ_ONLY_PARTITIONS queues by the hash of the owned organization
+
+READ_ONLY_PARTITIONS = int(os.getenv('READ_ONLY_PARTITIONS', 8))
+
+# The owners of an organization are saved in bucket documents of up to READ_ONLY_OWNER_BUCKET_SIZE owners
+
+READ_ONLY_OWNER_BUCKET_SIZE = int(os.getenv('READ_ONLY_OWNER_BUCKET_SIZE', 1000))
+
+# Owners and holdings per page when the request doesn't send a limit, and max limit
+
+READ_ONLY_PAGE_SIZE = int(os.getenv('READ_ONLY_PAGE_SIZE', 1000))
+READ_ONLY_MAX_PAGE_SIZE = int(os.getenv('READ_ONLY_MAX_PAGE_SIZE', 10000))
+
+# Max organizations of a batch summary request
+
+READ_ONLY_MAX_BATCH_SIZE = int(os.getenv('READ_ONLY_MAX_BATCH_SIZE', 1000))
+
+# In-process cache of the organizations read by the summary and owners endpoints, MAX_SIZE 0 disables it. The
+# organizations are removed from the cache of every process through the shares fanout exchange when they change
+
+READ_ONLY_CACHE = {
+    'MAX_SIZE': int(os.getenv('READ_ONLY_CACHE_MAX_SIZE', 10000)),
+    'TTL_SECONDS': float(os.getenv('READ_ONLY_CACHE_TTL_SECONDS', 30)),
+}
+
+# Ultimate owners: the chains of owners are followed up to MAX_DEPTH organizations (requests can ask for up to
+# MAX_DEPTH_LIMIT) and cut when the effective percentage is lower than MIN_PERCENTAGE. The owners of the
+# PRECOMPUTED_COMPANIES most requested organizations are computed with the default cut-offs by
+# precompute_ultimate_owners
+
+ULTIMATE_OWNERS = {
+    'MAX_DEPTH': int(os.getenv('ULTIMATE_OWNERS_MAX_DEPTH', 10)),
+    'MAX_DEPTH_LIMIT': int(os.getenv('ULTIMATE_OWNERS_MAX_DEPTH_LIMIT', 30)),
+    'MIN_PERCENTAGE': float(os.getenv('ULTIMATE_OWNERS_MIN_PERCENTAGE', 0.01)),
+    'PRECOMPUTED_COMPANIES': int(os.getenv('ULTIMATE_OWNERS_PRECOMPUTED_COMPANIES', 10000)),
+}
+
+# In-memory ownership graph of every process: default and max depth of the traversals, min effective percentage
+# of the downstream chains, and delay of the background rebuild after it is used with pending invalidations (the
+# invalidations of that time are applied in one rebuild)
+
+OWNERSHIP_GRAPH = {
+    'MAX_DEPTH': int(os.getenv('OWNERSHIP_GRAPH_MAX_DEPTH', 10)),
+    'MAX_DEPTH_LIMIT': int(os.getenv('OWNERSHIP_GRAPH_MAX_DEPTH_LIMIT', 50)),
+    'MIN_PERCENTAGE': float(os.getenv('OWNERSHIP_GRAPH_MIN_PERCENTAGE', 0.01)),
+    'REBUILD_DELAY_MS': int(os.getenv('OWNERSHIP_GRAPH_REBUILD_DELAY_MS', 1000)),
+}
+
+# Ownership concentration kept in the organization documents: number of largest owners (changing it needs a rebuild
+# of the read-only db) and min percentage of an owner that is not part of the free float. With TOP_OWNERS of at least
+# 100 / FREE_FLOAT_THRESHOLD every owner above the threshold is one of the largest owners
+
+CONCENTRATION = {
+    'TOP_OWNERS': int(os.getenv('CONCENTRATION_TOP_OWNERS', 20)),
+    'FREE_FLOAT_THRESHOLD': float(os.getenv('CONCENTRATION_FREE_FLOAT_THRESHOLD', 5)),
+}
+
+# Registry-wide leaderboards of the largest holders: entries kept per metric (the max limit of the endpoint)
+
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', 100))
+
+# Publisher of the messages to the amqp broker. The messages are buffered and sent in batches of BATCH_SIZE or
+# every FLUSH_INTERVAL_MS. When MAX_BUFFER messages are waiting (e.g. the broker is down) a message waits at most
+# PUBLISH_TIMEOUT_MS for room and is dropped after it
+
+AMQP_PUBLISHER = {
+    'BATCH_SIZE': int(os.getenv('AMQP_PUBLISH_BATCH_SIZE', 500)),
+    'FLUSH_INTERVAL_MS': int(os.getenv('AMQP_PUBLISH_FLUSH_INTERVAL_MS', 20)),
+    'MAX_BUFFER': int(os.getenv('AMQP_PUBLISH_MAX_BUFFER', 100000)),
+    'PUBLISH_TIMEOUT_MS': int(os.getenv('AMQP_PUBLISH_TIMEOUT_MS', 100)),
+    'RECONNECT_DELAY_MS': int(os.getenv('AMQP_RECONNECT_DELAY_MS', 1000)),
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 